@@ -22,25 +22,29 @@
 #   Sharding and Consistent Hashing implementation by Gleicon Moraes.
 #
 
+import binascii
 import bisect
 import collections
 import functools
 import operator
-import re
 import types
 import warnings
 import zlib
 import string
+import struct
+import sys
 import hashlib
 
 from twisted.internet import defer
 from twisted.internet import protocol
 from twisted.internet import reactor
-from twisted.protocols import basic
+from twisted.internet import task
 from twisted.protocols import policies
 from twisted.python import log
 from twisted.python.failure import Failure
 
+from cyclone.util import LRUCache, WriteCoalescer
+
 try:
     import hiredis
 except ImportError:
@@ -79,6 +83,22 @@ class WatchError(RedisError):
     pass
 
 
+class ClusterError(RedisError):
+    pass
+
+
+class SentinelError(ConnectionError):
+    pass
+
+
+class PoolTimeoutError(ConnectionError):
+    pass
+
+
+class CommandTimeoutError(RedisError):
+    pass
+
+
 def list_or_args(command, keys, args):
     oldapi = bool(args)
     try:
@@ -99,126 +119,302 @@ def list_or_args(command, keys, args):
         keys.extend(args)
     return keys
 
-# Possible first characters in a string containing an integer or a float.
-_NUM_FIRST_CHARS = frozenset(string.digits + "+-.")
 
+class ScanIterator(object):
+    """
+    Drives the cursor of SCAN, SSCAN, HSCAN or ZSCAN, one page per
+    command, and hands out the pages as batches.
 
-class MultiBulkStorage(object):
-    def __init__(self, parent=None):
-        self.items = None
-        self.pending = None
-        self.parent = parent
+    ``next()`` returns a deferred fired with the next non-empty batch, or
+    with None when the iteration is over. Up to ``prefetch`` pages are
+    requested ahead of the consumer, so memory stays bounded however big
+    the collection is. Calls to ``next()`` made before the previous one
+    fired get the following batches, in order. ``cancel()`` stops the
+    iteration, and so does cancelling a deferred returned by ``next()``::
 
-    def set_pending(self, pending):
-        if self.pending is None:
-            if pending < 0:
-                self.items = None
-                self.pending = 0
-            else:
-                self.items = []
-                self.pending = pending
-            return self
-        else:
-            m = MultiBulkStorage(self)
-            m.set_pending(pending)
-            return m
-
-    def append(self, item):
-        self.pending -= 1
-        self.items.append(item)
-
-
-class LineReceiver(protocol.Protocol, basic._PauseableMixin):
-    callLater = reactor.callLater
-    line_mode = 1
-    __buffer = ''
-    delimiter = '\r\n'
-    MAX_LENGTH = 16384
-
-    def clearLineBuffer(self):
-        b = self.__buffer
-        self.__buffer = ""
-        return b
-
-    def dataReceived(self, data, unpause=False):
-        if unpause is True:
-            if self.__buffer:
-                self.__buffer = data + self.__buffer
+        it = rc.scan_iter(pattern="session:*", count=1000)
+        while True:
+            keys = yield it.next()
+            if keys is None:
+                break
+            yield rc.delete(keys)
+    """
+    def __init__(self, command, post_proc=None, prefetch=1):
+        self._command = command
+        self._post_proc = post_proc
+        self._prefetch = max(1, prefetch)
+        self._cursor = 0
+        self._pages = []
+        self._fetching = False
+        self._waiting = []
+        self.finished = False
+        self.cancelled = False
+        self._fetch()
+
+    def _fetch(self):
+        if self._fetching or self.finished or self.cancelled or \
+                len(self._pages) >= self._prefetch:
+            return
+        self._fetching = True
+        d = defer.maybeDeferred(self._command, self._cursor)
+        d.addCallbacks(self._pageReceived, self._pageFailed)
+
+    def _pageReceived(self, reply):
+        self._fetching = False
+        cursor, items = reply
+        self._cursor = int(cursor)
+        if self._cursor == 0:
+            self.finished = True
+        if items and not self.cancelled:
+            if self._post_proc is not None:
+                items = self._post_proc(items)
+            self._deliver(items)
+        elif self.finished:
+            self._deliver(None)
+        self._fetch()
+
+    def _pageFailed(self, failure):
+        self._fetching = False
+        self.finished = True
+        self._deliver(failure)
+
+    def _deliver(self, page):
+        if self._waiting:
+            d = self._waiting.pop(0)
+            if isinstance(page, Failure):
+                d.errback(page)
             else:
-                self.__buffer += data
+                d.callback(page)
+        elif page is not None:
+            self._pages.append(page)
+        if self.finished:
+            # No page is coming for the other consumers.
+            waiting, self._waiting = self._waiting, []
+            for d in waiting:
+                d.callback(None)
 
-            self.resumeProducing()
-        else:
-            self.__buffer = self.__buffer + data
+    def next(self):
+        if self._pages:
+            page = self._pages.pop(0)
+            self._fetch()
+            if isinstance(page, Failure):
+                return defer.fail(page)
+            return defer.succeed(page)
+        if self.finished or self.cancelled:
+            return defer.succeed(None)
+        d = defer.Deferred(lambda d: self.cancel())
+        self._waiting.append(d)
+        return d
 
-        while self.line_mode and not self.paused:
-            try:
-                line, self.__buffer = self.__buffer.split(self.delimiter, 1)
-            except ValueError:
-                if len(self.__buffer) > self.MAX_LENGTH:
-                    line, self.__buffer = self.__buffer, ''
-                    return self.lineLengthExceeded(line)
-                break
-            else:
-                linelength = len(line)
-                if linelength > self.MAX_LENGTH:
-                    exceeded = line + self.__buffer
-                    self.__buffer = ''
-                    return self.lineLengthExceeded(exceeded)
-                why = self.lineReceived(line)
-                if why or self.transport and self.transport.disconnecting:
-                    return why
-        else:
-            if not self.paused:
-                data = self.__buffer
-                self.__buffer = ''
-                if data:
-                    return self.rawDataReceived(data)
+    def cancel(self):
+        """
+        Stops the iteration. A page being fetched is discarded when it
+        arrives, because the connection must still read its reply.
+        """
+        self.cancelled = True
+        self._pages = []
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            if not d.called:
+                d.errback(defer.CancelledError())
 
-    def setLineMode(self, extra=''):
-        self.line_mode = 1
-        if extra:
-            self.pauseProducing()
-            self.callLater(0, self.dataReceived, extra, True)
 
-    def setRawMode(self):
-        self.line_mode = 0
+def _scanNodes(nodes, pattern, count, prefetch):
+    """
+    Returns a `ScanIterator` over the keys of every node, scanned one
+    after the other. ``nodes`` returns a deferred fired with the list of
+    nodes when the first page is requested. The cursor packs the index of
+    the node with the cursor of that node.
+    """
+    found = []
+
+    def scan(cursor):
+        if not found:
+            return nodes().addCallback(started)
+        index, nodeCursor = cursor % len(found), cursor // len(found)
+        return found[index].scan(nodeCursor, pattern, count).addCallback(
+            page, index)
+
+    def started(result):
+        found.extend(result)
+        if not found:
+            return [0, []]
+        return scan(0)
+
+    def page(reply, index):
+        nodeCursor, items = reply
+        nodeCursor = int(nodeCursor)
+        if nodeCursor:
+            return [nodeCursor * len(found) + index, items]
+        # A zero cursor moves on to the next node, if any.
+        return [(index + 1) % len(found), items]
+
+    return ScanIterator(scan, prefetch=prefetch)
+
+
+def _pairs(items):
+    return zip(items[::2], items[1::2])
+
+
+def _streamEntries(reply):
+    # Entries deleted while pending have no fields.
+    return [(eid, dict(_pairs(fields or []))) for eid, fields in reply]
+
+
+def _streams(reply):
+    return dict((key, _streamEntries(entries))
+                for key, entries in reply or [])
+
+
+def _pendingSummary(reply):
+    count, smallest, greatest, consumers = reply
+    return {
+        "pending": count,
+        "min": smallest,
+        "max": greatest,
+        "consumers": dict((name, int(n)) for name, n in consumers or []),
+    }
+
+
+class ScanIteratorMixin(object):
+    """
+    Iterators over SCAN, SSCAN, HSCAN and ZSCAN, for connections and
+    connection handlers. Every page is a separate command, which may run
+    on any connection of a pool.
+    """
+    def scan_iter(self, pattern=None, count=None, prefetch=1):
+        return ScanIterator(lambda cursor: self.scan(cursor, pattern, count),
+                            prefetch=prefetch)
+
+    def sscan_iter(self, key, pattern=None, count=None, prefetch=1):
+        return ScanIterator(
+            lambda cursor: self.sscan(key, cursor, pattern, count),
+            prefetch=prefetch)
+
+    def hscan_iter(self, key, pattern=None, count=None, prefetch=1):
+        """Batches are lists of (field, value) tuples."""
+        return ScanIterator(
+            lambda cursor: self.hscan(key, cursor, pattern, count),
+            _pairs, prefetch)
+
+    def zscan_iter(self, key, pattern=None, count=None, prefetch=1):
+        """Batches are lists of (member, score) tuples."""
+        return ScanIterator(
+            lambda cursor: self.zscan(key, cursor, pattern, count),
+            lambda items: [(m, float(s)) for m, s in _pairs(items)],
+            prefetch)
+
+
+class Script(object):
+    """
+    A Lua script, returned by ``register_script``. Calling it runs the
+    script with EVALSHA, and with EVAL when redis does not know it yet,
+    or not anymore, after a restart or SCRIPT FLUSH. The script is only
+    sent again in these cases.
+
+    ``client`` runs the script on a pipeline, or on another connection.
+    Replies of pipelines only arrive once executed, too late to fall back
+    to EVAL, so the first use of the script on each connection sends its
+    source in the pipeline.
+    """
+    def __init__(self, client, script):
+        self.client = client
+        self.script = script
+        if isinstance(script, unicode):
+            script = script.encode("utf-8")
+        self.sha = hashlib.sha1(script).hexdigest()
+
+    def __call__(self, keys=[], args=[], client=None):
+        if client is None:
+            client = self.client
+
+        if isinstance(client, BaseRedisProtocol) and client.pipelining:
+            if self.sha in client.script_hashes:
+                return client.evalsha(self.sha, keys, args)
+            client.script_hashes.add(self.sha)
+            return client.execute_command("EVAL", self.script, len(keys),
+                                          *(tuple(keys) + tuple(args)))
+
+        d = client.evalsha(self.sha, keys, args)
+        d.addErrback(self._evalsha_failed, client, keys, args)
+        return d
+
+    def _evalsha_failed(self, err, client, keys, args):
+        err.trap(ScriptDoesNotExist)
+        return client.eval(self.script, keys, args)
+
+    def __repr__(self):
+        return "<Redis Script: %s>" % self.sha
 
-    def rawDataReceived(self, data):
-        raise NotImplementedError
 
-    def lineReceived(self, line):
-        raise NotImplementedError
+# Possible first characters in a string containing an integer or a float.
+_NUM_FIRST_CHARS = frozenset(string.digits + "+-.")
+
+
+def _rawCall(conn, raw, method, args, kwargs):
+    if not raw:
+        return getattr(conn, method)(*args, **kwargs)
+    conn.rawReplies = True
+    try:
+        return getattr(conn, method)(*args, **kwargs)
+    finally:
+        conn.rawReplies = False
+
 
-    def sendLine(self, line):
-        return self.transport.write(line + self.delimiter)
+class RawReplies(object):
+    """
+    Runs the commands of a connection or connection handler, returned by
+    their ``raw`` method, and gives their replies as they come from redis:
+    bulk strings are neither decoded nor converted to numbers.
+    """
+    def __init__(self, client):
+        self._client = client
 
-    def lineLengthExceeded(self, line):
-        return self.transport.loseConnection()
+    def __getattr__(self, method):
+        if isinstance(self._client, BaseRedisProtocol):
+            return lambda *args, **kwargs: _rawCall(self._client, True,
+                                                    method, args, kwargs)
+        return functools.partial(self._client._call, method, True)
 
 
-class BaseRedisProtocol(LineReceiver, policies.TimeoutMixin):
+class BaseRedisProtocol(protocol.Protocol, policies.TimeoutMixin,
+                        ScanIteratorMixin):
     """
     Redis client protocol.
+
+    Bulk strings are converted to numbers when the factory has
+    ``convertNumbers``, and decoded with ``charset``. Without either,
+    or for the commands sent through ``raw()``, replies are left as they
+    come, without looking at each element.
     """
+    rawReplies = False
 
     def __init__(self, charset="utf-8", errors="strict"):
         self.charset = charset
         self.errors = errors
 
-        self.bulk_length = 0
-        self.bulk_buffer = []
+        self._buffer = ""
+        self._bulk_chunks = []
+        self._bulk_remaining = 0
+        self._stack = []
+        # The converters of the replies to the commands sent, in order,
+        # and of the reply being parsed.
+        self._converters = collections.deque()
+        self._convert = None
 
         self.post_proc = []
-        self.multi_bulk = MultiBulkStorage()
 
         self.replyQueue = defer.DeferredQueue()
+        # The replies still expected, and the callers of drained().
+        self.pendingReplies = 0
+        self._drainWaiters = []
 
         self.transactions = 0
         self.inTransaction = False
         self.inMulti = False
         self.unwatch_cc = lambda: ()
         self.commit_cc = lambda: ()
+        self.pipeline_cc = lambda: ()
 
         self.script_hashes = set()
 
@@ -228,6 +424,9 @@ class BaseRedisProtocol(LineReceiver, policies.TimeoutMixin):
 
     @defer.inlineCallbacks
     def connectionMade(self):
+        if getattr(self.factory, "autoPipeline", False):
+            self.transport = WriteCoalescer(self.transport)
+
         if self.factory.password is not None:
             try:
                 response = yield self.auth(self.factory.password)
@@ -264,112 +463,155 @@ class BaseRedisProtocol(LineReceiver, policies.TimeoutMixin):
 
     def connectionLost(self, why):
         self.connected = 0
+        if isinstance(self.transport, WriteCoalescer):
+            self.transport.discard()
         self.script_hashes.clear()
+        self._converters.clear()
         self.factory.delConnection(self)
-        LineReceiver.connectionLost(self, why)
+        protocol.Protocol.connectionLost(self, why)
         while self.replyQueue.waiting:
             self.replyReceived(ConnectionError("Lost connection"))
 
-    def lineReceived(self, line):
+    def dataReceived(self, data):
         """
+        Parses every complete reply out of the received data in one pass.
+
         Reply types:
           "-" error message
           "+" single line status reply
           ":" integer number (protocol level only?)
           "$" bulk data
           "*" multi-bulk data
-        """
-        if line:
-            self.resetTimeout()
-            token, data = line[0], line[1:]
-        else:
-            return
-
-        if token == "$":  # bulk data
-            try:
-                self.bulk_length = long(data)
-            except ValueError:
-                self.replyReceived(InvalidResponse("Cannot convert data "
-                                                   "'%s' to integer" % data))
-            else:
-                if self.bulk_length == -1:
-                    self.bulk_length = 0
-                    self.bulkDataReceived(None)
-                else:
-                    self.bulk_length += 2  # 2 == \r\n
-                    self.setRawMode()
-
-        elif token == "*":  # multi-bulk data
-            try:
-                n = long(data)
-            except (TypeError, ValueError):
-                self.multi_bulk = MultiBulkStorage()
-                self.replyReceived(InvalidResponse("Cannot convert "
-                                                   "multi-response header "
-                                                   "'%s' to integer" % data))
-            else:
-                self.multi_bulk = self.multi_bulk.set_pending(n)
-                if n in (0, -1):
-                    self.multiBulkDataReceived()
 
-        elif token == "+":  # single line status
-            if data == "QUEUED":
-                self.transactions += 1
-                self.replyReceived(data)
-            else:
-                if self.multi_bulk.pending:
-                    self.handleMultiBulkElement(data)
+        Incomplete lines are kept in the buffer until more data arrives,
+        and incomplete bulk data is collected in chunks, so big replies
+        are not parsed over and over again.
+        """
+        self.resetTimeout()
+        if self._bulk_remaining:
+            size = len(data)
+            if size < self._bulk_remaining:
+                self._bulk_chunks.append(data)
+                self._bulk_remaining -= size
+                return
+            self._bulk_chunks.append(data[:self._bulk_remaining])
+            data = data[self._bulk_remaining:]
+            bulk = "".join(self._bulk_chunks)[:-2]
+            self._bulk_chunks = []
+            self._bulk_remaining = 0
+            if self._convert is not None:
+                bulk = self._convert(bulk)
+            self._elementReceived(bulk)
+        elif self._buffer:
+            data = self._buffer + data
+            self._buffer = ""
+
+        pos = 0
+        size = len(data)
+        find = data.find
+        while pos < size:
+            eol = find("\r\n", pos)
+            if eol == -1:
+                break
+            if not self._stack:
+                self._convert = self._converters[0] if self._converters \
+                    else self._defaultConverter()
+            token = data[pos]
+            if token == "$":  # bulk data
+                try:
+                    length = int(data[pos + 1:eol])
+                except ValueError:
+                    element = InvalidResponse("Cannot convert data '%s' to "
+                                              "integer" % data[pos + 1:eol])
+                    pos = eol + 2
                 else:
-                    self.replyReceived(data)
-
-        elif token == "-":  # error
-            reply = ResponseError(data[4:] if data[:4] == "ERR" else data)
-            if self.multi_bulk.pending:
-                self.handleMultiBulkElement(reply)
-            else:
-                self.replyReceived(reply)
-
-        elif token == ":":  # integer
-            try:
-                reply = int(data)
-            except ValueError:
-                reply = InvalidResponse(
-                    "Cannot convert data '%s' to integer" % data)
+                    if length == -1:
+                        element = None
+                        pos = eol + 2
+                    else:
+                        start = eol + 2
+                        pos = start + length + 2
+                        if pos > size:
+                            # Wait for the rest of the bulk data.
+                            self._bulk_chunks = [data[start:]]
+                            self._bulk_remaining = pos - size
+                            return
+                        element = data[start:pos - 2]
+                        if self._convert is not None:
+                            element = self._convert(element)
+
+            elif token == "*":  # multi-bulk data
+                try:
+                    length = int(data[pos + 1:eol])
+                except ValueError:
+                    self._stack = []
+                    self._replyDone()
+                    self.replyReceived(InvalidResponse(
+                        "Cannot convert multi-response header "
+                        "'%s' to integer" % data[pos + 1:eol]))
+                    pos = eol + 2
+                    continue
+                pos = eol + 2
+                if length > 0:
+                    self._stack.append(([], length))
+                    continue
+                element = [] if length == 0 else None
+
+            elif token == "+":  # single line status
+                element = data[pos + 1:eol]
+                pos = eol + 2
+                if element == "QUEUED" and not self._stack:
+                    self.transactions += 1
+                    self._replyDone()
+                    self.replyReceived(element)
+                    continue
+
+            elif token == "-":  # error
+                element = ResponseError(data[pos + 1:eol])
+                pos = eol + 2
+
+            elif token == ":":  # integer
+                try:
+                    element = int(data[pos + 1:eol])
+                except ValueError:
+                    element = InvalidResponse("Cannot convert data '%s' to "
+                                              "integer" % data[pos + 1:eol])
+                pos = eol + 2
 
-            if self.multi_bulk.pending:
-                self.handleMultiBulkElement(reply)
             else:
-                self.replyReceived(reply)
-
-    def rawDataReceived(self, data):
-        """
-        Process and dispatch to bulkDataReceived.
-        """
-        if self.bulk_length:
-            data, rest = data[:self.bulk_length], data[self.bulk_length:]
-            self.bulk_length -= len(data)
-        else:
-            rest = ""
-
-        self.bulk_buffer.append(data)
-        if self.bulk_length == 0:
-            bulk_buffer = "".join(self.bulk_buffer)[:-2]
-            self.bulk_buffer = []
-            self.bulkDataReceived(bulk_buffer)
-            self.setLineMode(extra=rest)
-
-    def bulkDataReceived(self, data):
-        """
-        Receipt of a bulk data element.
-        """
-        el = None
-        if data is not None:
-            el = self.tryConvertData(data)
-
-        if self.multi_bulk.pending or self.multi_bulk.items:
-            self.handleMultiBulkElement(el)
-        else:
-            self.replyReceived(el)
+                pos = eol + 2
+                continue
+
+            self._elementReceived(element)
+
+        if pos < size:
+            self._buffer = data[pos:]
+
+    def _elementReceived(self, element):
+        stack = self._stack
+        while stack:
+            items, length = stack[-1]
+            items.append(element)
+            if len(items) < length:
+                return
+            stack.pop()
+            element = items
+
+        self._replyDone()
+        if isinstance(element, list):
+            element = self.handleTransactionData(element)
+        self.replyReceived(element)
+
+    def _defaultConverter(self):
+        if self.charset is None and not self.factory.convertNumbers:
+            return None
+        return self.tryConvertData
+
+    def _replyDone(self):
+        # Unsolicited replies, like messages of subscriptions, have no
+        # converter of their own.
+        if self._converters:
+            self._converters.popleft()
 
     def tryConvertData(self, data):
         if not isinstance(data, str):
@@ -391,29 +633,6 @@ class BaseRedisProtocol(LineReceiver, policies.TimeoutMixin):
                     pass
         return el
 
-    def handleMultiBulkElement(self, element):
-        self.multi_bulk.append(element)
-
-        if not self.multi_bulk.pending:
-            self.multiBulkDataReceived()
-
-    def multiBulkDataReceived(self):
-        """
-        Receipt of list or set of bulk data elements.
-        """
-        while self.multi_bulk.parent and not self.multi_bulk.pending:
-            p = self.multi_bulk.parent
-            p.append(self.multi_bulk.items)
-            self.multi_bulk = p
-
-        if not self.multi_bulk.pending:
-            reply = self.multi_bulk.items
-            self.multi_bulk = MultiBulkStorage()
-
-            reply = self.handleTransactionData(reply)
-
-            self.replyReceived(reply)
-
     def handleTransactionData(self, reply):
         if self.inTransaction and isinstance(reply, list):
             # watch or multi has been called
@@ -438,8 +657,26 @@ class BaseRedisProtocol(LineReceiver, policies.TimeoutMixin):
         Complete reply received and ready to be pushed to the requesting
         function.
         """
+        self.pendingReplies -= 1
+        if not self.pendingReplies and self._drainWaiters:
+            # Commands sent now get their replies after this one, whatever
+            # the callbacks of this reply do.
+            waiters, self._drainWaiters = self._drainWaiters, []
+            for d in waiters:
+                d.callback(self)
         self.replyQueue.put(reply)
 
+    def drained(self):
+        """
+        Returns a Deferred which fires with the connection once the replies
+        of the commands sent on it have arrived.
+        """
+        if not self.pendingReplies:
+            return defer.succeed(self)
+        d = defer.Deferred()
+        self._drainWaiters.append(d)
+        return d
+
     @staticmethod
     def handle_reply(r):
         if isinstance(r, Exception):
@@ -480,6 +717,10 @@ class BaseRedisProtocol(LineReceiver, policies.TimeoutMixin):
             else:
                 self.transport.write(command)
 
+            self._converters.append(None if self.rawReplies
+                                    else self._defaultConverter())
+            self.pendingReplies += 1
+
             # Return deferred that will contain the result of this command.
             # Note: when using pipelining, this deferred will NOT return
             # until after execute_pipeline is called.
@@ -1472,6 +1713,8 @@ class BaseRedisProtocol(LineReceiver, policies.TimeoutMixin):
             self.pipelining = False
             self.pipelined_commands = []
             self.pipelined_replies = []
+            pipeline_cc, self.pipeline_cc = self.pipeline_cc, lambda: ()
+            pipeline_cc()
 
     # Publish/Subscribe
     # see the SubscriberProtocol for subscribing to channels
@@ -1617,6 +1860,19 @@ class BaseRedisProtocol(LineReceiver, policies.TimeoutMixin):
     def script_load(self, script):
         return self.execute_command("SCRIPT",  "LOAD", script)
 
+    def register_script(self, script):
+        """
+        Returns a Script, to run ``script`` on this connection.
+        """
+        return Script(self, script)
+
+    def raw(self):
+        """
+        Returns a RawReplies, to run commands on this connection without
+        decoding or converting their replies.
+        """
+        return RawReplies(self)
+
     # Redis 2.8.9 HyperLogLog commands
     def pfadd(self, key, elements, *args):
         elements = list_or_args("pfadd", elements, args)
@@ -1630,23 +1886,182 @@ class BaseRedisProtocol(LineReceiver, policies.TimeoutMixin):
         sourceKeys = list_or_args("pfmerge", sourceKeys, args)
         return self.execute_command("PFMERGE", destKey, *sourceKeys)
 
+    # Redis 5.0 stream commands
+    def xadd(self, key, fields, id="*", maxlen=None, approximate=True):
+        """
+        Appends an entry to a stream, and returns its id. ``fields`` is a
+        dict, or a list of (field, value) tuples to keep their order.
+        """
+        pieces = [key]
+        if maxlen is not None:
+            pieces.append("MAXLEN")
+            if approximate:
+                pieces.append("~")
+            pieces.append(maxlen)
+        pieces.append(id)
+        if isinstance(fields, dict):
+            fields = fields.items()
+        for field, value in fields:
+            pieces.extend([field, value])
+        return self.execute_command("XADD", *pieces)
+
+    def xlen(self, key):
+        return self.execute_command("XLEN", key)
+
+    def xrange(self, key, start="-", end="+", count=None):
+        """
+        Returns the entries of a stream, as (id, fields) tuples.
+        """
+        pieces = [key, start, end]
+        if count is not None:
+            pieces.extend(["COUNT", count])
+        return self.execute_command("XRANGE", post_proc=_streamEntries,
+                                    *pieces)
+
+    def xrevrange(self, key, end="+", start="-", count=None):
+        pieces = [key, end, start]
+        if count is not None:
+            pieces.extend(["COUNT", count])
+        return self.execute_command("XREVRANGE", post_proc=_streamEntries,
+                                    *pieces)
+
+    def xdel(self, key, ids, *args):
+        ids = list_or_args("xdel", ids, args)
+        return self.execute_command("XDEL", key, *ids)
+
+    def xtrim(self, key, maxlen, approximate=True):
+        pieces = [key, "MAXLEN"]
+        if approximate:
+            pieces.append("~")
+        pieces.append(maxlen)
+        return self.execute_command("XTRIM", *pieces)
+
+    def _xread(self, pieces, streams, count, block):
+        if count is not None:
+            pieces.extend(["COUNT", count])
+        if block is not None:
+            pieces.extend(["BLOCK", block])
+        if isinstance(streams, dict):
+            streams = streams.items()
+        keys, ids = zip(*streams)
+        pieces.append("STREAMS")
+        pieces.extend(keys)
+        pieces.extend(ids)
+        return self.execute_command(post_proc=_streams, *pieces)
+
+    def xread(self, streams, count=None, block=None):
+        """
+        Reads the entries after the given ids, of a dict of {key: id}.
+        Returns a dict of {key: [(id, fields), ...]}, empty when ``block``
+        milliseconds pass without entries.
+        """
+        return self._xread(["XREAD"], streams, count, block)
+
+    def xreadgroup(self, group, consumer, streams, count=None, block=None,
+                   noack=False):
+        """
+        Reads entries as ``consumer`` of ``group``. The id ">" gets new
+        entries, other ids the entries already delivered to the consumer,
+        and not acknowledged.
+        """
+        pieces = ["XREADGROUP", "GROUP", group, consumer]
+        if noack:
+            pieces.append("NOACK")
+        return self._xread(pieces, streams, count, block)
+
+    def xgroup_create(self, key, group, id="$", mkstream=False):
+        pieces = ["CREATE", key, group, id]
+        if mkstream:
+            pieces.append("MKSTREAM")
+        return self.execute_command("XGROUP", *pieces)
+
+    def xgroup_destroy(self, key, group):
+        return self.execute_command("XGROUP", "DESTROY", key, group)
+
+    def xack(self, key, group, ids, *args):
+        """
+        Acknowledges entries, and returns how many were pending.
+        """
+        ids = list_or_args("xack", ids, args)
+        return self.execute_command("XACK", key, group, *ids)
+
+    def xpending(self, key, group, start=None, end=None, count=None,
+                 consumer=None):
+        """
+        Without ``start``, returns a summary of the pending entries of the
+        group: a dict with their number, their smallest and greatest ids,
+        and how many each consumer has. Otherwise, returns a list of
+        (id, consumer, milliseconds idle, times delivered) tuples.
+        """
+        if start is None:
+            return self.execute_command("XPENDING", key, group,
+                                        post_proc=_pendingSummary)
+        pieces = [key, group, start, end or "+", count or 10]
+        if consumer is not None:
+            pieces.append(consumer)
+        return self.execute_command(
+            "XPENDING", post_proc=lambda r: [tuple(item) for item in r],
+            *pieces)
+
+    def xclaim(self, key, group, consumer, min_idle_time, ids, justid=False):
+        """
+        Takes over the pending entries idle for at least ``min_idle_time``
+        milliseconds, and returns them, or their ids with ``justid``.
+        """
+        pieces = [key, group, consumer, min_idle_time] + list(ids)
+        if justid:
+            pieces.append("JUSTID")
+            return self.execute_command("XCLAIM", *pieces)
+        return self.execute_command("XCLAIM", post_proc=_streamEntries,
+                                    *pieces)
+
+    def xautoclaim(self, key, group, consumer, min_idle_time, start="0-0",
+                   count=None, justid=False):
+        """
+        Takes over the pending entries idle for at least ``min_idle_time``
+        milliseconds, scanning from ``start``. Returns the id to scan from
+        next time, "0-0" at the end, and the entries, or their ids with
+        ``justid``. Requires redis 6.2.
+        """
+        pieces = [key, group, consumer, min_idle_time, start]
+        if count is not None:
+            pieces.extend(["COUNT", count])
+        if justid:
+            pieces.append("JUSTID")
+
+        def post_proc(reply):
+            entries = reply[1] if justid else _streamEntries(reply[1])
+            return (reply[0], entries)
+        return self.execute_command("XAUTOCLAIM", post_proc=post_proc,
+                                    *pieces)
+
 
 class HiredisProtocol(BaseRedisProtocol):
     def __init__(self, *args, **kwargs):
         BaseRedisProtocol.__init__(self, *args, **kwargs)
+        # The reader does not decode, so that raw replies stay bytes, and
+        # others are converted just like the replies of BaseRedisProtocol.
         self._reader = hiredis.Reader(protocolError=InvalidData,
                                       replyError=ResponseError)
 
-    def dataReceived(self, data, unpause=False):
+    def _convertList(self, items, convert):
+        return [self._convertList(item, convert) if isinstance(item, list)
+                else convert(item) for item in items]
+
+    def dataReceived(self, data):
         self.resetTimeout()
         if data:
             self._reader.feed(data)
         res = self._reader.gets()
         while res is not False:
-            if isinstance(res, basestring):
-                res = self.tryConvertData(res)
-            elif isinstance(res, list):
-                res = map(self.tryConvertData, res)
+            convert = self._converters[0] if self._converters \
+                else self._defaultConverter()
+            self._replyDone()
+            if convert is not None:
+                if isinstance(res, basestring):
+                    res = convert(res)
+                elif isinstance(res, list):
+                    res = self._convertList(res, convert)
             if res == "QUEUED":
                 self.transactions += 1
             else:
@@ -1718,49 +2133,187 @@ class SubscriberProtocol(RedisProtocol):
         return self.execute_command("PUNSUBSCRIBE", *patterns)
 
 
-class ConnectionHandler(object):
+# Commands that hold on to their connection, and cannot share it with
+# other callers when auto-pipelining.
+_exclusiveMethods = frozenset([
+    "blpop",
+    "brpop",
+    "brpoplpush",
+    "multi",
+    "pipeline",
+    "watch",
+    "xread",
+    "xreadgroup",
+])
+
+# Commands that may block their connection for a long time, and are sent
+# on the blocking pool of the factory, when it has one.
+_blockingMethods = frozenset([
+    "blpop",
+    "brpop",
+    "brpoplpush",
+])
+
+
+def _switch_to_errback(reply):
+    if isinstance(reply, Exception):
+        raise reply
+    return reply
+
+
+def _deadline(d, timeout, clock):
+    """
+    Returns a Deferred which fires with the result of ``d``, or fails with
+    CommandTimeoutError after ``timeout`` seconds. ``d`` is left running,
+    so that the late reply is still read off its connection.
+    """
+    def cancel(result):
+        if call.active():
+            call.cancel()
+
+    def expired():
+        result.errback(CommandTimeoutError(
+            "No reply after %s seconds" % timeout))
+
+    def done(reply):
+        if call.active():
+            call.cancel()
+            result.callback(reply)
+
+    result = defer.Deferred(cancel)
+    call = clock.callLater(timeout, expired)
+    d.addBoth(done)
+    return result
+
+
+class ConnectionHandler(ScanIteratorMixin):
+    """
+    Runs each command on one of the connections of the pool.
+
+    By default a connection is taken out of the pool for each command,
+    and put back when its reply arrives. With ``autoPipeline``, commands
+    are sent on idle connections without taking them out of the pool:
+    the commands issued in one reactor iteration are written together,
+    and their replies are matched in order. Transactions, pipelines and
+    blocking commands still get a connection of their own, once the
+    replies of the shared commands already sent on it have arrived.
+
+    Blocking commands (BLPOP, BRPOP and BRPOPLPUSH) are sent on a pool of
+    their own, which opens a connection for each blocked caller, so that
+    they never hold on to the connections of other commands. Cancelling
+    their Deferred closes the connection.
+
+    With the ``commandTimeout`` of the factory, commands fail with
+    CommandTimeoutError when their reply takes longer than that. The
+    connection goes back to the pool once the late reply arrives.
+    """
     def __init__(self, factory):
         self._factory = factory
         self._connected = factory.deferred
 
     def disconnect(self):
-        self._factory.continueTrying = 0
-        for conn in self._factory.pool:
-            try:
-                conn.transport.loseConnection()
-            except:
-                pass
-
-        return self._factory.waitForEmptyPool()
-
-    def __getattr__(self, method):
-        def wrapper(*args, **kwargs):
-            d = self._factory.getConnection()
+        factories = [self._factory]
+        if self._factory.blocking is not None:
+            factories.append(self._factory.blocking)
 
-            def callback(connection):
-                protocol_method = getattr(connection, method)
+        for factory in factories:
+            factory.continueTrying = 0
+            for conn in factory.pool:
                 try:
-                    d = protocol_method(*args, **kwargs)
+                    conn.transport.loseConnection()
                 except:
-                    self._factory.connectionQueue.put(connection)
-                    raise
-
-                def put_back(reply):
-                    if not connection.inTransaction:
-                        self._factory.connectionQueue.put(connection)
-                    return reply
+                    pass
 
-                def switch_to_errback(reply):
-                    if isinstance(reply, Exception):
-                        raise reply
-                    return reply
+        d = self._factory.waitForEmptyPool()
+        if self._factory.blocking is not None:
+            d.addCallback(lambda _: self._factory.blocking.waitForEmptyPool())
+        return d
 
-                d.addBoth(put_back)
-                d.addCallback(switch_to_errback)
-                return d
-            d.addCallback(callback)
+    def _timeout(self, method, d):
+        # Blocking commands, transactions and pipelines wait on purpose.
+        timeout = self._factory.commandTimeout
+        if timeout is None or method in _exclusiveMethods:
             return d
-        return wrapper
+        return _deadline(d, timeout, self._factory.clock)
+
+    def register_script(self, script):
+        """
+        Returns a Script, to run ``script`` on any connection of the pool.
+        """
+        return Script(self, script)
+
+    def raw(self):
+        """
+        Returns a RawReplies, to run commands without decoding or
+        converting their replies.
+        """
+        return RawReplies(self)
+
+    def _blockingCall(self, method, raw, args, kwargs):
+        blocking = self._factory.blocking
+
+        def callback(connection):
+            def cancel(result):
+                # The server would still answer on this connection, which
+                # cannot be used for anything else, until then.
+                blocking._evict(connection)
+
+            def put_back(reply):
+                if not result.called:
+                    blocking.connectionQueue.put(connection)
+                    result.callback(reply)
+
+            result = defer.Deferred(cancel)
+            d = defer.maybeDeferred(_rawCall, connection, raw, method,
+                                    args, kwargs)
+            d.addBoth(put_back)
+            return result.addCallback(_switch_to_errback)
+
+        return blocking.getConnection().addCallback(callback)
+
+    def _call(self, method, raw, *args, **kwargs):
+        if method in _blockingMethods and self._factory.blocking is not None:
+            return self._blockingCall(method, raw, args, kwargs)
+
+        if self._factory.autoPipeline and \
+                method not in _exclusiveMethods:
+            connection = self._factory.getSharedConnection()
+            if connection is not None:
+                d = defer.maybeDeferred(_rawCall, connection, raw, method,
+                                        args, kwargs)
+                d.addCallback(_switch_to_errback)
+                return self._timeout(method, d)
+
+        d = self._factory.getConnection()
+
+        def callback(connection):
+            if method in _exclusiveMethods and connection.pendingReplies:
+                # Shared commands were sent on it while it was idle, their
+                # replies would be taken for those of the transaction.
+                return connection.drained().addCallback(callback)
+            try:
+                d = _rawCall(connection, raw, method, args, kwargs)
+            except:
+                self._factory.connectionQueue.put(connection)
+                raise
+
+            def put_back(reply):
+                if connection.pipelining:
+                    # Pipelines give the connection back when executed.
+                    connection.pipeline_cc = functools.partial(
+                        self._factory.connectionQueue.put, connection)
+                elif not connection.inTransaction:
+                    self._factory.connectionQueue.put(connection)
+                return reply
+
+            d.addBoth(put_back)
+            d.addCallback(_switch_to_errback)
+            return self._timeout(method, d)
+        d.addCallback(callback)
+        return d
+
+    def __getattr__(self, method):
+        return functools.partial(self._call, method, False)
 
     def __repr__(self):
         try:
@@ -1800,6 +2353,7 @@ ShardedMethods = frozenset([
     "hlen",
     "hmget",
     "hmset",
+    "hscan",
     "hset",
     "hvals",
     "incr",
@@ -1820,7 +2374,20 @@ ShardedMethods = frozenset([
     "sismember",
     "smembers",
     "srem",
+    "sscan",
     "ttl",
+    "xack",
+    "xadd",
+    "xautoclaim",
+    "xclaim",
+    "xdel",
+    "xgroup_create",
+    "xgroup_destroy",
+    "xlen",
+    "xpending",
+    "xrange",
+    "xrevrange",
+    "xtrim",
     "zadd",
     "zcard",
     "zcount",
@@ -1836,75 +2403,174 @@ ShardedMethods = frozenset([
     "zremrangebyscore",
     "zremrangebyrank",
     "zrevrange",
+    "zscan",
     "zscore",
 ])
 
-_findhash = re.compile(r'.+\{(.*)\}.*')
+def _hashtag(key):
+    """
+    Returns the part of the key used to pick its shard: the text between
+    the last "{" (not at the start of the key) and the last "}", when the
+    key has one, or the key itself.
+    """
+    end = key.rfind("}")
+    if end > 1:
+        start = key.rfind("{", 1, end)
+        if start > 0:
+            return key[start + 1:end]
+    return key
+
+
+def _jump_hash(key, buckets):
+    """Jump consistent hash, by John Lamping and Eric Veach."""
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
 
 
 class HashRing(object):
-    """Consistent hash for redis API"""
-    def __init__(self, nodes=[], replicas=160):
-        self.nodes = []
+    """
+    Consistent hash for redis API.
+
+    The ring is a sorted tuple of points, and a tuple with the node that
+    owns each point. Both are rebuilt, never changed in place, when nodes
+    are added or removed. Nodes are identified by their factory's uuid,
+    the ``host:port`` or path they connect to.
+
+    Modes:
+
+    - ``crc32`` (default): ``replicas`` CRC32 points per node.
+    - ``ketama``: MD5 points compatible with libketama and other clients
+      that implement it, such as memcached's.
+    - ``jump``: Jump consistent hash. It takes no memory and spreads keys
+      evenly, but only moves the minimum of keys when nodes are appended
+      or removed from the end of the list.
+
+    The nodes of the most recently used keys are kept in an LRU cache of
+    ``cache_size`` items. It defaults to 1024 items in the ketama and jump
+    modes, and is disabled in crc32 mode, where looking up the ring is
+    cheaper than the cache.
+    """
+    modes = ("crc32", "ketama", "jump")
+
+    def __init__(self, nodes=[], replicas=160, mode="crc32",
+                 cache_size=None):
+        if mode not in self.modes:
+            raise ValueError("Invalid mode '%s', must be one of %s" %
+                             (mode, ", ".join(self.modes)))
+        if cache_size is None:
+            cache_size = 0 if mode == "crc32" else 1024
         self.replicas = replicas
-        self.ring = {}
-        self.sorted_keys = []
+        self.mode = mode
+        self._position = getattr(self, "_%sPosition" % mode)
+        self._cache = LRUCache(cache_size) if cache_size else None
+        self._build(list(nodes))
 
-        for n in nodes:
-            self.add_node(n)
+    @staticmethod
+    def _name(node):
+        return node._factory.uuid
+
+    def _build(self, nodes):
+        owners = {}
+        if self.mode == "crc32":
+            for node in nodes:
+                name = self._name(node)
+                for x in xrange(self.replicas):
+                    owners[zlib.crc32("%s:%d" % (name, x))] = node
+        elif self.mode == "ketama":
+            for node in nodes:
+                name = self._name(node)
+                for x in xrange(self.replicas // 4):
+                    digest = hashlib.md5("%s-%d" % (name, x)).digest()
+                    for point in struct.unpack("<4L", digest):
+                        owners[point] = node
+
+        nodes = tuple(nodes)
+        if self.mode == "jump":
+            self._ring = (nodes, (), nodes)
+        else:
+            points = tuple(sorted(owners))
+            self._ring = (nodes, points, tuple(owners[p] for p in points))
+        if self._cache is not None:
+            self._cache.clear()
 
-    def add_node(self, node):
-        self.nodes.append(node)
-        for x in xrange(self.replicas):
-            crckey = zlib.crc32("%s:%d" % (node._factory.uuid, x))
-            self.ring[crckey] = node
-            self.sorted_keys.append(crckey)
+    @property
+    def nodes(self):
+        return list(self._ring[0])
 
-        self.sorted_keys.sort()
+    def add_node(self, node):
+        self._build(self.nodes + [node])
 
     def remove_node(self, node):
-        self.nodes.remove(node)
-        for x in xrange(self.replicas):
-            crckey = zlib.crc32("%s:%d" % (node, x))
-            self.ring.remove(crckey)
-            self.sorted_keys.remove(crckey)
+        nodes = self.nodes
+        nodes.remove(node)
+        self._build(nodes)
 
     def get_node(self, key):
-        n, i = self.get_node_pos(key)
-        return n
-    # self.get_node_pos(key)[0]
+        cache = self._cache
+        if cache is not None:
+            node = cache.get(key)
+            if node is not None:
+                return node
+        owners = self._ring[2]
+        if not owners:
+            return None
+        node = owners[self._position(key)]
+        if cache is not None:
+            cache[key] = node
+        return node
+
+    __call__ = get_node
 
     def get_node_pos(self, key):
-        if len(self.ring) == 0:
+        owners = self._ring[2]
+        if not owners:
             return [None, None]
-        crc = zlib.crc32(key)
-        idx = bisect.bisect(self.sorted_keys, crc)
-        # prevents out of range index
-        idx = min(idx, (self.replicas * len(self.nodes)) - 1)
-        return [self.ring[self.sorted_keys[idx]], idx]
+        idx = self._position(key)
+        return [owners[idx], idx]
+
+    def _crc32Position(self, key):
+        points = self._ring[1]
+        idx = bisect.bisect(points, zlib.crc32(key))
+        # Keys past the last point stay on it, rather than wrapping
+        # around, as they always did.
+        return idx if idx < len(points) else idx - 1
+
+    def _ketamaPosition(self, key):
+        points = self._ring[1]
+        h = struct.unpack("<L", hashlib.md5(key).digest()[:4])[0]
+        idx = bisect.bisect_left(points, h)
+        return idx if idx < len(points) else 0
+
+    def _jumpPosition(self, key):
+        h = struct.unpack("<Q", hashlib.md5(key).digest()[:8])[0]
+        return _jump_hash(h, len(self._ring[0]))
 
     def iter_nodes(self, key):
-        if len(self.ring) == 0:
-            yield None, None
+        nodes, points, owners = self._ring
         node, pos = self.get_node_pos(key)
-        for k in self.sorted_keys[pos:]:
-            yield k, self.ring[k]
-
-    def __call__(self, key):
-        return self.get_node(key)
+        if node is None or not points:
+            yield None, node
+        else:
+            for idx in xrange(pos, len(points)):
+                yield points[idx], owners[idx]
 
 
-class ShardedConnectionHandler(object):
-    def __init__(self, connections):
+class ShardedConnectionHandler(ScanIteratorMixin):
+    def __init__(self, connections, hashMode="crc32"):
+        self._hashMode = hashMode
         if isinstance(connections, defer.DeferredList):
             self._ring = None
             connections.addCallback(self._makeRing)
         else:
-            self._ring = HashRing(connections)
+            self._ring = HashRing(connections, mode=hashMode)
 
     def _makeRing(self, connections):
         connections = map(operator.itemgetter(1), connections)
-        self._ring = HashRing(connections)
+        self._ring = HashRing(connections, mode=self._hashMode)
         return self
 
     @defer.inlineCallbacks
@@ -1916,24 +2582,51 @@ class ShardedConnectionHandler(object):
             yield conn.disconnect()
         defer.returnValue(True)
 
-    def _wrap(self, method, *args, **kwargs):
+    def _node(self, key):
+        return self._ring(_hashtag(key))
+
+    def scan_iter(self, pattern=None, count=None, prefetch=1):
+        """Scans the keys of every shard, one after the other."""
+        if not self._ring:
+            raise ConnectionError("Not connected")
+        return _scanNodes(lambda: defer.succeed(list(self._ring.nodes)),
+                          pattern, count, prefetch)
+
+    def _nodeForCommand(self, method, args):
         try:
             key = args[0]
             assert isinstance(key, (str, unicode))
         except:
             raise ValueError(
                 "Method '%s' requires a key as the first argument" % method)
+        return self._node(key)
 
-        m = _findhash.match(key)
-        if m is not None and len(m.groups()) >= 1:
-            node = self._ring(m.groups()[0])
-        else:
-            node = self._ring(key)
+    def _groupKeys(self, keys):
+        """
+        Returns a list of (node, indexes) with the positions of the keys
+        stored in each node, in the order nodes are first seen.
+        """
+        groups = {}
+        nodes = []
+        for idx, key in enumerate(keys):
+            node = self._node(key)
+            indexes = groups.get(node)
+            if indexes is None:
+                indexes = groups[node] = []
+                nodes.append(node)
+            indexes.append(idx)
+        return [(node, groups[node]) for node in nodes]
 
+    def _wrap(self, method, *args, **kwargs):
+        node = self._nodeForCommand(method, args)
         return getattr(node, method)(*args, **kwargs)
 
     def pipeline(self):
-        raise NotImplementedError("Pipelining is not supported across shards")
+        """
+        Returns a deferred with a `ShardedPipeline`. Commands are buffered
+        until `execute_pipeline` is called.
+        """
+        return defer.succeed(ShardedPipeline(self))
 
     def __getattr__(self, method):
         if method in ShardedMethods:
@@ -1944,28 +2637,43 @@ class ShardedConnectionHandler(object):
     @defer.inlineCallbacks
     def mget(self, keys, *args):
         """
-        high-level mget, required because of the sharding support
+        high-level mget, required because of the sharding support.
+        Values are returned in the order of the keys.
         """
-
         keys = list_or_args("mget", keys, args)
-        group = collections.defaultdict(lambda: [])
-        for k in keys:
-            node = self._ring(k)
-            group[node].append(k)
-
-        deferreds = []
-        for node, keys in group.items():
-            nd = node.mget(keys)
-            deferreds.append(nd)
-
-        result = []
-        response = yield defer.DeferredList(deferreds)
-        for (success, values) in response:
-            if success:
-                result += values
-
+        groups = self._groupKeys(keys)
+        replies = yield _gather([node.mget([keys[idx] for idx in indexes])
+                                 for node, indexes in groups])
+
+        result = [None] * len(keys)
+        for (node, indexes), values in zip(groups, replies):
+            for idx, value in zip(indexes, values):
+                result[idx] = value
         defer.returnValue(result)
 
+    @defer.inlineCallbacks
+    def mset(self, mapping):
+        """
+        high-level mset, one MSET per node. Unlike MSET on a single
+        server, it is not atomic.
+        """
+        keys = list(mapping)
+        yield _gather([node.mset(dict((keys[idx], mapping[keys[idx]])
+                                      for idx in indexes))
+                       for node, indexes in self._groupKeys(keys)])
+        defer.returnValue("OK")
+
+    @defer.inlineCallbacks
+    def delete(self, keys, *args):
+        """
+        high-level delete, returns the number of keys removed from all
+        nodes.
+        """
+        keys = list_or_args("delete", keys, args)
+        replies = yield _gather([node.delete([keys[idx] for idx in indexes])
+                                 for node, indexes in self._groupKeys(keys)])
+        defer.returnValue(sum(replies))
+
     def __repr__(self):
         nodes = []
         for conn in self._ring.nodes:
@@ -1979,27 +2687,735 @@ class ShardedConnectionHandler(object):
         return "<Redis Sharded Connection: %s>" % ", ".join(nodes)
 
 
-class ShardedUnixConnectionHandler(ShardedConnectionHandler):
-    def __repr__(self):
-        nodes = []
-        for conn in self._ring.nodes:
-            try:
-                cli = conn._factory.pool[0].transport.getPeer()
-            except:
-                pass
-            else:
+class ShardedPipeline(object):
+    """
+    Buffers the commands of a pipeline on sharded connections. Once
+    executed, the commands of each node are sent as one pipeline, all
+    nodes in parallel, and the replies are returned in the order the
+    commands were issued.
+    """
+    def __init__(self, handler):
+        self._handler = handler
+        self._commands = []
+
+    def __getattr__(self, method):
+        if method not in ShardedMethods:
+            raise NotImplementedError("Method '%s' cannot be sharded" % method)
+
+        def wrapper(*args, **kwargs):
+            node = self._handler._nodeForCommand(method, args)
+            d = defer.Deferred()
+            self._commands.append((node, method, args, kwargs, d))
+            return d
+        return wrapper
+
+    def _fail(self, commands):
+        # execute_pipeline() fails too, so the errors nobody handles on
+        # the deferreds of the commands are not logged.
+        failure = Failure()
+        for command in commands:
+            command[-1].addErrback(lambda f: None)
+            command[-1].errback(failure)
+
+    @defer.inlineCallbacks
+    def _executeNode(self, node, commands):
+        pipe = yield node.pipeline()
+        for _, method, args, kwargs, _ in commands:
+            getattr(pipe, method)(*args, **kwargs)
+        replies = yield pipe.execute_pipeline()
+        defer.returnValue(replies)
+
+    @defer.inlineCallbacks
+    def execute_pipeline(self):
+        commands = self._commands
+        self._commands = []
+        groups = {}
+        nodes = []
+        for idx, command in enumerate(commands):
+            node = command[0]
+            if node not in groups:
+                groups[node] = []
+                nodes.append(node)
+            groups[node].append(idx)
+
+        try:
+            replies = yield _gather([
+                self._executeNode(node, [commands[idx]
+                                         for idx in groups[node]])
+                for node in nodes])
+        except Exception:
+            self._fail(commands)
+            raise
+
+        result = [None] * len(commands)
+        for node, values in zip(nodes, replies):
+            for idx, value in zip(groups[node], values):
+                result[idx] = value
+        for command, value in zip(commands, result):
+            command[-1].callback(value)
+        defer.returnValue(result)
+
+
+def _gather(deferreds):
+    """
+    Like gatherResults, but fails with the error of the first deferred
+    that failed, rather than with a FirstError.
+    """
+    d = defer.gatherResults(deferreds, consumeErrors=True)
+    d.addErrback(lambda f: f.value.subFailure if f.check(defer.FirstError)
+                 else f)
+    return d
+
+
+class ShardedUnixConnectionHandler(ShardedConnectionHandler):
+    def __repr__(self):
+        nodes = []
+        for conn in self._ring.nodes:
+            try:
+                cli = conn._factory.pool[0].transport.getPeer()
+            except:
+                pass
+            else:
                 nodes.append("%s/%d" %
                              (cli.name, conn._factory.size))
         return "<Redis Sharded Connection: %s>" % ", ".join(nodes)
 
 
+CLUSTER_SLOTS = 16384
+
+
+def _keyslot(key, charset="utf-8"):
+    """
+    Returns the hash slot of a key in redis cluster: CRC16 of the key, or
+    of the text between its first "{" and the next "}" when not empty.
+    """
+    if isinstance(key, unicode):
+        key = key.encode(charset)
+    start = key.find("{")
+    if start != -1:
+        end = key.find("}", start + 1)
+        if end > start + 1:
+            key = key[start + 1:end]
+    return binascii.crc_hqx(key, 0) % CLUSTER_SLOTS
+
+
+def _redirection(error):
+    """
+    Returns (kind, slot, address) for MOVED and ASK errors, or None.
+    """
+    if isinstance(error, ResponseError) and error.args:
+        parts = error.args[0].split()
+        if len(parts) == 3 and parts[0] in ("MOVED", "ASK"):
+            return parts[0], int(parts[1]), parts[2]
+
+
+class ClusterConnectionHandler(ScanIteratorMixin):
+    """
+    Sends commands to the node of a redis cluster that serves the hash
+    slot of their key, with a pool of connections per node.
+
+    The slot map is fetched with CLUSTER SLOTS. MOVED redirections update
+    the slot and refresh the whole map in background, ASK redirections
+    send the command once to the other node, after ASKING.
+    """
+    maxRedirections = 5
+    # Seconds to wait for a node to send the slot map, before asking the
+    # next one.
+    slotsTimeout = 2
+
+    def __init__(self, nodes, poolsize, reconnect, charset, password,
+                 connectTimeout, replyTimeout, convertNumbers, autoPipeline):
+        self._charset = charset
+        self._options = (poolsize, reconnect, True, charset, password,
+                         connectTimeout, replyTimeout, convertNumbers,
+                         autoPipeline)
+        self._startup = list(nodes)
+        self._nodes = {}
+        self._slots = [None] * CLUSTER_SLOTS
+        self._refreshing = []
+        for address in nodes:
+            self._node(address)
+
+    def _node(self, address):
+        node = self._nodes.get(address)
+        if node is None:
+            host, port = address.rsplit(":", 1)
+            node = makeConnection(host, int(port), None, *self._options)
+            self._nodes[address] = node
+        return node
+
+    def refreshSlots(self):
+        """
+        Fetches the slot map from the first node that answers. Returns a
+        deferred fired with the handler. Only one request is sent at a
+        time, concurrent calls wait for it.
+        """
+        d = defer.Deferred()
+        self._refreshing.append(d)
+        if len(self._refreshing) == 1:
+            self._fetchSlots().addBoth(self._slotsFetched)
+        return d
+
+    def _slotsFetched(self, result):
+        deferreds, self._refreshing = self._refreshing, []
+        for d in deferreds:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(self)
+
+    @defer.inlineCallbacks
+    def _fetchSlots(self):
+        addresses = self._startup + \
+            [a for a in self._nodes if a not in self._startup]
+        errors = []
+        for address in addresses:
+            node = self._node(address)
+            try:
+                reply = yield _deadline(
+                    node.execute_command("CLUSTER", "SLOTS"),
+                    self.slotsTimeout, node._factory.clock)
+            except Exception, e:
+                errors.append("%s: %s" % (address, e))
+                continue
+
+            slots = [None] * CLUSTER_SLOTS
+            for item in reply:
+                start, end, master = item[0], item[1], item[2]
+                host = master[0] or address.rsplit(":", 1)[0]
+                node = self._node("%s:%s" % (host, master[1]))
+                slots[start:end + 1] = [node] * (end - start + 1)
+            self._slots = slots
+            defer.returnValue(self)
+
+        raise ClusterError("Could not fetch the slot map: %s" %
+                           "; ".join(errors))
+
+    def _nodeForSlot(self, slot):
+        node = self._slots[slot]
+        if node is not None:
+            return defer.succeed(node)
+
+        def refreshed(ign):
+            if self._slots[slot] is None:
+                raise ClusterError("No node serves slot %d" % slot)
+            return self._slots[slot]
+        return self.refreshSlots().addCallback(refreshed)
+
+    def _masters(self):
+        if None in self._slots:
+            d = self.refreshSlots()
+        else:
+            d = defer.succeed(self)
+
+        def masters(ign):
+            nodes = []
+            for node in self._slots:
+                if node is not None and node not in nodes:
+                    nodes.append(node)
+            return nodes
+        return d.addCallback(masters)
+
+    def scan_iter(self, pattern=None, count=None, prefetch=1):
+        """Scans the keys of every master, one after the other."""
+        return _scanNodes(self._masters, pattern, count, prefetch)
+
+    def _nodeForCommand(self, method, args):
+        # Pipelines resolve the slot to its node when executed.
+        return self._slot(method, args)
+
+    def _slot(self, method, args):
+        try:
+            key = args[0]
+            if isinstance(key, (list, tuple)):
+                key = key[0]
+            elif isinstance(key, dict):
+                key = iter(key).next()
+            assert isinstance(key, (str, unicode))
+        except:
+            raise ValueError(
+                "Method '%s' requires a key as the first argument" % method)
+        return _keyslot(key, self._charset)
+
+    @defer.inlineCallbacks
+    def _execute(self, slot, method, args, kwargs, redirection=None):
+        node = yield self._nodeForSlot(slot)
+        for x in xrange(self.maxRedirections + 1):
+            asking = False
+            if redirection is not None:
+                kind, ign, address = redirection
+                if address.startswith(":"):
+                    address = node._factory.uuid.rsplit(":", 1)[0] + address
+                node = self._node(address)
+                if kind == "MOVED":
+                    self._slots[slot] = node
+                    self.refreshSlots().addErrback(log.err)
+                else:
+                    asking = True
+
+            try:
+                if asking:
+                    result = yield self._asking(node, method, args, kwargs)
+                else:
+                    result = yield getattr(node, method)(*args, **kwargs)
+            except ResponseError, e:
+                redirection = _redirection(e)
+                if redirection is None:
+                    raise
+            else:
+                defer.returnValue(result)
+
+        raise ClusterError("Too many redirections for slot %d" % slot)
+
+    @defer.inlineCallbacks
+    def _asking(self, node, method, args, kwargs):
+        # ASKING only applies to the next command on the same connection.
+        pipe = yield node.pipeline()
+        pipe.execute_command("ASKING")
+        getattr(pipe, method)(*args, **kwargs)
+        try:
+            replies = yield pipe.execute_pipeline()
+        except defer.FirstError, e:
+            e.subFailure.raiseException()
+        defer.returnValue(replies[1])
+
+    def _groupSlots(self, keys):
+        groups = {}
+        slots = []
+        for idx, key in enumerate(keys):
+            slot = _keyslot(key, self._charset)
+            if slot not in groups:
+                groups[slot] = []
+                slots.append(slot)
+            groups[slot].append(idx)
+        return [(slot, groups[slot]) for slot in slots]
+
+    @defer.inlineCallbacks
+    def mget(self, keys, *args):
+        """
+        mget across hash slots, values are returned in the order of the
+        keys.
+        """
+        keys = list_or_args("mget", keys, args)
+        groups = self._groupSlots(keys)
+        replies = yield _gather([
+            self._execute(slot, "mget", ([keys[idx] for idx in indexes],), {})
+            for slot, indexes in groups])
+
+        result = [None] * len(keys)
+        for (slot, indexes), values in zip(groups, replies):
+            for idx, value in zip(indexes, values):
+                result[idx] = value
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def mset(self, mapping):
+        """
+        mset across hash slots, one MSET per slot. It is not atomic.
+        """
+        keys = list(mapping)
+        yield _gather([
+            self._execute(slot, "mset",
+                          (dict((keys[idx], mapping[keys[idx]])
+                                for idx in indexes),), {})
+            for slot, indexes in self._groupSlots(keys)])
+        defer.returnValue("OK")
+
+    @defer.inlineCallbacks
+    def delete(self, keys, *args):
+        """
+        delete across hash slots, returns the number of keys removed.
+        """
+        keys = list_or_args("delete", keys, args)
+        replies = yield _gather([
+            self._execute(slot, "delete", ([keys[idx] for idx in indexes],),
+                          {})
+            for slot, indexes in self._groupSlots(keys)])
+        defer.returnValue(sum(replies))
+
+    def pipeline(self):
+        """
+        Returns a deferred with a `ClusterPipeline`, that sends one
+        pipeline to each node when executed.
+        """
+        return defer.succeed(ClusterPipeline(self))
+
+    @defer.inlineCallbacks
+    def disconnect(self):
+        for node in self._nodes.values():
+            yield node.disconnect()
+        defer.returnValue(True)
+
+    def __getattr__(self, method):
+        if method in ShardedMethods:
+            def wrapper(*args, **kwargs):
+                return self._execute(self._slot(method, args), method,
+                                     args, kwargs)
+            return wrapper
+        raise NotImplementedError("Method '%s' cannot be sent to a "
+                                  "cluster" % method)
+
+    def __repr__(self):
+        return "<Redis Cluster Connection: %d node(s)>" % len(self._nodes)
+
+
+class ClusterPipeline(ShardedPipeline):
+    """
+    Pipeline on a redis cluster. Commands redirected with MOVED or ASK
+    are sent again, one by one, to the node they were redirected to.
+    """
+    @defer.inlineCallbacks
+    def execute_pipeline(self):
+        try:
+            commands = []
+            for slot, method, args, kwargs, d in self._commands:
+                node = yield self._handler._nodeForSlot(slot)
+                commands.append((node, method, args, kwargs, d))
+        except Exception:
+            self._fail(self._commands)
+            self._commands = []
+            raise
+
+        self._commands = commands
+        result = yield ShardedPipeline.execute_pipeline(self)
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def _executeNode(self, node, commands):
+        pipe = yield node.pipeline()
+        # Collect every reply before execute_pipeline gives up on the
+        # first error, so that only redirected commands are sent again.
+        replies = defer.DeferredList(
+            [getattr(pipe, method)(*args, **kwargs)
+             for _, method, args, kwargs, _ in commands],
+            consumeErrors=True)
+        yield pipe.execute_pipeline()
+        results = yield replies
+
+        values = []
+        for (success, value), command in zip(results, commands):
+            if not success:
+                redirection = _redirection(value.value)
+                if redirection is None:
+                    value.raiseException()
+                _, method, args, kwargs, _ = command
+                slot = self._handler._slot(method, args)
+                value = yield self._handler._execute(slot, method, args,
+                                                     kwargs, redirection)
+            values.append(value)
+        defer.returnValue(values)
+
+
+# Commands sent to the replicas by sentinel connections, when reading from
+# replicas.
+_readOnlyMethods = frozenset([
+    "bitcount",
+    "dbsize",
+    "exists",
+    "get",
+    "getbit",
+    "hexists",
+    "hget",
+    "hgetall",
+    "hkeys",
+    "hlen",
+    "hmget",
+    "hscan",
+    "hvals",
+    "keys",
+    "lindex",
+    "llen",
+    "lrange",
+    "mget",
+    "pfcount",
+    "randomkey",
+    "scan",
+    "scard",
+    "sdiff",
+    "sinter",
+    "sismember",
+    "smembers",
+    "srandmember",
+    "sscan",
+    "substr",
+    "sunion",
+    "ttl",
+    "type",
+    "xlen",
+    "xrange",
+    "xrevrange",
+    "zcard",
+    "zcount",
+    "zrange",
+    "zrangebyscore",
+    "zrank",
+    "zrevrange",
+    "zrevrangebyscore",
+    "zrevrank",
+    "zscan",
+    "zscore",
+])
+
+
+class SentinelConnectionHandler(ScanIteratorMixin):
+    """
+    Sends commands to the master of a service monitored by redis
+    sentinels, with a pool of connections.
+
+    The address of the master is asked to the sentinels, and their
+    +switch-master events are followed: a new pool is made for the new
+    master right away, and the old one is drained. Callers still waiting
+    for a connection of the old pool, and commands refused with READONLY
+    by a master turned replica, are sent again to the new master.
+
+    With ``readFromReplicas``, read-only commands are sent in turns to the
+    replicas known to the sentinels, or to the master when there are none.
+    """
+    watchedEvents = ("+switch-master", "+slave", "+sdown", "-sdown")
+    # Seconds to wait for a sentinel to answer, before asking the next one.
+    sentinelTimeout = 2
+
+    def __init__(self, sentinels, service, dbid, poolsize, reconnect,
+                 charset, password, connectTimeout, replyTimeout,
+                 convertNumbers, autoPipeline, readFromReplicas=False):
+        self.service = service
+        self.readFromReplicas = readFromReplicas
+        self.master = None
+        self._addresses = list(sentinels)
+        self._charset = charset
+        self._connectTimeout = connectTimeout
+        self._options = (dbid, poolsize, reconnect, True, charset, password,
+                         connectTimeout, replyTimeout, convertNumbers,
+                         autoPipeline)
+        self._sentinels = {}
+        self._watchers = []
+        self._master = None
+        self._replicas = {}
+        self._idx = 0
+        self._discovering = []
+
+    def _pool(self, address):
+        host, port = address.rsplit(":", 1)
+        return makeConnection(host, int(port), *self._options)
+
+    def _sentinel(self, address):
+        conn = self._sentinels.get(address)
+        if conn is None:
+            host, port = address.rsplit(":", 1)
+            conn = makeConnection(host, int(port), None, 1, True, True,
+                                  self._charset, None, self._connectTimeout,
+                                  None, False, False,
+                                  acquireTimeout=self.sentinelTimeout,
+                                  commandTimeout=self.sentinelTimeout)
+            self._sentinels[address] = conn
+        return conn
+
+    def watch(self):
+        """
+        Subscribes to the events of every sentinel.
+        """
+        for address in self._addresses:
+            host, port = address.rsplit(":", 1)
+            factory = SentinelWatcherFactory(self)
+            reactor.connectTCP(host, int(port), factory, self._connectTimeout)
+            self._watchers.append(factory)
+
+    def discoverMaster(self):
+        """
+        Asks the sentinels for the address of the master, and of its
+        replicas when reading from them. Returns a deferred fired with the
+        handler. Only one request is sent at a time, concurrent calls wait
+        for it.
+        """
+        d = defer.Deferred()
+        self._discovering.append(d)
+        if len(self._discovering) == 1:
+            self._askSentinels().addBoth(self._discovered)
+        return d
+
+    def _discovered(self, result):
+        deferreds, self._discovering = self._discovering, []
+        for d in deferreds:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(self)
+
+    @defer.inlineCallbacks
+    def _askSentinels(self):
+        errors = []
+        for address in self._addresses:
+            try:
+                reply = yield self._sentinel(address).execute_command(
+                    "SENTINEL", "get-master-addr-by-name", self.service)
+            except Exception, e:
+                errors.append("%s: %s" % (address, e))
+                continue
+            if not reply:
+                errors.append("%s: unknown service" % address)
+                continue
+
+            self._switchMaster("%s:%s" % tuple(reply))
+            if self.readFromReplicas:
+                try:
+                    yield self._refreshReplicas(address)
+                except Exception, e:
+                    log.msg("Redis sentinel %s could not list the replicas "
+                            "of %s: %s" % (address, self.service, e))
+            defer.returnValue(self)
+
+        raise SentinelError("Could not find the master of %s: %s" %
+                            (self.service, "; ".join(errors)))
+
+    @defer.inlineCallbacks
+    def _refreshReplicas(self, sentinel):
+        reply = yield self._sentinel(sentinel).execute_command(
+            "SENTINEL", "slaves", self.service)
+        addresses = []
+        for item in reply:
+            info = dict(zip(item[::2], item[1::2]))
+            flags = info.get("flags", "").split(",")
+            if not set(flags) & set(["s_down", "o_down", "disconnected"]):
+                addresses.append("%s:%s" % (info["ip"], info["port"]))
+
+        for address in list(self._replicas):
+            if address not in addresses:
+                self._retire(self._replicas.pop(address))
+        for address in addresses:
+            if address not in self._replicas and address != self.master:
+                self._replicas[address] = self._pool(address)
+
+    def _switchMaster(self, address):
+        if address == self.master:
+            return
+        log.msg("Redis sentinel: the master of %s is %s" %
+                (self.service, address))
+        previous = self._master
+        self.master = address
+        self._master = self._replicas.pop(address, None) or \
+            self._pool(address)
+        if previous is not None:
+            self._retire(previous)
+
+    def _retire(self, handler):
+        handler._factory.drain()
+
+    def eventReceived(self, event, message):
+        parts = message.split()
+        if event == "+switch-master":
+            if len(parts) == 5 and parts[0] == self.service:
+                self._switchMaster("%s:%s" % (parts[3], parts[4]))
+                if self.readFromReplicas:
+                    self.discoverMaster().addErrback(log.err)
+        elif self.readFromReplicas and "@" in parts[:-1] and \
+                parts[parts.index("@") + 1] == self.service:
+            # A replica was added, went down or came back.
+            self.discoverMaster().addErrback(log.err)
+
+    def _handler(self, method):
+        if self.readFromReplicas and method in _readOnlyMethods and \
+                self._replicas:
+            replicas = self._replicas.values()
+            self._idx = (self._idx + 1) % len(replicas)
+            return defer.succeed(replicas[self._idx])
+        if self._master is None:
+            return self.discoverMaster().addCallback(
+                lambda ign: self._master)
+        return defer.succeed(self._master)
+
+    @defer.inlineCallbacks
+    def _execute(self, method, *args, **kwargs):
+        for retry in (False, True):
+            handler = yield self._handler(method)
+            try:
+                result = yield getattr(handler, method)(*args, **kwargs)
+            except defer.CancelledError:
+                # Cancelled by the drain of a retired pool, it was not
+                # sent.
+                if retry or handler is self._master or \
+                        handler in self._replicas.values():
+                    raise
+            except ResponseError, e:
+                if retry or not str(e).startswith("READONLY"):
+                    raise
+                yield self.discoverMaster()
+            else:
+                defer.returnValue(result)
+
+    def register_script(self, script):
+        """
+        Returns a Script, to run ``script`` on the master.
+        """
+        return Script(self, script)
+
+    @defer.inlineCallbacks
+    def disconnect(self):
+        for factory in self._watchers:
+            yield factory.handler.disconnect()
+        handlers = self._replicas.values() + self._sentinels.values()
+        if self._master is not None:
+            handlers.append(self._master)
+        for handler in handlers:
+            yield handler.disconnect()
+        defer.returnValue(True)
+
+    def __getattr__(self, method):
+        return functools.partial(self._execute, method)
+
+    def __repr__(self):
+        return "<Redis Sentinel Connection: %s at %s, %d replica(s)>" % (
+            self.service, self.master, len(self._replicas))
+
+
+class _ConnectionQueue(defer.DeferredQueue):
+    """
+    The idle connections of a pool, which remember since when they are idle.
+    """
+    def __init__(self, factory):
+        defer.DeferredQueue.__init__(self)
+        self.factory = factory
+
+    def put(self, conn):
+        if self.factory.draining:
+            conn.transport.loseConnection()
+            return
+        conn.idleSince = self.factory.clock.seconds()
+        defer.DeferredQueue.put(self, conn)
+
+
+def _cancelCall(result, call):
+    if call.active():
+        call.cancel()
+    return result
+
+
 class RedisFactory(protocol.ReconnectingClientFactory):
+    """
+    Keeps the pool of connections to one redis server.
+
+    The pool opens ``poolsize`` connections, and more on demand, up to
+    ``maxsize``, when all of them are busy. Connections idle for longer
+    than ``idleTimeout`` seconds are closed, down to ``minsize``, and
+    the ones idle for ``pingInterval`` seconds are checked with PING, and
+    closed if they do not answer. Callers waiting for a connection for
+    longer than ``acquireTimeout`` seconds fail with PoolTimeoutError.
+
+    Blocking commands go to ``blocking``, a second pool made by
+    makeBlockingPool, which keeps its idle connections for
+    ``blockingIdleTimeout`` seconds.
+    """
     maxDelay = 10
     protocol = RedisProtocol
+    clock = reactor
+    blockingIdleTimeout = 60
+    # Upper bounds, in seconds, of the buckets of the wait-time histogram.
+    waitBuckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
 
     def __init__(self, uuid, dbid, poolsize, isLazy=False,
                  handler=ConnectionHandler, charset="utf-8", password=None,
-                 replyTimeout=None, convertNumbers=True):
+                 replyTimeout=None, convertNumbers=True, autoPipeline=False,
+                 minsize=None, maxsize=None, idleTimeout=None,
+                 pingInterval=None, acquireTimeout=None, commandTimeout=None):
         if not isinstance(poolsize, int):
             raise ValueError("Redis poolsize must be an integer, not %s" %
                              repr(poolsize))
@@ -2016,14 +3432,32 @@ class RedisFactory(protocol.ReconnectingClientFactory):
         self.password = password
         self.replyTimeout = replyTimeout
         self.convertNumbers = convertNumbers
+        self.autoPipeline = autoPipeline
+        self.minsize = poolsize if minsize is None else minsize
+        self.maxsize = poolsize if maxsize is None else max(maxsize, poolsize)
+        self.idleTimeout = idleTimeout
+        self.pingInterval = pingInterval
+        self.acquireTimeout = acquireTimeout
+        self.commandTimeout = commandTimeout
+        # Opens one more connection, set by makeConnection.
+        self.connect = None
+        # The pool of connections for blocking commands, set by
+        # makeConnection.
+        self.blocking = None
 
         self.idx = 0
         self.size = 0
         self.pool = []
         self.deferred = defer.Deferred()
         self.handler = handler(self)
-        self.connectionQueue = defer.DeferredQueue()
+        self.connectionQueue = _ConnectionQueue(self)
+        self.waitTimes = [0] * (len(self.waitBuckets) + 1)
         self._waitingForEmptyPool = set()
+        self._growing = set()
+        self._evicting = set()
+        self._evictedConnectors = set()
+        self._maintenance = None
+        self.draining = False
 
     def buildProtocol(self, addr):
         if hasattr(self, 'charset'):
@@ -2035,6 +3469,7 @@ class RedisFactory(protocol.ReconnectingClientFactory):
         return p
 
     def addConnection(self, conn):
+        self._growing.discard(getattr(conn.transport, "connector", None))
         self.connectionQueue.put(conn)
         self.pool.append(conn)
         self.size = len(self.pool)
@@ -2043,13 +3478,24 @@ class RedisFactory(protocol.ReconnectingClientFactory):
                 self.deferred.callback(self.handler)
                 self.deferred = None
 
+        if self._maintenance is None and \
+                (self.idleTimeout or self.pingInterval):
+            self._maintenance = task.LoopingCall(self.maintain)
+            self._maintenance.clock = self.clock
+            self._maintenance.start(
+                min(filter(None, (self.idleTimeout, self.pingInterval))),
+                now=False)
+
     def delConnection(self, conn):
         try:
             self.pool.remove(conn)
         except Exception, e:
             log.msg("Could not remove connection from pool: %s" % str(e))
 
+        self._evicting.discard(conn)
         self.size = len(self.pool)
+        if not self.size and not self.continueTrying:
+            self.stopMaintenance()
         if not self.size and self._waitingForEmptyPool:
             deferreds = self._waitingForEmptyPool
             self._waitingForEmptyPool = set()
@@ -2075,16 +3521,164 @@ class RedisFactory(protocol.ReconnectingClientFactory):
             self.deferred.errback(ValueError(why))
             self.deferred = None
 
+    def clientConnectionLost(self, connector, reason):
+        if connector in self._evictedConnectors:
+            # Closed by the pool on purpose, do not reconnect.
+            self._evictedConnectors.discard(connector)
+            return
+        protocol.ReconnectingClientFactory.clientConnectionLost(
+            self, connector, reason)
+
+    def drain(self):
+        """
+        Closes the pool: stops reconnecting, cancels the callers waiting
+        for a connection, and closes each connection once it is idle.
+        """
+        self.continueTrying = 0
+        self.draining = True
+        self.stopMaintenance()
+        if self.blocking is not None:
+            self.blocking.drain()
+        for d in list(self.connectionQueue.waiting):
+            d.cancel()
+        for conn in list(self.connectionQueue.pending):
+            self.connectionQueue.pending.remove(conn)
+            conn.transport.loseConnection()
+
+    def makeBlockingPool(self):
+        """
+        Returns an empty pool with the settings of this one, for blocking
+        commands. It has no upper bound, and connections are opened as
+        callers need them.
+        """
+        pool = RedisFactory(self.uuid, self.dbid, 0, True, ConnectionHandler,
+                            self.charset, self.password, None,
+                            self.convertNumbers, False, 0, sys.maxint,
+                            self.blockingIdleTimeout)
+        pool.clock = self.clock
+        pool.continueTrying = 1
+        # Nobody waits for this pool to fill up.
+        pool.deferred = None
+        return pool
+
+    def stopMaintenance(self):
+        if self._maintenance is not None:
+            if self._maintenance.running:
+                self._maintenance.stop()
+            self._maintenance = None
+
+    def maintain(self):
+        """
+        Closes the connections idle for longer than ``idleTimeout``, down
+        to ``minsize``, and checks the ones idle for ``pingInterval``.
+        """
+        now = self.clock.seconds()
+        for conn in list(self.connectionQueue.pending):
+            idle = now - conn.idleSince
+            if not conn.connected:
+                self.connectionQueue.pending.remove(conn)
+            elif self.idleTimeout is not None and \
+                    idle >= self.idleTimeout and \
+                    self.size - len(self._evicting) > self.minsize:
+                self.connectionQueue.pending.remove(conn)
+                self._evict(conn)
+            elif self.pingInterval is not None and idle >= self.pingInterval:
+                self.connectionQueue.pending.remove(conn)
+                self._ping(conn)
+
+    def _evict(self, conn):
+        self._evicting.add(conn)
+        connector = getattr(conn.transport, "connector", None)
+        if connector is not None:
+            self._evictedConnectors.add(connector)
+        conn.transport.loseConnection()
+
+    def _ping(self, conn):
+        def pong(reply):
+            if isinstance(reply, (Failure, Exception)):
+                log.msg("Redis connection failed its health check: %s" %
+                        (reply,))
+                conn.transport.loseConnection()
+            elif conn.connected:
+                self.connectionQueue.put(conn)
+
+        d = defer.maybeDeferred(conn.execute_command, "PING")
+        _deadline(d, self.commandTimeout or self.pingInterval,
+                  self.clock).addBoth(pong)
+
+    def _grow(self):
+        if self.connect is None or self.connectionQueue.pending or \
+                not self.continueTrying or \
+                self.size + len(self._growing) >= self.maxsize:
+            return
+        self._growing.add(self.connect())
+
+    def _recordWait(self, elapsed):
+        self.waitTimes[bisect.bisect_left(self.waitBuckets, elapsed)] += 1
+
+    def stats(self):
+        """
+        Returns the number of connections in the pool, in use and idle, of
+        callers waiting for a connection, and a histogram of how long
+        callers waited, as a list of (upper bound in seconds, count) where
+        the last bound is None. ``blocking`` is the number of connections
+        of the blocking pool.
+        """
+        idle = len([conn for conn in self.connectionQueue.pending
+                    if conn.connected])
+        return {
+            "size": self.size,
+            "in_use": self.size - idle,
+            "idle": idle,
+            "waiters": len(self.connectionQueue.waiting),
+            "connecting": len(self._growing),
+            "blocking": self.blocking.size if self.blocking else 0,
+            "wait_histogram": zip(self.waitBuckets + (None,),
+                                  self.waitTimes),
+        }
+
+    def getSharedConnection(self):
+        """
+        Returns one of the idle connections, in turns, without taking it
+        out of the pool. Returns None if there are no idle connections.
+        Connections in a transaction or a pipeline are never shared.
+        """
+        idle = self.connectionQueue.pending
+        for x in xrange(len(idle)):
+            self.idx = (self.idx + 1) % len(idle)
+            conn = idle[self.idx]
+            if conn.connected and not conn.inTransaction and \
+                    not conn.pipelining:
+                return conn
+
     @defer.inlineCallbacks
     def getConnection(self, put_back=False):
         if not self.continueTrying and not self.size:
             raise ConnectionError("Not connected")
 
+        started = self.clock.seconds()
         while True:
-            conn = yield self.connectionQueue.get()
+            self._grow()
+            d = self.connectionQueue.get()
+            if self.acquireTimeout is not None and not d.called:
+                remaining = started + self.acquireTimeout - \
+                    self.clock.seconds()
+                d.addBoth(_cancelCall,
+                          self.clock.callLater(max(remaining, 0), d.cancel))
+            try:
+                conn = yield d
+            except defer.CancelledError:
+                if self.acquireTimeout is None or \
+                        self.clock.seconds() - started < self.acquireTimeout:
+                    raise
+                raise PoolTimeoutError(
+                    "No redis connection available after %s seconds" %
+                    self.acquireTimeout)
+
             if conn.connected == 0:
                 log.msg('Discarding dead connection.')
             else:
+                self._recordWait(self.clock.seconds() - started)
                 if put_back:
                     self.connectionQueue.put(conn)
                 defer.returnValue(conn)
@@ -2106,15 +3700,712 @@ class MonitorFactory(RedisFactory):
                               handler=handler)
 
 
+class PubSubBridgeProtocol(SubscriberProtocol):
+    def messageReceived(self, pattern, channel, message):
+        self.factory.bridge.messageReceived(channel, message, pattern)
+
+
+class PubSubBridgeFactory(SubscriberFactory):
+    protocol = PubSubBridgeProtocol
+
+    def __init__(self, bridge, password=None, shard=0):
+        SubscriberFactory.__init__(self, isLazy=True)
+        self.bridge = bridge
+        self.password = password
+        self.shard = shard
+        # Messages are forwarded to clients as they are published.
+        self.convertNumbers = False
+
+    def addConnection(self, conn):
+        SubscriberFactory.addConnection(self, conn)
+        self.bridge.connectionMade(conn, self.shard)
+
+    def delConnection(self, conn):
+        SubscriberFactory.delConnection(self, conn)
+        self.bridge.connectionLost(conn, self.shard)
+
+
+class PubSubBridge(object):
+    """
+    Delivers redis pub/sub messages to local subscribers, such as
+    WebSocket and SSE handlers, over one or more subscriber connections.
+
+    Channels are subscribed on redis when their first local subscriber
+    shows up, and unsubscribed when the last one goes away. All channels
+    are subscribed again after a reconnection. Glob-style patterns work
+    the same way with ``psubscribe`` and ``punsubscribe``.
+
+    Messages are routed with a dict lookup on their channel, or on the
+    pattern they matched, which redis sends along with the message.
+
+    With ``connections`` greater than 1, channels and patterns are spread
+    over that many subscriber connections by the CRC32 of their name, so
+    that a busy channel does not hold back the messages of the others.
+
+    A subscriber is either an ``SSEHandler`` (messages are sent with
+    ``sendEvent``), a ``WebSocketHandler`` (``sendMessage``), or a callable
+    taking ``(channel, message)``. Messages are published with the
+    ``publish`` command of a regular connection::
+
+        bridge = cyclone.redis.lazyPubSubBridge()
+
+        class ChatHandler(cyclone.websocket.WebSocketHandler):
+            def connectionMade(self):
+                bridge.subscribe("chat", self)
+
+            def connectionLost(self, reason):
+                bridge.unsubscribeAll(self)
+    """
+    def __init__(self, password=None, connections=1):
+        self.factories = [PubSubBridgeFactory(self, password, shard)
+                          for shard in xrange(connections)]
+        self.connections = [None] * connections
+        self.subscribers = {}
+        self.patterns = {}
+
+    @property
+    def factory(self):
+        return self.factories[0]
+
+    @property
+    def connection(self):
+        return self.connections[0]
+
+    def _shard(self, name):
+        if len(self.connections) == 1:
+            return 0
+        if isinstance(name, unicode):
+            name = name.encode("utf-8")
+        return (zlib.crc32(name) & 0xffffffff) % len(self.connections)
+
+    def connectionMade(self, conn, shard=0):
+        self.connections[shard] = conn
+        for channel in self.subscribers:
+            if self._shard(channel) == shard:
+                self._send("subscribe", channel)
+        for pattern in self.patterns:
+            if self._shard(pattern) == shard:
+                self._send("psubscribe", pattern)
+
+    def connectionLost(self, conn, shard=0):
+        if self.connections[shard] is conn:
+            self.connections[shard] = None
+
+    def _send(self, command, channel):
+        conn = self.connections[self._shard(channel)]
+        if conn is None:
+            # Pending subscriptions are sent once connected.
+            return defer.succeed(None)
+        # One channel per command: each channel gets its own reply.
+        d = getattr(conn, command)(channel)
+        d.addErrback(self._commandFailed, command, channel)
+        return d
+
+    def _commandFailed(self, failure, command, channel):
+        log.msg("Redis error: could not %s to %s: %s" %
+                (command, channel, failure.getErrorMessage()))
+
+    def _add(self, table, command, name, subscriber):
+        subscribers = table.get(name)
+        if subscribers is None:
+            subscribers = table[name] = set()
+            subscribers.add(subscriber)
+            return self._send(command, name)
+        subscribers.add(subscriber)
+        return defer.succeed(None)
+
+    def _remove(self, table, command, name, subscriber):
+        subscribers = table.get(name)
+        if subscribers is None or subscriber not in subscribers:
+            return defer.succeed(None)
+        subscribers.discard(subscriber)
+        if subscribers:
+            return defer.succeed(None)
+        del table[name]
+        return self._send(command, name)
+
+    def subscribe(self, channel, subscriber):
+        """
+        Delivers the messages published on ``channel`` to ``subscriber``.
+        """
+        return self._add(self.subscribers, "subscribe", channel, subscriber)
+
+    def unsubscribe(self, channel, subscriber):
+        """
+        Stops delivering the messages of ``channel`` to ``subscriber``.
+        """
+        return self._remove(self.subscribers, "unsubscribe", channel,
+                            subscriber)
+
+    def psubscribe(self, pattern, subscriber):
+        """
+        Delivers the messages published on any channel matching the
+        glob-style ``pattern`` to ``subscriber``.
+        """
+        return self._add(self.patterns, "psubscribe", pattern, subscriber)
+
+    def punsubscribe(self, pattern, subscriber):
+        """
+        Stops delivering the messages matching ``pattern`` to
+        ``subscriber``.
+        """
+        return self._remove(self.patterns, "punsubscribe", pattern,
+                            subscriber)
+
+    def unsubscribeAll(self, subscriber):
+        """
+        Removes ``subscriber`` from all of its channels and patterns,
+        typically when the client disconnects.
+        """
+        channels = [channel for channel, subscribers in
+                    self.subscribers.iteritems() if subscriber in subscribers]
+        patterns = [pattern for pattern, subscribers in
+                    self.patterns.iteritems() if subscriber in subscribers]
+        return defer.DeferredList(
+            [self.unsubscribe(channel, subscriber) for channel in channels] +
+            [self.punsubscribe(pattern, subscriber) for pattern in patterns])
+
+    def messageReceived(self, channel, message, pattern=None):
+        if pattern is None:
+            subscribers = self.subscribers.get(channel)
+        else:
+            subscribers = self.patterns.get(pattern)
+        if not subscribers:
+            return
+        # Subscribers may unsubscribe while their message is delivered.
+        for subscriber in list(subscribers):
+            try:
+                if hasattr(subscriber, "sendEvent"):
+                    subscriber.sendEvent(message)
+                elif hasattr(subscriber, "sendMessage"):
+                    subscriber.sendMessage(message)
+                else:
+                    subscriber(channel, message)
+            except Exception:
+                log.err()
+
+    def disconnect(self):
+        return defer.DeferredList([factory.handler.disconnect()
+                                   for factory in self.factories])
+
+    def __repr__(self):
+        return "<Redis PubSubBridge: %d channel(s), %d pattern(s)>" % (
+            len(self.subscribers), len(self.patterns))
+
+
+class InvalidationProtocol(SubscriberProtocol):
+    def replyReceived(self, reply):
+        # The reply of CLIENT ID, sent before subscribing.
+        if not isinstance(reply, (list, Exception)):
+            self.replyQueue.put(reply)
+        else:
+            SubscriberProtocol.replyReceived(self, reply)
+
+    def messageReceived(self, pattern, channel, message):
+        if channel == ClientSideCache.invalidationChannel:
+            self.factory.cache.invalidate(message)
+
+
+class InvalidationFactory(SubscriberFactory):
+    protocol = InvalidationProtocol
+
+    def __init__(self, cache, password=None):
+        SubscriberFactory.__init__(self, isLazy=True)
+        self.cache = cache
+        self.password = password
+        self.convertNumbers = False
+
+    def addConnection(self, conn):
+        SubscriberFactory.addConnection(self, conn)
+        self.cache.invalidationConnectionMade(conn)
+
+    def delConnection(self, conn):
+        SubscriberFactory.delConnection(self, conn)
+        self.cache.invalidationConnectionLost(conn)
+
+
+class SentinelWatcherProtocol(SubscriberProtocol):
+    def messageReceived(self, pattern, channel, message):
+        self.factory.sentinel.eventReceived(channel, message)
+
+
+class SentinelWatcherFactory(SubscriberFactory):
+    protocol = SentinelWatcherProtocol
+
+    def __init__(self, sentinel):
+        SubscriberFactory.__init__(self, isLazy=True)
+        self.sentinel = sentinel
+        self.convertNumbers = False
+
+    def addConnection(self, conn):
+        SubscriberFactory.addConnection(self, conn)
+        for event in self.sentinel.watchedEvents:
+            conn.subscribe(event).addErrback(log.err)
+        if self.sentinel.master is not None:
+            # Events may have been missed while disconnected.
+            self.sentinel.discoverMaster().addErrback(log.err)
+
+
+class TrackingFactory(RedisFactory):
+    """
+    Connections that read the values of a `ClientSideCache`. Tracking is
+    enabled on each connection before it joins the pool.
+    """
+    def __init__(self, cache, factory, poolsize=1):
+        RedisFactory.__init__(self, factory.uuid, factory.dbid, poolsize,
+                              True, ConnectionHandler, factory.charset,
+                              factory.password, factory.replyTimeout,
+                              factory.convertNumbers)
+        self.cache = cache
+
+    def addConnection(self, conn):
+        d = self.cache.trackConnection(conn)
+        d.addCallback(lambda ign: RedisFactory.addConnection(self, conn))
+        d.addErrback(log.err)
+
+
+class ClientSideCache(object):
+    """
+    Local cache of the values read with ``cachedMethods``, in front of a
+    connection handler. Any other command is sent to the handler, and
+    the commands of ``writeMethods`` drop the local copy of the keys they
+    change.
+
+    Up to ``maxsize`` keys are kept, the least recently used are dropped
+    first, and values expire after ``ttl`` seconds (None for no expiry,
+    only when tracking). Values are shared, they must not be changed.
+
+    With ``tracking``, values are read on connections where redis tracks
+    the keys read (``CLIENT TRACKING ON REDIRECT``), and sends their
+    invalidations to a subscriber connection once they change. When the
+    server does not support tracking, the cache falls back to the TTL
+    only. Use `lazyClientSideCache` to set up the connections::
+
+        cache = redis.lazyClientSideCache(rc, maxsize=1000, ttl=300)
+        flags = yield cache.hgetall("feature:flags")
+    """
+    invalidationChannel = "__redis__:invalidate"
+    cachedMethods = frozenset(["get", "hget", "hgetall", "hmget",
+                               "smembers"])
+    # Commands that change the key given first, or the keys of the list
+    # given first.
+    writeMethods = frozenset([
+        "append", "decr", "decrby", "delete", "expire", "getset", "hdel",
+        "hincrby", "hmset", "hset", "hsetnx", "incr", "incrby", "move",
+        "persist", "sadd", "sdiffstore", "set", "setbit", "setex", "setnx",
+        "sinterstore", "spop", "srem", "sunionstore",
+    ])
+    # Commands that change the keys given first and second.
+    moveMethods = frozenset(["rename", "renamenx", "smove"])
+
+    def __init__(self, handler, maxsize=10000, ttl=60, tracking=True,
+                 clock=None):
+        if ttl is None and not tracking:
+            raise ValueError("A ttl is required without tracking")
+        if clock is None:
+            clock = reactor
+        self.handler = handler
+        self.ttl = ttl
+        self.tracking = tracking
+        self.clock = clock
+        self.reader = handler
+        self.clientId = None
+        self.invalidationFactory = None
+        self.trackingFactory = None
+        self.hits = self.misses = self.invalidations = 0
+        self._cache = LRUCache(maxsize)
+        self._waitingForClientId = []
+        self._inflight = {}
+        self._pending = {}
+        self._stale = set()
+        if tracking:
+            self.invalidationFactory = InvalidationFactory(
+                self, handler._factory.password)
+            self.trackingFactory = TrackingFactory(self, handler._factory)
+            self.reader = self.trackingFactory.handler
+
+    @defer.inlineCallbacks
+    def invalidationConnectionMade(self, conn):
+        try:
+            client_id = yield conn.execute_command("CLIENT", "ID")
+            yield conn.subscribe(self.invalidationChannel)
+        except Exception, e:
+            log.msg("Redis error: could not subscribe to invalidations: %s"
+                    % e)
+            conn.transport.loseConnection()
+            defer.returnValue(None)
+
+        self.clientId = client_id
+        deferreds, self._waitingForClientId = self._waitingForClientId, []
+        for d in deferreds:
+            d.callback(client_id)
+
+    def invalidationConnectionLost(self, conn):
+        # Invalidations are lost until every connection tracks its keys
+        # again, redirected to the new subscriber connection.
+        self.clientId = None
+        self.invalidate(None)
+        if self.trackingFactory is not None:
+            for reader in list(self.trackingFactory.pool):
+                reader.transport.loseConnection()
+
+    @defer.inlineCallbacks
+    def trackConnection(self, conn):
+        if not self.tracking:
+            defer.returnValue(None)
+        client_id = self.clientId
+        if client_id is None:
+            d = defer.Deferred()
+            self._waitingForClientId.append(d)
+            client_id = yield d
+        try:
+            yield conn.execute_command("CLIENT", "TRACKING", "ON",
+                                       "REDIRECT", client_id)
+        except ResponseError, e:
+            log.msg("Redis error: client tracking is not available, "
+                    "caching with ttl=%s: %s" % (self.ttl, e))
+            self._trackingUnavailable()
+
+    def _trackingUnavailable(self):
+        self.tracking = False
+        self.reader = self.handler
+        if self.ttl is None:
+            self.ttl = 60
+        for factory in (self.invalidationFactory, self.trackingFactory):
+            factory.continueTrying = 0
+            for conn in list(factory.pool):
+                conn.transport.loseConnection()
+
+    def invalidate(self, keys):
+        """
+        Drops the local copy of ``keys``, or of every key when None.
+        """
+        if keys is None:
+            self.invalidations += len(self._cache)
+            self._cache.clear()
+            self._stale.update(self._pending)
+            return
+        if isinstance(keys, (str, unicode)):
+            keys = [keys]
+        for key in keys:
+            if self._cache.pop(key, None) is not None:
+                self.invalidations += 1
+            if key in self._pending:
+                self._stale.add(key)
+
+    def _cached(self, method, key, *args):
+        ident = (method,) + tuple(tuple(arg) if isinstance(arg, list)
+                                  else arg for arg in args)
+        entry = self._cache.get(key)
+        if entry is not None and ident in entry:
+            value, expires = entry[ident]
+            if expires is None or expires > self.clock.seconds():
+                self.hits += 1
+                return defer.succeed(value)
+            del entry[ident]
+
+        self.misses += 1
+        # Concurrent misses of the same value share one command.
+        waiting = self._inflight.get((key, ident))
+        if waiting is not None:
+            d = defer.Deferred()
+            waiting.append(d)
+            return d
+
+        self._inflight[(key, ident)] = []
+        self._pending[key] = self._pending.get(key, 0) + 1
+        d = getattr(self.reader, method)(key, *args)
+        d.addBoth(self._received, key, ident)
+        return d
+
+    def _received(self, result, key, ident):
+        waiting = self._inflight.pop((key, ident))
+        stale = key in self._stale
+        self._pending[key] -= 1
+        if not self._pending[key]:
+            del self._pending[key]
+            self._stale.discard(key)
+
+        if not stale and not isinstance(result, Failure):
+            entry = self._cache.get(key)
+            if entry is None:
+                entry = self._cache[key] = {}
+            expires = None
+            if self.ttl is not None:
+                expires = self.clock.seconds() + self.ttl
+            entry[ident] = (result, expires)
+
+        for d in waiting:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        return result
+
+    def _writtenKeys(self, method, args):
+        if method in ("mset", "msetnx"):
+            return list(args[0])
+        if method in self.moveMethods:
+            return list(args[:2])
+        keys = []
+        # delete also takes the keys as separate arguments.
+        for arg in args if method == "delete" else args[:1]:
+            if isinstance(arg, (str, unicode)):
+                keys.append(arg)
+            else:
+                keys.extend(arg)
+        return keys
+
+    def _write(self, method, *args, **kwargs):
+        keys = self._writtenKeys(method, args)
+        self.invalidate(keys)
+
+        def written(result):
+            self.invalidate(keys)
+            return result
+        d = getattr(self.handler, method)(*args, **kwargs)
+        return d.addBoth(written)
+
+    def __getattr__(self, method):
+        if method in self.cachedMethods:
+            return functools.partial(self._cached, method)
+        elif method in self.writeMethods or method in self.moveMethods or \
+                method in ("mset", "msetnx"):
+            return functools.partial(self._write, method)
+        return getattr(self.handler, method)
+
+    def stats(self):
+        """
+        Returns hits, misses, hit_rate, invalidations, the number of keys
+        cached and whether the server tracks them.
+        """
+        reads = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": float(self.hits) / reads if reads else 0.0,
+            "invalidations": self.invalidations,
+            "size": len(self._cache),
+            "tracking": self.tracking,
+        }
+
+    @defer.inlineCallbacks
+    def disconnect(self):
+        """
+        Closes the connections of the cache, but not of its handler.
+        """
+        for factory in (self.invalidationFactory, self.trackingFactory):
+            if factory is not None:
+                yield factory.handler.disconnect()
+        self.invalidate(None)
+
+    def __repr__(self):
+        return "<Redis ClientSideCache: %d key(s), %s>" % (
+            len(self._cache), "tracking" if self.tracking else "ttl only")
+
+
+class StreamConsumer(object):
+    """
+    Consumes a stream as ``consumer`` of ``group``, calling ``callback``
+    with the id and the fields of each entry. It may return a Deferred.
+
+    Entries are read ``count`` at a time with XREADGROUP, blocking for up
+    to ``block`` seconds. Entries handled without errors are acknowledged
+    with a single XACK, sent in the same pipeline as the next read. The
+    others stay pending.
+
+    Entries delivered to the consumer before a restart, and never
+    acknowledged, are handled first. Every ``claimAfter`` seconds, entries
+    pending for longer than that, probably in consumers that went away,
+    are claimed with XAUTOCLAIM, or with XPENDING and XCLAIM before redis
+    6.2.
+
+    The reads hold their connection while blocking, so give the consumer
+    a connection of its own, without a ``replyTimeout`` shorter than
+    ``block``::
+
+        rc = cyclone.redis.lazyConnection()
+        consumer = cyclone.redis.StreamConsumer(rc, "jobs", "workers",
+                                                "worker-1", handle)
+        consumer.start()
+    """
+    # Seconds to wait before reading again, after an error.
+    retryDelay = 1
+
+    def __init__(self, redis, key, group, consumer, callback, count=100,
+                 block=5, claimAfter=60, createGroup=True, clock=None):
+        self.redis = redis
+        self.key = key
+        self.group = group
+        self.consumer = consumer
+        self.callback = callback
+        self.count = count
+        self.block = block
+        self.claimAfter = claimAfter
+        self.createGroup = createGroup
+        self.clock = clock or reactor
+        self.running = False
+        self.processed = 0
+        self.failed = 0
+        self.claimed = 0
+        self._acks = []
+        # Entries already delivered are read from this id, then new ones.
+        self._history = "0"
+        self._nextClaim = None
+        self._autoclaim = True
+        self._loop = None
+        self._waitingForStop = []
+
+    def start(self):
+        if self._loop is None:
+            self.running = True
+            self._loop = self._consume()
+            self._loop.addErrback(log.err)
+            self._loop.addBoth(self._stopped)
+
+    def stop(self):
+        """
+        Stops reading. Returns a Deferred fired once the current batch is
+        handled, and acknowledged.
+        """
+        self.running = False
+        if self._loop is None:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._waitingForStop.append(d)
+        return d
+
+    def _stopped(self, ign):
+        self._loop = None
+        deferreds, self._waitingForStop = self._waitingForStop, []
+        for d in deferreds:
+            d.callback(None)
+
+    @defer.inlineCallbacks
+    def _consume(self):
+        if self.claimAfter is not None:
+            self._nextClaim = self.clock.seconds() + self.claimAfter
+        while self.running:
+            try:
+                if self.createGroup:
+                    yield self._createGroup()
+                if self._nextClaim is not None and \
+                        self.clock.seconds() >= self._nextClaim:
+                    yield self._claim()
+                    self._nextClaim = self.clock.seconds() + self.claimAfter
+                entries = yield self._read()
+                yield self._handle(entries)
+            except Exception:
+                log.err(None, "Error consuming the stream %s" % self.key)
+                yield task.deferLater(self.clock, self.retryDelay,
+                                      lambda: None)
+
+        if self._acks:
+            acks, self._acks = self._acks, []
+            yield self.redis.xack(self.key, self.group, acks)
+
+    @defer.inlineCallbacks
+    def _createGroup(self):
+        try:
+            yield self.redis.xgroup_create(self.key, self.group, "$",
+                                           mkstream=True)
+        except ResponseError, e:
+            if not str(e).startswith("BUSYGROUP"):
+                raise
+        self.createGroup = False
+
+    @defer.inlineCallbacks
+    def _read(self):
+        if self._history is not None:
+            streams, block = {self.key: self._history}, None
+        else:
+            streams, block = {self.key: ">"}, int(self.block * 1000)
+
+        acks, self._acks = self._acks, []
+        pipe = yield self.redis.pipeline()
+        if acks:
+            pipe.xack(self.key, self.group, acks)
+        pipe.xreadgroup(self.group, self.consumer, streams, self.count, block)
+        try:
+            replies = yield pipe.execute_pipeline()
+        except:
+            self._acks = acks + self._acks
+            raise
+
+        entries = replies[-1].get(self.key, [])
+        if self._history is not None:
+            self._history = entries[-1][0] if entries else None
+        defer.returnValue(entries)
+
+    @defer.inlineCallbacks
+    def _handle(self, entries):
+        for eid, fields in entries:
+            if not fields:
+                # Deleted while pending.
+                self._acks.append(eid)
+                continue
+            try:
+                yield defer.maybeDeferred(self.callback, eid, fields)
+            except Exception:
+                self.failed += 1
+                log.err(None, "Error handling the entry %s of the stream %s"
+                        % (eid, self.key))
+            else:
+                self.processed += 1
+                self._acks.append(eid)
+
+    @defer.inlineCallbacks
+    def _claim(self):
+        idle = int(self.claimAfter * 1000)
+        if self._autoclaim:
+            start = "0-0"
+            try:
+                while True:
+                    start, entries = yield self.redis.xautoclaim(
+                        self.key, self.group, self.consumer, idle, start,
+                        self.count)
+                    self.claimed += len(entries)
+                    yield self._handle(entries)
+                    if start == "0-0":
+                        defer.returnValue(None)
+            except ResponseError, e:
+                if not str(e).startswith("ERR unknown command"):
+                    raise
+                self._autoclaim = False
+
+        pending = yield self.redis.xpending(self.key, self.group, "-", "+",
+                                            self.count)
+        ids = [eid for eid, consumer, elapsed, deliveries in pending
+               if elapsed >= idle]
+        if ids:
+            entries = yield self.redis.xclaim(self.key, self.group,
+                                              self.consumer, idle, ids)
+            self.claimed += len(entries)
+            yield self._handle(entries)
+
+    def __repr__(self):
+        return "<Redis StreamConsumer: %s of %s on %s, %d processed>" % (
+            self.consumer, self.group, self.key, self.processed)
+
+
 def makeConnection(host, port, dbid, poolsize, reconnect, isLazy,
                    charset, password, connectTimeout, replyTimeout,
-                   convertNumbers):
+                   convertNumbers, autoPipeline, minsize=None, maxsize=None,
+                   idleTimeout=None, pingInterval=None, acquireTimeout=None,
+                   commandTimeout=None):
     uuid = "%s:%s" % (host, port)
     factory = RedisFactory(uuid, dbid, poolsize, isLazy, ConnectionHandler,
-                           charset, password, replyTimeout, convertNumbers)
+                           charset, password, replyTimeout, convertNumbers,
+                           autoPipeline, minsize, maxsize, idleTimeout,
+                           pingInterval, acquireTimeout, commandTimeout)
     factory.continueTrying = reconnect
+    factory.connect = functools.partial(reactor.connectTCP, host, port,
+                                        factory, connectTimeout)
+    factory.blocking = factory.makeBlockingPool()
+    factory.blocking.connect = functools.partial(
+        reactor.connectTCP, host, port, factory.blocking, connectTimeout)
     for x in xrange(poolsize):
-        reactor.connectTCP(host, port, factory, connectTimeout)
+        factory.connect()
 
     if isLazy:
         return factory.handler
@@ -2124,7 +4415,7 @@ def makeConnection(host, port, dbid, poolsize, reconnect, isLazy,
 
 def makeShardedConnection(hosts, dbid, poolsize, reconnect, isLazy,
                           charset, password, connectTimeout, replyTimeout,
-                          convertNumbers):
+                          convertNumbers, autoPipeline, hashMode="crc32"):
     err = "Please use a list or tuple of host:port for sharded connections"
     if not isinstance(hosts, (list, tuple)):
         raise ValueError(err)
@@ -2139,94 +4430,121 @@ def makeShardedConnection(hosts, dbid, poolsize, reconnect, isLazy,
 
         c = makeConnection(host, port, dbid, poolsize, reconnect, isLazy,
                            charset, password, connectTimeout, replyTimeout,
-                           convertNumbers)
+                           convertNumbers, autoPipeline)
         connections.append(c)
 
     if isLazy:
-        return ShardedConnectionHandler(connections)
+        return ShardedConnectionHandler(connections, hashMode)
     else:
         deferred = defer.DeferredList(connections)
-        ShardedConnectionHandler(deferred)
+        ShardedConnectionHandler(deferred, hashMode)
         return deferred
 
 
 def Connection(host="localhost", port=6379, dbid=None, reconnect=True,
                charset="utf-8", password=None,
-               connectTimeout=None, replyTimeout=None, convertNumbers=True):
+               connectTimeout=None, replyTimeout=None, convertNumbers=True,
+               autoPipeline=False):
     return makeConnection(host, port, dbid, 1, reconnect, False,
                           charset, password, connectTimeout, replyTimeout,
-                          convertNumbers)
+                          convertNumbers, autoPipeline)
 
 
 def lazyConnection(host="localhost", port=6379, dbid=None, reconnect=True,
                    charset="utf-8", password=None,
-                   connectTimeout=None, replyTimeout=None, convertNumbers=True):
+                   connectTimeout=None, replyTimeout=None, convertNumbers=True,
+                   autoPipeline=False):
     return makeConnection(host, port, dbid, 1, reconnect, True,
                           charset, password, connectTimeout, replyTimeout,
-                          convertNumbers)
+                          convertNumbers, autoPipeline)
 
 
 def ConnectionPool(host="localhost", port=6379, dbid=None,
                    poolsize=10, reconnect=True, charset="utf-8", password=None,
                    connectTimeout=None, replyTimeout=None,
-                   convertNumbers=True):
+                   convertNumbers=True, autoPipeline=False, minsize=None,
+                   maxsize=None, idleTimeout=None, pingInterval=None,
+                   acquireTimeout=None, commandTimeout=None):
     return makeConnection(host, port, dbid, poolsize, reconnect, False,
                           charset, password, connectTimeout, replyTimeout,
-                          convertNumbers)
+                          convertNumbers, autoPipeline, minsize, maxsize,
+                          idleTimeout, pingInterval, acquireTimeout,
+                          commandTimeout)
 
 
 def lazyConnectionPool(host="localhost", port=6379, dbid=None,
                        poolsize=10, reconnect=True, charset="utf-8",
                        password=None, connectTimeout=None, replyTimeout=None,
-                       convertNumbers=True):
+                       convertNumbers=True, autoPipeline=False, minsize=None,
+                       maxsize=None, idleTimeout=None, pingInterval=None,
+                       acquireTimeout=None, commandTimeout=None):
     return makeConnection(host, port, dbid, poolsize, reconnect, True,
                           charset, password, connectTimeout, replyTimeout,
-                          convertNumbers)
+                          convertNumbers, autoPipeline, minsize, maxsize,
+                          idleTimeout, pingInterval, acquireTimeout,
+                          commandTimeout)
 
 
 def ShardedConnection(hosts, dbid=None, reconnect=True, charset="utf-8",
                       password=None, connectTimeout=None, replyTimeout=None,
-                      convertNumbers=True):
+                      convertNumbers=True, autoPipeline=False,
+                      hashMode="crc32"):
     return makeShardedConnection(hosts, dbid, 1, reconnect, False,
                                  charset, password, connectTimeout,
-                                 replyTimeout, convertNumbers)
+                                 replyTimeout, convertNumbers, autoPipeline,
+                                 hashMode)
 
 
 def lazyShardedConnection(hosts, dbid=None, reconnect=True, charset="utf-8",
                           password=None,
                           connectTimeout=None, replyTimeout=None,
-                          convertNumbers=True):
+                          convertNumbers=True, autoPipeline=False,
+                          hashMode="crc32"):
     return makeShardedConnection(hosts, dbid, 1, reconnect, True,
                                  charset, password, connectTimeout,
-                                 replyTimeout, convertNumbers)
+                                 replyTimeout, convertNumbers, autoPipeline,
+                                 hashMode)
 
 
 def ShardedConnectionPool(hosts, dbid=None, poolsize=10, reconnect=True,
                           charset="utf-8", password=None,
                           connectTimeout=None, replyTimeout=None,
-                          convertNumbers=True):
+                          convertNumbers=True, autoPipeline=False,
+                          hashMode="crc32"):
     return makeShardedConnection(hosts, dbid, poolsize, reconnect, False,
                                  charset, password, connectTimeout,
-                                 replyTimeout, convertNumbers)
+                                 replyTimeout, convertNumbers, autoPipeline,
+                                 hashMode)
 
 
 def lazyShardedConnectionPool(hosts, dbid=None, poolsize=10, reconnect=True,
                               charset="utf-8", password=None,
                               connectTimeout=None, replyTimeout=None,
-                              convertNumbers=True):
+                              convertNumbers=True, autoPipeline=False,
+                              hashMode="crc32"):
     return makeShardedConnection(hosts, dbid, poolsize, reconnect, True,
                                  charset, password, connectTimeout,
-                                 replyTimeout, convertNumbers)
+                                 replyTimeout, convertNumbers, autoPipeline,
+                                 hashMode)
 
 
 def makeUnixConnection(path, dbid, poolsize, reconnect, isLazy,
                        charset, password, connectTimeout, replyTimeout,
-                       convertNumbers):
+                       convertNumbers, autoPipeline, minsize=None,
+                       maxsize=None, idleTimeout=None, pingInterval=None,
+                       acquireTimeout=None, commandTimeout=None):
     factory = RedisFactory(path, dbid, poolsize, isLazy, UnixConnectionHandler,
-                           charset, password, replyTimeout, convertNumbers)
+                           charset, password, replyTimeout, convertNumbers,
+                           autoPipeline, minsize, maxsize, idleTimeout,
+                           pingInterval, acquireTimeout, commandTimeout)
     factory.continueTrying = reconnect
+    factory.connect = functools.partial(reactor.connectUNIX, path, factory,
+                                        connectTimeout)
+    factory.blocking = factory.makeBlockingPool()
+    factory.blocking.connect = functools.partial(
+        reactor.connectUNIX, path, factory.blocking, connectTimeout)
     for x in xrange(poolsize):
-        reactor.connectUNIX(path, factory, connectTimeout)
+        factory.connect()
 
     if isLazy:
         return factory.handler
@@ -2236,7 +4554,7 @@ def makeUnixConnection(path, dbid, poolsize, reconnect, isLazy,
 
 def makeShardedUnixConnection(paths, dbid, poolsize, reconnect, isLazy,
                               charset, password, connectTimeout, replyTimeout,
-                              convertNumbers):
+                              convertNumbers, autoPipeline, hashMode="crc32"):
     err = "Please use a list or tuple of paths for sharded unix connections"
     if not isinstance(paths, (list, tuple)):
         raise ValueError(err)
@@ -2245,85 +4563,283 @@ def makeShardedUnixConnection(paths, dbid, poolsize, reconnect, isLazy,
     for path in paths:
         c = makeUnixConnection(path, dbid, poolsize, reconnect, isLazy,
                                charset, password, connectTimeout, replyTimeout,
-                               convertNumbers)
+                               convertNumbers, autoPipeline)
         connections.append(c)
 
     if isLazy:
-        return ShardedUnixConnectionHandler(connections)
+        return ShardedUnixConnectionHandler(connections, hashMode)
     else:
         deferred = defer.DeferredList(connections)
-        ShardedUnixConnectionHandler(deferred)
+        ShardedUnixConnectionHandler(deferred, hashMode)
         return deferred
 
 
 def UnixConnection(path="/tmp/redis.sock", dbid=None, reconnect=True,
                    charset="utf-8", password=None,
-                   connectTimeout=None, replyTimeout=None, convertNumbers=True):
+                   connectTimeout=None, replyTimeout=None, convertNumbers=True,
+                   autoPipeline=False):
     return makeUnixConnection(path, dbid, 1, reconnect, False,
                               charset, password, connectTimeout, replyTimeout,
-                              convertNumbers)
+                              convertNumbers, autoPipeline)
 
 
 def lazyUnixConnection(path="/tmp/redis.sock", dbid=None, reconnect=True,
                        charset="utf-8", password=None,
                        connectTimeout=None, replyTimeout=None,
-                       convertNumbers=True):
+                       convertNumbers=True, autoPipeline=False):
     return makeUnixConnection(path, dbid, 1, reconnect, True,
                               charset, password, connectTimeout, replyTimeout,
-                              convertNumbers)
+                              convertNumbers, autoPipeline)
 
 
 def UnixConnectionPool(path="/tmp/redis.sock", dbid=None, poolsize=10,
                        reconnect=True, charset="utf-8", password=None,
                        connectTimeout=None, replyTimeout=None,
-                       convertNumbers=True):
+                       convertNumbers=True, autoPipeline=False, minsize=None,
+                       maxsize=None, idleTimeout=None, pingInterval=None,
+                       acquireTimeout=None, commandTimeout=None):
     return makeUnixConnection(path, dbid, poolsize, reconnect, False,
                               charset, password, connectTimeout, replyTimeout,
-                              convertNumbers)
+                              convertNumbers, autoPipeline, minsize, maxsize,
+                              idleTimeout, pingInterval, acquireTimeout,
+                              commandTimeout)
 
 
 def lazyUnixConnectionPool(path="/tmp/redis.sock", dbid=None, poolsize=10,
                            reconnect=True, charset="utf-8", password=None,
                            connectTimeout=None, replyTimeout=None,
-                           convertNumbers=True):
+                           convertNumbers=True, autoPipeline=False,
+                           minsize=None, maxsize=None, idleTimeout=None,
+                           pingInterval=None, acquireTimeout=None,
+                           commandTimeout=None):
     return makeUnixConnection(path, dbid, poolsize, reconnect, True,
                               charset, password, connectTimeout, replyTimeout,
-                              convertNumbers)
+                              convertNumbers, autoPipeline, minsize, maxsize,
+                              idleTimeout, pingInterval, acquireTimeout,
+                              commandTimeout)
 
 
 def ShardedUnixConnection(paths, dbid=None, reconnect=True, charset="utf-8",
                           password=None, connectTimeout=None, replyTimeout=None,
-                          convertNumbers=True):
+                          convertNumbers=True, autoPipeline=False,
+                          hashMode="crc32"):
     return makeShardedUnixConnection(paths, dbid, 1, reconnect, False,
                                      charset, password, connectTimeout,
-                                     replyTimeout, convertNumbers)
+                                     replyTimeout, convertNumbers,
+                                     autoPipeline, hashMode)
 
 
 def lazyShardedUnixConnection(paths, dbid=None, reconnect=True,
                               charset="utf-8", password=None,
                               connectTimeout=None, replyTimeout=None,
-                              convertNumbers=True):
+                              convertNumbers=True, autoPipeline=False,
+                              hashMode="crc32"):
     return makeShardedUnixConnection(paths, dbid, 1, reconnect, True,
                                      charset, password, connectTimeout,
-                                     replyTimeout, convertNumbers)
+                                     replyTimeout, convertNumbers,
+                                     autoPipeline, hashMode)
 
 
 def ShardedUnixConnectionPool(paths, dbid=None, poolsize=10, reconnect=True,
                               charset="utf-8", password=None,
                               connectTimeout=None, replyTimeout=None,
-                              convertNumbers=True):
+                              convertNumbers=True, autoPipeline=False,
+                              hashMode="crc32"):
     return makeShardedUnixConnection(paths, dbid, poolsize, reconnect, False,
                                      charset, password, connectTimeout,
-                                     replyTimeout, convertNumbers)
+                                     replyTimeout, convertNumbers,
+                                     autoPipeline, hashMode)
 
 
 def lazyShardedUnixConnectionPool(paths, dbid=None, poolsize=10,
                                   reconnect=True, charset="utf-8",
                                   password=None, connectTimeout=None,
-                                  replyTimeout=None, convertNumbers=True):
+                                  replyTimeout=None, convertNumbers=True,
+                                  autoPipeline=False, hashMode="crc32"):
     return makeShardedUnixConnection(paths, dbid, poolsize, reconnect, True,
                                      charset, password, connectTimeout,
-                                     replyTimeout, convertNumbers)
+                                     replyTimeout, convertNumbers,
+                                     autoPipeline, hashMode)
+
+
+def makeClusterConnection(nodes, poolsize, reconnect, isLazy, charset,
+                          password, connectTimeout, replyTimeout,
+                          convertNumbers, autoPipeline):
+    err = "Please use a list or tuple of host:port for cluster connections"
+    if not isinstance(nodes, (list, tuple)) or not nodes:
+        raise ValueError(err)
+    for item in nodes:
+        try:
+            host, port = item.rsplit(":", 1)
+            int(port)
+        except:
+            raise ValueError(err)
+
+    handler = ClusterConnectionHandler(nodes, poolsize, reconnect, charset,
+                                       password, connectTimeout, replyTimeout,
+                                       convertNumbers, autoPipeline)
+    if isLazy:
+        handler.refreshSlots().addErrback(log.err)
+        return handler
+    else:
+        # Fetch the slot map once connected to any of the nodes.
+        deferred = defer.DeferredList(
+            [handler._node(address)._factory.deferred for address in nodes],
+            fireOnOneCallback=True, consumeErrors=True)
+        return deferred.addCallback(lambda ign: handler.refreshSlots())
+
+
+def ClusterConnection(nodes, reconnect=True, charset="utf-8", password=None,
+                      connectTimeout=None, replyTimeout=None,
+                      convertNumbers=True, autoPipeline=False):
+    return makeClusterConnection(nodes, 1, reconnect, False, charset,
+                                 password, connectTimeout, replyTimeout,
+                                 convertNumbers, autoPipeline)
+
+
+def lazyClusterConnection(nodes, reconnect=True, charset="utf-8",
+                          password=None, connectTimeout=None,
+                          replyTimeout=None, convertNumbers=True,
+                          autoPipeline=False):
+    return makeClusterConnection(nodes, 1, reconnect, True, charset,
+                                 password, connectTimeout, replyTimeout,
+                                 convertNumbers, autoPipeline)
+
+
+def ClusterConnectionPool(nodes, poolsize=10, reconnect=True,
+                          charset="utf-8", password=None,
+                          connectTimeout=None, replyTimeout=None,
+                          convertNumbers=True, autoPipeline=False):
+    return makeClusterConnection(nodes, poolsize, reconnect, False, charset,
+                                 password, connectTimeout, replyTimeout,
+                                 convertNumbers, autoPipeline)
+
+
+def lazyClusterConnectionPool(nodes, poolsize=10, reconnect=True,
+                              charset="utf-8", password=None,
+                              connectTimeout=None, replyTimeout=None,
+                              convertNumbers=True, autoPipeline=False):
+    return makeClusterConnection(nodes, poolsize, reconnect, True, charset,
+                                 password, connectTimeout, replyTimeout,
+                                 convertNumbers, autoPipeline)
+
+
+def makeSentinelConnection(sentinels, service, dbid, poolsize, reconnect,
+                           isLazy, charset, password, connectTimeout,
+                           replyTimeout, convertNumbers, autoPipeline,
+                           readFromReplicas):
+    err = "Please use a list or tuple of host:port for sentinel connections"
+    if not isinstance(sentinels, (list, tuple)) or not sentinels:
+        raise ValueError(err)
+    for item in sentinels:
+        try:
+            host, port = item.rsplit(":", 1)
+            int(port)
+        except:
+            raise ValueError(err)
+
+    handler = SentinelConnectionHandler(sentinels, service, dbid, poolsize,
+                                        reconnect, charset, password,
+                                        connectTimeout, replyTimeout,
+                                        convertNumbers, autoPipeline,
+                                        readFromReplicas)
+    handler.watch()
+    if isLazy:
+        handler.discoverMaster().addErrback(log.err)
+        return handler
+
+    def connected(ign):
+        deferred = handler._master._factory.deferred
+        if deferred is None:
+            return handler
+        return deferred.addCallback(lambda ign: handler)
+    return handler.discoverMaster().addCallback(connected)
+
+
+def SentinelConnection(sentinels, service="mymaster", dbid=None,
+                       reconnect=True, charset="utf-8", password=None,
+                       connectTimeout=None, replyTimeout=None,
+                       convertNumbers=True, autoPipeline=False,
+                       readFromReplicas=False):
+    return makeSentinelConnection(sentinels, service, dbid, 1, reconnect,
+                                  False, charset, password, connectTimeout,
+                                  replyTimeout, convertNumbers, autoPipeline,
+                                  readFromReplicas)
+
+
+def lazySentinelConnection(sentinels, service="mymaster", dbid=None,
+                           reconnect=True, charset="utf-8", password=None,
+                           connectTimeout=None, replyTimeout=None,
+                           convertNumbers=True, autoPipeline=False,
+                           readFromReplicas=False):
+    return makeSentinelConnection(sentinels, service, dbid, 1, reconnect,
+                                  True, charset, password, connectTimeout,
+                                  replyTimeout, convertNumbers, autoPipeline,
+                                  readFromReplicas)
+
+
+def SentinelConnectionPool(sentinels, service="mymaster", dbid=None,
+                           poolsize=10, reconnect=True, charset="utf-8",
+                           password=None, connectTimeout=None,
+                           replyTimeout=None, convertNumbers=True,
+                           autoPipeline=False, readFromReplicas=False):
+    return makeSentinelConnection(sentinels, service, dbid, poolsize,
+                                  reconnect, False, charset, password,
+                                  connectTimeout, replyTimeout,
+                                  convertNumbers, autoPipeline,
+                                  readFromReplicas)
+
+
+def lazySentinelConnectionPool(sentinels, service="mymaster", dbid=None,
+                               poolsize=10, reconnect=True, charset="utf-8",
+                               password=None, connectTimeout=None,
+                               replyTimeout=None, convertNumbers=True,
+                               autoPipeline=False, readFromReplicas=False):
+    return makeSentinelConnection(sentinels, service, dbid, poolsize,
+                                  reconnect, True, charset, password,
+                                  connectTimeout, replyTimeout,
+                                  convertNumbers, autoPipeline,
+                                  readFromReplicas)
+
+
+def lazyPubSubBridge(host="localhost", port=6379, reconnect=True,
+                     password=None, connectTimeout=None, connections=1):
+    bridge = PubSubBridge(password, connections)
+    for factory in bridge.factories:
+        factory.continueTrying = reconnect
+        reactor.connectTCP(host, port, factory, connectTimeout)
+    return bridge
+
+
+def lazyUnixPubSubBridge(path="/tmp/redis.sock", reconnect=True,
+                         password=None, connectTimeout=None, connections=1):
+    bridge = PubSubBridge(password, connections)
+    for factory in bridge.factories:
+        factory.continueTrying = reconnect
+        reactor.connectUNIX(path, factory, connectTimeout)
+    return bridge
+
+
+def lazyClientSideCache(handler, maxsize=10000, ttl=60, tracking=True,
+                        poolsize=1, connectTimeout=None):
+    """
+    Returns a `ClientSideCache` in front of ``handler``. With tracking,
+    it connects to the same server with ``poolsize`` connections to read
+    the values, and one connection to receive their invalidations.
+    """
+    cache = ClientSideCache(handler, maxsize, ttl, tracking)
+    if tracking:
+        cache.trackingFactory.poolsize = poolsize
+        factories = [cache.invalidationFactory] + \
+            [cache.trackingFactory] * poolsize
+        uuid = handler._factory.uuid
+        for factory in factories:
+            if isinstance(handler, UnixConnectionHandler):
+                reactor.connectUNIX(uuid, factory, connectTimeout)
+            else:
+                host, port = uuid.rsplit(":", 1)
+                reactor.connectTCP(host, int(port), factory, connectTimeout)
+    return cache
 
 
 __all__ = [
@@ -2335,6 +4851,12 @@ __all__ = [
     UnixConnectionPool, lazyUnixConnectionPool,
     ShardedUnixConnection, lazyShardedUnixConnection,
     ShardedUnixConnectionPool, lazyShardedUnixConnectionPool,
+    ClusterConnection, lazyClusterConnection,
+    ClusterConnectionPool, lazyClusterConnectionPool,
+    SentinelConnection, lazySentinelConnection,
+    SentinelConnectionPool, lazySentinelConnectionPool,
+    lazyPubSubBridge, lazyUnixPubSubBridge,
+    lazyClientSideCache,
 ]
 
 __author__ = "Alexandre Fiori"
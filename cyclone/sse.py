@@ -23,21 +23,221 @@ For more information, check out the `SEE demo
 <https://github.com/fiorix/cyclone/tree/master/demos/sse>`_.
 """
 
+import collections
+import itertools
+import re
+
 from cyclone import escape
+from cyclone.util import WriteCoalescer
 from cyclone.web import RequestHandler
+from twisted.internet import defer
+from twisted.internet import task
 from twisted.python import log
 
 
+def _event_id(eid):
+    if isinstance(eid, unicode):
+        return eid.encode("utf-8")
+    return str(eid)
+
+
+def _clock():
+    from twisted.internet import reactor
+    return reactor
+
+
+class EventBuffer(object):
+    """Keeps the most recent events of a stream in memory, so clients
+    reconnecting with a ``Last-Event-ID`` header can be sent the events
+    they missed.
+
+    At most ``maxlen`` events are retained, and events older than
+    ``max_age`` seconds are dropped. Each stream (chat room, topic, etc)
+    should have its own buffer, shared by all of its clients, and events
+    should be appended once when they are published rather than once per
+    client.
+    """
+    def __init__(self, maxlen=1000, max_age=None, clock=None):
+        self.maxlen = maxlen
+        self.max_age = max_age
+        self._clock = clock
+        self._events = collections.deque()
+        self._serials = {}
+        self._serial = 0
+
+    def _now(self):
+        if self._clock is None:
+            self._clock = _clock()
+        return self._clock.seconds()
+
+    def _expire(self):
+        events = self._events
+        while len(events) > self.maxlen:
+            self._forget(events.popleft())
+        if self.max_age is not None:
+            oldest = self._now() - self.max_age
+            while events and events[0][2] < oldest:
+                self._forget(events.popleft())
+
+    def _forget(self, entry):
+        serial, eid = entry[:2]
+        # A reused id maps to its most recent event.
+        if self._serials.get(eid) == serial:
+            del self._serials[eid]
+
+    def append(self, message, event=None, eid=None):
+        """Records an event and returns its id. When ``eid`` is not given,
+        a sequential id is assigned.
+        """
+        self._serial += 1
+        if eid is None:
+            eid = self._serial
+        eid = _event_id(eid)
+        self._serials[eid] = self._serial
+        self._events.append((self._serial, eid, self._now(), event, message))
+        self._expire()
+        return eid
+
+    def since(self, last_id):
+        """Returns the ``(eid, event, message)`` of the events that came
+        after ``last_id``, oldest first. All retained events are returned
+        if ``last_id`` is no longer (or never was) in the buffer.
+        """
+        self._expire()
+        serial = self._serials.get(_event_id(last_id))
+        if serial is None or not self._events:
+            start = 0
+        else:
+            start = serial - self._events[0][0] + 1
+        return [(eid, event, message) for _, eid, _, event, message in
+                itertools.islice(self._events, start, None)]
+
+
+class RedisEventBuffer(object):
+    """Like `EventBuffer`, but the events are stored in the redis stream
+    ``key``, so they are shared by all processes and survive restarts.
+
+    ``redis`` is a connection from `cyclone.redis`, preferably created
+    with ``convertNumbers=False``. Event ids are the stream's entry ids.
+    `append` and `since` return Deferreds.
+    """
+    _stream_id = re.compile(r"^\d+(-\d+)?$")
+
+    def __init__(self, redis, key, maxlen=1000, max_age=None, clock=None):
+        self.redis = redis
+        self.key = key
+        self.maxlen = maxlen
+        self.max_age = max_age
+        self._clock = clock
+
+    def append(self, message, event=None, eid=None):
+        args = ["XADD", self.key, "MAXLEN", "~", self.maxlen,
+                "*" if eid is None else eid, "data", message]
+        if event:
+            args.extend(("event", event))
+        return self.redis.execute_command(*args)
+
+    def since(self, last_id):
+        last_id = _event_id(last_id)
+        if not self._stream_id.match(last_id):
+            last_id = "-"
+        d = self.redis.execute_command("XRANGE", self.key, last_id, "+",
+                                       "COUNT", self.maxlen + 1)
+        d.addCallback(self._parseEvents, last_id)
+        return d
+
+    def _parseEvents(self, entries, last_id):
+        if self.max_age is not None:
+            if self._clock is None:
+                self._clock = _clock()
+            oldest = (self._clock.seconds() - self.max_age) * 1000
+        else:
+            oldest = None
+
+        events = []
+        for eid, fields in entries or []:
+            eid = _event_id(eid)
+            if eid == last_id:
+                continue
+            if oldest is not None and long(eid.split("-")[0]) < oldest:
+                continue
+            fields = dict(zip(fields[::2], fields[1::2]))
+            message = fields.get("data", "")
+            if not isinstance(message, basestring):
+                message = str(message)
+            events.append((eid, fields.get("event"), message))
+        return events
+
+
+class _Heartbeat(object):
+    """Writes a heartbeat to every stream using the same interval, from a
+    single LoopingCall that only runs while there are streams.
+    """
+    def __init__(self, interval, clock=None):
+        self.interval = interval
+        self.streams = set()
+        self.call = task.LoopingCall(self.beat)
+        if clock is not None:
+            self.call.clock = clock
+
+    def add(self, handler):
+        self.streams.add(handler)
+        if not self.call.running:
+            self.call.start(self.interval, now=False)
+
+    def remove(self, handler):
+        self.streams.discard(handler)
+        if not self.streams and self.call.running:
+            self.call.stop()
+
+    def beat(self):
+        for handler in list(self.streams):
+            handler.sendHeartbeat()
+
+_heartbeats = {}  # {interval: _Heartbeat}
+
+
 class SSEHandler(RequestHandler):
     """Subclass this class and define `bind` and `unbind` to get
     notified when a new client connects or disconnects, respectively.
 
     Once connected, you may send events to the browser via `sendEvent`.
+
+    Set ``write_coalescing = True`` to queue the events sent during one
+    reactor iteration and write them with a single ``writeSequence`` call,
+    or earlier once ``write_coalescing_max_bytes`` are pending.
+
+    Clients reconnecting with a ``Last-Event-ID`` header are sent the
+    events they missed when `getEventBuffer` returns an `EventBuffer` or
+    `RedisEventBuffer` for the stream. `bind` is called first, so no event
+    is lost while they are fetched. The events sent meanwhile are held
+    back and follow the missed ones, except those already replayed.
+
+    Set ``heartbeat_interval`` (seconds) to write a comment to idle
+    streams, so proxies keep them open and dead clients are detected.
+    Streams whose heartbeat cannot be written are closed and unbound.
     """
+    write_coalescing = False
+    write_coalescing_max_bytes = 65536
+    heartbeat_interval = None
+
+    _active_streams = set()
+
+    @classmethod
+    def activeStreams(cls):
+        """Returns the number of connected SSE clients."""
+        return len(SSEHandler._active_streams)
+
     def __init__(self, application, request, **kwargs):
         RequestHandler.__init__(self, application, request, **kwargs)
         self.transport = request.connection.transport
+        if self.write_coalescing:
+            self.transport = WriteCoalescer(self.transport,
+                                            self.write_coalescing_max_bytes)
         self._auto_finish = False
+        self._closed = False
+        self._bound = False
+        self._held_events = None
 
     def sendEvent(self, message, event=None, eid=None, retry=None):
         """
@@ -54,20 +254,40 @@ class SSEHandler(RequestHandler):
 
         retry: set the retry timeout in ms. default 3 secs.
         """
+        if self._held_events is not None:
+            self._held_events.append((message, event, eid, retry))
+            return
+
         if isinstance(message, dict):
             message = escape.json_encode(message)
         if isinstance(message, unicode):
             message = message.encode("utf-8")
         assert isinstance(message, str)
 
+        fields = []
         if eid:
-            self.transport.write("id: %s\n" % eid)
+            fields.append("id: %s\n" % eid)
         if event:
-            self.transport.write("event: %s\n" % event)
+            fields.append("event: %s\n" % event)
         if retry:
-            self.transport.write("retry: %s\n" % retry)
+            fields.append("retry: %s\n" % retry)
+        fields.append("data: %s\n\n" % message)
+
+        self.transport.write("".join(fields))
 
-        self.transport.write("data: %s\n\n" % message)
+    def sendHeartbeat(self):
+        """Writes a comment line, which clients ignore."""
+        transport = self.request.connection.transport
+        try:
+            if transport.disconnecting or getattr(transport, "disconnected",
+                                                  False):
+                raise IOError("SSE transport is closed")
+            self.transport.write(":\n\n")
+        except Exception, e:
+            log.msg("SSE heartbeat failed for %s: %s" %
+                    (self.request.remote_ip, e))
+            self._closeStream()
+            transport.loseConnection()
 
     def _execute(self, transforms, *args, **kwargs):
         self._transforms = []  # transforms
@@ -78,13 +298,74 @@ class SSEHandler(RequestHandler):
         self.set_header("Connection", "keep-alive")
         self.flush()
         self.request.connection.setRawMode()
+        SSEHandler._active_streams.add(self)
+        if self.heartbeat_interval:
+            heartbeat = _heartbeats.get(self.heartbeat_interval)
+            if heartbeat is None:
+                heartbeat = _Heartbeat(self.heartbeat_interval)
+                _heartbeats[self.heartbeat_interval] = heartbeat
+            heartbeat.add(self)
         self.notifyFinish().addCallback(self.on_connection_closed)
+        if self._closed:
+            # The client is already gone.
+            return
+
+        event_buffer = None
+        last_id = self.request.headers.get("Last-Event-ID")
+        if last_id:
+            event_buffer = self.getEventBuffer(*args, **kwargs)
+        if event_buffer is not None:
+            self._held_events = []
+        self._bound = True
         self.bind(*args, **kwargs)
+        if event_buffer is not None:
+            d = defer.maybeDeferred(event_buffer.since, last_id)
+            d.addErrback(self._replayFailed)
+            d.addCallback(self._replayEvents)
+
+    def _replayFailed(self, failure):
+        log.err(failure, "SSE replay failed")
+        return []
+
+    def _replayEvents(self, events):
+        held, self._held_events = self._held_events, None
+        if self._closed:
+            # Disconnected meanwhile.
+            return
+        replayed = set()
+        for eid, event, message in events:
+            replayed.add(str(eid))
+            self.sendEvent(message, event=event, eid=eid)
+        for message, event, eid, retry in held:
+            if eid is None or str(eid) not in replayed:
+                self.sendEvent(message, event=event, eid=eid, retry=retry)
+
+    def getEventBuffer(self, *args, **kwargs):
+        """Returns the buffer of recent events of the stream this client
+        is connecting to, or None to disable replays. Gets the same
+        arguments as `bind`.
+        """
+        return None
 
     def on_connection_closed(self, *args, **kwargs):
         if self.settings.get("debug"):
             log.msg("SSE client disconnected %s" % self.request.remote_ip)
-        self.unbind()
+        self._closeStream()
+
+    def _closeStream(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._held_events = None
+        SSEHandler._active_streams.discard(self)
+        if self.heartbeat_interval in _heartbeats:
+            _heartbeats[self.heartbeat_interval].remove(self)
+        if isinstance(self.transport, WriteCoalescer):
+            self.transport.discard()
+        # Only streams that were bound get unbound.
+        if self._bound:
+            self._bound = False
+            self.unbind()
 
     def bind(self):
         """Gets called when a new client connects."""
@@ -79,6 +79,21 @@ functions in to your template just like any other variable::
 We provide the functions escape(), url_escape(), json_encode(), and squeeze()
 to all templates by default.
 
+Templates are compiled to plain functions, and generate() returns a string.
+Templates created with ``asynchronous=True``, or by a loader created with
+it, may also use expressions returning Deferreds: they are compiled to
+generators run by inlineCallbacks, and generate() returns a Deferred if
+any of those Deferreds has not fired yet::
+
+   t = template.Template("{{ db.get(key) }}", asynchronous=True)
+   d = t.generate(db=redis_connection, key="title")
+
+A `Loader` created with ``cache_path`` keeps the compiled code of its
+templates in that directory, so that new processes load them without
+compiling them again. The cache can be filled at build time with::
+
+    cyclone templates --precompile --cache=/var/cache/myapp templates/
+
 Typical applications do not create `Template` or `Loader` instances by
 hand, but instead use the `render` and `render_string` methods of
 `cyclone.web.RequestHandler`, which load templates automatically based
@@ -128,6 +143,21 @@ with ``{# ... #}``.
         {% extends "base.html" %}
         {% block title %}My page title{% end %}
 
+``{% cache *key* *ttl* %}...{% end %}``
+    Renders the content up to ``end`` once, and reuses the output for
+    ``ttl`` seconds, or until it is evicted if ``ttl`` is 0. ``key`` is an
+    expression, evaluated on every render::
+
+        {% cache "sidebar:%s" % current_user.id 60 %}
+          {% module Sidebar(current_user) %}
+        {% end %}
+
+    The output is stored by the `FragmentCache` of the loader, in
+    memory by default. Concurrent renders of a missing fragment wait for
+    the first one instead of rendering it too. Variables set with
+    ``{% set %}`` inside the block are not set when the output is reused.
+    The loader clears the cache when it drops modified templates.
+
 ``{% comment ... %}``
     A comment which will be removed from the template output.  Note that
     there is no ``{% end %}`` tag; the comment goes from the word ``comment``
@@ -143,6 +173,14 @@ with ``{# ... #}``.
     This statement is allowed only inside ``{% block %}`` statement.
     Inserts value of the appropriate block from the parent template.
 
+``{% flush %}``
+    Sends the output rendered so far when the template is rendered with
+    `Template.stream`, like `~cyclone.web.RequestHandler.render` does. The
+    browser may then fetch the stylesheets of the page while the rest of it
+    is rendered.  Ignored by `Template.generate`, and inside ``apply``::
+
+        </head>{% flush %}
+
 ``{% for *var* in *expr* %}...{% end %}``
     Same as the python ``for`` statement.  ``{% break %}`` and
     ``{% continue %}`` may be used inside the loop.
@@ -189,37 +227,112 @@ from __future__ import absolute_import, division, with_statement
 import collections
 import contextlib
 import datetime
+import getopt
+import hashlib
+import imp
 import linecache
+import marshal
 import os.path
 import posixpath
 import re
 import sys
+import tempfile
 import threading
+import time
 import traceback
 import types
 
 from cStringIO import StringIO
+from cyclone import __version__
 from cyclone import escape
+from cyclone.util import LRUCache
 from cyclone.util import ObjectDict
 from cyclone.util import bytes_type
 from cyclone.util import unicode_type
 
 from twisted.python.failure import Failure
 from twisted.internet.defer import Deferred
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import returnValue
+from twisted.python import log
+from twisted.python.filepath import FilePath
+
+try:
+    from twisted.internet import inotify
+except ImportError:
+    inotify = None
 
 _DEFAULT_AUTOESCAPE = "xhtml_escape"
 _UNSET = object()
 
+def _no_flush(buffer):
+    pass
+
+
+def _str(value):
+    """Converts the value of an expression of a synchronous template."""
+    if isinstance(value, Deferred):
+        result = []
+
+        def record(outcome):
+            # The Deferred keeps its result, for whoever else waits for it.
+            result.append(outcome)
+            return outcome
+        value.addBoth(record)
+        if not result:
+            raise TemplateError("Deferred did not fire in a synchronous "
+                                "template, use asynchronous=True")
+        if isinstance(result[0], Failure):
+            # The error is raised by the template instead.
+            value.addErrback(lambda failure: None)
+            result[0].raiseException()
+        value = result[0]
+        if isinstance(value, (unicode_type, bytes_type)):
+            return value
+    return str(value)
+
+
+# The names every template can use, before the namespace of the loader
+# and the arguments of generate().
+_DEFAULT_NAMESPACE = {
+    "escape": escape.xhtml_escape,
+    "xhtml_escape": escape.xhtml_escape,
+    "url_escape": escape.url_escape,
+    "json_encode": escape.json_encode,
+    "squeeze": escape.squeeze,
+    "linkify": escape.linkify,
+    "datetime": datetime,
+    "_utf8": escape.utf8,  # for internal use
+    "_string_types": (unicode_type, bytes_type),
+    "_str": _str,
+    "_flush": _no_flush,
+    "Deferred": Deferred,
+    "returnValue": returnValue,
+    "__builtins__": __builtins__,
+}
+
 
 class Template(object):
     """A compiled template.
 
     We compile into Python from the given template_string. You can generate
     the template from variables with generate().
+
+    The generated code defines a single ``_execute`` function, which is
+    compiled once. Each call to generate() runs its code object with a
+    new globals dict, holding the default namespace and the arguments.
+
+    With ``asynchronous``, ``_execute`` is a generator which waits for the
+    Deferreds returned by expressions, run by inlineCallbacks. It defaults
+    to the setting of the loader, or False.
     """
     def __init__(self, template_string, name="<string>", loader=None,
-                 compress_whitespace=None, autoescape=_UNSET):
+                 compress_whitespace=None, autoescape=_UNSET,
+                 asynchronous=None):
         self.name = name
+        if asynchronous is None:
+            asynchronous = loader.asynchronous if loader else False
+        self.asynchronous = asynchronous
         if compress_whitespace is None:
             compress_whitespace = name.endswith(".html") or \
                 name.endswith(".js")
@@ -230,9 +343,11 @@ class Template(object):
         else:
             self.autoescape = _DEFAULT_AUTOESCAPE
         self.namespace = loader.namespace if loader else {}
-        reader = _TemplateReader(name, escape.native_str(template_string))
+        self.source = escape.native_str(template_string)
+        self.mtime = None
+        reader = _TemplateReader(name, self.source)
         try:
-            self.file = _File(self, _parse(reader, self))
+            self._file = _File(self, _parse(reader, self))
             self.code = self._generate_python(loader, compress_whitespace)
         except ParseError, e:
             raise TemplateError("Error parsing template %s, line %d: %s" %
@@ -240,43 +355,116 @@ class Template(object):
 
         self.loader = loader
         try:
-            # Under python2.5, the fake filename used here must match
-            # the module name used in __name__ below.
-            self.compiled = compile(
-                escape.to_unicode(self.code),
-                "%s.generated.py" % self.name.replace('.', '_'),
-                "exec")
+            self.compiled = compile(escape.to_unicode(self.code),
+                                    self._filename(), "exec")
         except Exception:
             raise TemplateError("Error compiling template " + name + ":\n" +
                                  _format_code(self.code).rstrip())
+        self._prepare()
+
+    @classmethod
+    def _from_cache(cls, template_string, name, loader, autoescape, code,
+                    compiled, streaming, dependency_names):
+        """Makes a template out of code compiled by a previous process.
+
+        It is only parsed if another template extends or includes it.
+        """
+        self = cls.__new__(cls)
+        self.name = name
+        self.asynchronous = loader.asynchronous
+        self.autoescape = autoescape
+        self.namespace = loader.namespace
+        self.source = escape.native_str(template_string)
+        self.mtime = None
+        self.loader = loader
+        self.code = code
+        self.compiled = compiled
+        self.streaming = streaming
+        self.dependencies = None
+        self.dependency_names = dependency_names
+        self._file = None
+        self._prepare()
+        return self
+
+    @property
+    def file(self):
+        if self._file is None:
+            reader = _TemplateReader(self.name, self.source)
+            try:
+                self._file = _File(self, _parse(reader, self))
+            except ParseError, e:
+                raise TemplateError("Error parsing template %s, line %d: %s" %
+                                    (self.name, reader.line, str(e)))
+        return self._file
+
+    def _module_name(self):
+        # The digest of the generated code tells apart templates that share
+        # a name, like every "<string>" template, in tracebacks.
+        digest = hashlib.sha1(escape.utf8(self.code)).hexdigest()
+        return "%s_%s" % (self.name.replace('.', '_'), digest[:12])
+
+    def _filename(self):
+        # Under python2.5, the fake filename used here must match
+        # the module name used in __name__ below.
+        return "%s.generated.py" % self._module_name()
+
+    def _prepare(self):
+        filename = self._filename()
+        # The generated source is handed to the traceback module once.
+        # Without an mtime, linecache.checkcache() leaves it alone.
+        linecache.cache[filename] = (len(self.code), None,
+                                     self.code.splitlines(True), filename)
+        module = {}
+        exec self.compiled in module
+        self._execute_code = module["_execute"].func_code
+        self._namespace = dict(_DEFAULT_NAMESPACE)
+        # __name__ and __loader__ allow the traceback mechanism to find
+        # the generated source code, should linecache be cleared.
+        self._namespace["__name__"] = self._module_name()
+        self._namespace["__loader__"] = ObjectDict(
+            get_source=lambda name: self.code)
+        self._namespace["_fragments"] = self.loader.fragment_cache \
+            if self.loader else FragmentCache()
 
     def generate(self, **kwargs):
-        """Generate this template with the given arguments."""
-        namespace = {
-            "escape": escape.xhtml_escape,
-            "xhtml_escape": escape.xhtml_escape,
-            "url_escape": escape.url_escape,
-            "json_encode": escape.json_encode,
-            "squeeze": escape.squeeze,
-            "linkify": escape.linkify,
-            "datetime": datetime,
-            "_utf8": escape.utf8,  # for internal use
-            "_string_types": (unicode_type, bytes_type),
-            # __name__ and __loader__ allow the traceback mechanism to find
-            # the generated source code.
-            "__name__": self.name.replace('.', '_'),
-            "__loader__": ObjectDict(get_source=lambda name: self.code),
-        }
-        namespace.update(self.namespace)
+        """Generate this template with the given arguments.
+
+        Asynchronous templates return a Deferred when they have to wait
+        for one.
+        """
+        return self._execute(kwargs)
+
+    def stream(self, write, **kwargs):
+        """Generate this template, passing the output to ``write`` at each
+        ``{% flush %}``.
+
+        Returns the output after the last flush, like generate() does.
+        ``streaming`` tells whether the template, or any template it
+        extends or includes, has ``{% flush %}``.
+        """
+        def flush(buffer):
+            if buffer:
+                write(escape.utf8('').join(buffer))
+                del buffer[:]
+
+        kwargs["_flush"] = flush
+        return self._execute(kwargs)
+
+    def _execute(self, kwargs):
+        namespace = self._namespace.copy()
+        if self.namespace:
+            namespace.update(self.namespace)
         namespace.update(kwargs)
-        exec self.compiled in namespace
-        execute = namespace["_execute"]
-        # Clear the traceback module's cache of source data now that
-        # we've generated a new template (mainly for this module's
-        # unittests, where different tests reuse the same name).
-        linecache.clearcache()
+        execute = types.FunctionType(self._execute_code, namespace)
+        if not self.asynchronous:
+            try:
+                return execute()
+            except:
+                raise TemplateError("Error executing template " + self.name +
+                ":\n" + _format_code(
+                    traceback.format_exception(*sys.exc_info())))
         try:
-            rv = execute()
+            rv = inlineCallbacks(execute)()
             assert isinstance(rv, Deferred), rv
             if hasattr(rv, "result"):
                 # Deferred is already resolved.
@@ -302,8 +490,15 @@ class Template(object):
             self.file.find_named_blocks(loader, named_blocks)
             writer = _CodeWriter(buffer, named_blocks, loader,
                                  ancestors[0].template,
-                                 compress_whitespace)
+                                 compress_whitespace, self.asynchronous)
             ancestors[0].generate(writer)
+            self.streaming = writer.streaming
+            # The templates whose source ends up in the generated code.
+            dependencies = writer.templates.union(
+                ancestor.template for ancestor in ancestors)
+            dependencies.discard(self)
+            self.dependencies = sorted(dependencies, key=lambda t: t.name)
+            self.dependency_names = [t.name for t in self.dependencies]
             return buffer.getvalue()
         finally:
             buffer.close()
@@ -321,7 +516,8 @@ class Template(object):
 
 class BaseLoader(object):
     """Base class for template loaders."""
-    def __init__(self, autoescape=_DEFAULT_AUTOESCAPE, namespace=None):
+    def __init__(self, autoescape=_DEFAULT_AUTOESCAPE, namespace=None,
+                 asynchronous=False, fragment_cache=None):
         """Creates a template loader.
 
         root_directory may be the empty string if this loader does not
@@ -329,8 +525,16 @@ class BaseLoader(object):
 
         autoescape must be either None or a string naming a function
         in the template namespace, such as "xhtml_escape".
+
+        asynchronous makes the templates of this loader wait for the
+        Deferreds returned by their expressions.
+
+        fragment_cache stores the output of ``{% cache %}`` blocks, it
+        defaults to a new `FragmentCache`.
         """
         self.autoescape = autoescape
+        self.asynchronous = asynchronous
+        self.fragment_cache = fragment_cache or FragmentCache()
         self.namespace = namespace or {}
         self.templates = {}
         # self.lock protects self.templates.  It's a reentrant lock
@@ -341,9 +545,25 @@ class BaseLoader(object):
         self.lock = threading.RLock()
 
     def reset(self):
-        """Resets the cache of compiled templates."""
+        """Resets the cache of compiled templates, and the fragments of
+        their ``{% cache %}`` blocks."""
         with self.lock:
             self.templates = {}
+            self._clear_fragments()
+
+    def check(self):
+        """Drops the compiled templates whose source may have changed.
+
+        Called before each request in debug mode. This loader cannot tell,
+        so it resets the whole cache.
+        """
+        self.reset()
+
+    def _clear_fragments(self):
+        # The fragments of a modified template would hide its changes.
+        d = self.fragment_cache.clear()
+        if isinstance(d, Deferred):
+            d.addErrback(log.err, "Fragment cache clear failed")
 
     def resolve_path(self, name, parent_path=None):
         """Converts a possibly-relative path to absolute (used internally)."""
@@ -367,10 +587,84 @@ class Loader(BaseLoader):
     You must use a template loader to use template constructs like
     {% extends %} and {% include %}. Loader caches all templates after
     they are loaded the first time.
+
+    With ``cache_path``, the compiled templates are also stored in that
+    directory, see `TemplateCache`.
+
+    check() only drops the templates whose file was modified, and the
+    ones that extend or include them. It compares the modification time
+    of every file read by the loader, unless ``watch`` is set and inotify
+    is available: the loader then watches the root directory from the
+    first call to check() on, and no longer calls stat.
     """
-    def __init__(self, root_directory, **kwargs):
+    def __init__(self, root_directory, cache_path=None, watch=False,
+                 **kwargs):
         super(Loader, self).__init__(**kwargs)
         self.root = os.path.abspath(root_directory)
+        self.cache = TemplateCache(cache_path) if cache_path else None
+        self.watch = watch and inotify is not None
+        self.mtimes = {}  # {name: mtime of the file when it was read}
+        self._notifier = None
+        self._modified = set()
+
+    def reset(self):
+        with self.lock:
+            self.templates = {}
+            self.mtimes = {}
+            self._modified = set()
+            self._clear_fragments()
+
+    def check(self):
+        """Drops the templates whose file was modified since it was read,
+        and the templates that extend or include them. The fragment cache
+        is cleared too.
+        """
+        with self.lock:
+            if self.watch and self._notifier is None:
+                self._start_watching()
+            if self._notifier is not None:
+                modified, self._modified = self._modified, set()
+            else:
+                modified = set(name for name, mtime in self.mtimes.items()
+                               if self._mtime(name) != mtime)
+            if not modified:
+                return
+            for name, template in self.templates.items():
+                if name in modified or \
+                   modified.intersection(template.dependency_names):
+                    del self.templates[name]
+            for name in modified:
+                self.mtimes.pop(name, None)
+            self._clear_fragments()
+
+    def _mtime(self, name):
+        try:
+            return os.path.getmtime(os.path.join(self.root, name))
+        except OSError:
+            return None
+
+    def _start_watching(self):
+        try:
+            notifier = inotify.INotify()
+        except Exception:
+            # Not supported on this system.
+            self.watch = False
+            return
+        notifier.startReading()
+        notifier.watch(FilePath(self.root),
+                       mask=inotify.IN_MODIFY | inotify.IN_ATTRIB |
+                       inotify.IN_CREATE | inotify.IN_DELETE |
+                       inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO,
+                       autoAdd=True, recursive=True,
+                       callbacks=[self._notify])
+        self._notifier = notifier
+        # Files may have changed before the watch was set up.
+        self._modified.update(name for name, mtime in self.mtimes.items()
+                              if self._mtime(name) != mtime)
+
+    def _notify(self, watch, path, mask):
+        with self.lock:
+            self._modified.add(os.path.relpath(path.path, self.root))
 
     def resolve_path(self, name, parent_path=None):
         if parent_path and not parent_path.startswith("<") and \
@@ -385,12 +679,262 @@ class Loader(BaseLoader):
 
     def _create_template(self, name):
         path = os.path.join(self.root, name)
+        # Taken before reading, a change made meanwhile is not missed.
+        mtime = os.path.getmtime(path)
         f = open(path, "rb")
-        template = Template(f.read(), name=name, loader=self)
+        source = f.read()
         f.close()
+        template = None
+        if self.cache is not None:
+            template = self.cache.load(self, name, source)
+        if template is None:
+            template = Template(source, name=name, loader=self)
+            if self.cache is not None:
+                self.cache.save(self, template)
+        template.mtime = mtime
+        self.mtimes[name] = mtime
+        for dependency in template.dependency_names:
+            # Those of a cached template may not be loaded.
+            if dependency not in self.mtimes:
+                self.mtimes[dependency] = self._mtime(dependency)
         return template
 
 
+class TemplateCache(object):
+    """Keeps the code compiled from the templates of a `Loader` on disk.
+
+    Each template is stored in its own file, named after the version of
+    cyclone and python, the settings of the loader and the name of the
+    template. The file holds the generated code, and the name,
+    modification time and SHA1 of the template and of every template it
+    extends or includes.
+
+    A stored template is used only if the modification time or else the
+    content of each of those files still matches. The root directory of
+    the loader is not part of the key, so templates compiled at build
+    time are used wherever the application is deployed.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def _filename(self, loader, name):
+        key = repr((__version__, imp.get_magic(), loader.autoescape,
+                    loader.asynchronous, name))
+        return os.path.join(self.path,
+                            hashlib.sha1(key).hexdigest() + ".template")
+
+    def _unchanged(self, loader, name, mtime, digest):
+        path = os.path.join(loader.root, name)
+        try:
+            if os.path.getmtime(path) == mtime:
+                return True
+            with open(path, "rb") as f:
+                return hashlib.sha1(f.read()).hexdigest() == digest
+        except (IOError, OSError):
+            return False
+
+    def load(self, loader, name, source):
+        """Returns the stored template, or None if it is missing or stale.
+        """
+        try:
+            with open(self._filename(loader, name), "rb") as f:
+                entry = marshal.load(f)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+
+        if entry["digest"] != hashlib.sha1(source).hexdigest():
+            return None
+        for dependency, mtime, digest in entry["dependencies"]:
+            if not self._unchanged(loader, dependency, mtime, digest):
+                return None
+        try:
+            return Template._from_cache(source, name, loader,
+                                        entry["autoescape"], entry["code"],
+                                        entry["compiled"], entry["streaming"],
+                                        [dependency for dependency, mtime,
+                                         digest in entry["dependencies"]])
+        except KeyError:
+            # Stored by an older version.
+            return None
+
+    def save(self, loader, template):
+        """Stores a template compiled by ``loader``.
+
+        Errors are ignored, the template is compiled again next time.
+        """
+        dependencies = []
+        for dependency in template.dependencies:
+            if dependency.mtime is None:
+                # Not loaded from a file of this loader.
+                return
+            dependencies.append((dependency.name, dependency.mtime,
+                                 hashlib.sha1(dependency.source).hexdigest()))
+        entry = {
+            "digest": hashlib.sha1(template.source).hexdigest(),
+            "dependencies": dependencies,
+            "autoescape": template.autoescape,
+            "code": template.code,
+            "compiled": template.compiled,
+            "streaming": template.streaming,
+        }
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            # Written to a temporary file first, concurrent readers never
+            # see half of it.
+            fd, path = tempfile.mkstemp(dir=self.path)
+            with os.fdopen(fd, "wb") as f:
+                marshal.dump(entry, f)
+            os.rename(path, self._filename(loader, template.name))
+        except (IOError, OSError, ValueError):
+            pass
+
+
+def precompile(root_directory, cache_path, **kwargs):
+    """Compiles all the templates under ``root_directory`` into the
+    cache at ``cache_path``. Keyword arguments are passed to `Loader`, and
+    must match the ones of the application for the cache to be used.
+
+    Returns a list of (name, error) of the templates that failed.
+    """
+    loader = Loader(root_directory, cache_path=cache_path, **kwargs)
+    errors = []
+    for path, dirs, files in os.walk(loader.root):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for filename in sorted(files):
+            if filename.startswith("."):
+                continue
+            name = os.path.relpath(os.path.join(path, filename), loader.root)
+            try:
+                loader.load(name)
+            except Exception, e:
+                errors.append((name, e))
+    return errors
+
+
+class FragmentCache(object):
+    """Keeps the output of ``{% cache %}`` blocks in memory.
+
+    Up to ``size`` fragments are kept, the least recently used one is
+    evicted first.
+
+    Other backends override get(), set() and clear(). Those which return
+    Deferreds must set ``asynchronous``, and can only be used by
+    asynchronous templates.
+    """
+    asynchronous = False
+
+    def __init__(self, size=1000):
+        self._fragments = LRUCache(size)  # {key: (expires, fragment)}
+        self._pending = {}  # {key: [Deferred]}, renders waiting for a key
+
+    def get(self, key):
+        """Returns the fragment stored under ``key``, or None."""
+        entry = self._fragments.get(key)
+        if entry is None:
+            return None
+        expires, fragment = entry
+        if expires and expires < time.time():
+            self._fragments.pop(key)
+            return None
+        return fragment
+
+    def set(self, key, fragment, ttl):
+        """Stores ``fragment`` under ``key`` for ``ttl`` seconds, or with no
+        expiration if ``ttl`` is 0."""
+        self._fragments[key] = (time.time() + ttl if ttl else 0, fragment)
+
+    def clear(self):
+        """Drops every fragment. Called when the loader drops templates."""
+        self._fragments.clear()
+
+    def lookup(self, key, wait=True):
+        """Returns the fragment stored under ``key`` (used internally).
+
+        Returns None if the caller has to render it, and then call store().
+        With ``wait``, the result may be a Deferred. If the fragment is
+        being rendered, it fires once it is stored.
+        """
+        if key in self._pending:
+            if not wait:
+                return None
+            d = Deferred()
+            self._pending[key].append(d)
+            return d
+        if self.asynchronous and not wait:
+            raise TemplateError("%s can only be used by asynchronous "
+                                "templates" % self.__class__.__name__)
+        self._pending[key] = []
+        fragment = self.get(key)
+        if isinstance(fragment, Deferred):
+            return fragment.addCallbacks(self._got, self._failed,
+                                         callbackArgs=(key,),
+                                         errbackArgs=(key,))
+        return self._got(fragment, key)
+
+    def _got(self, fragment, key):
+        if fragment is not None:
+            self._release(key, fragment)
+        return fragment
+
+    def _failed(self, failure, key):
+        log.err(failure, "Fragment cache lookup of %r failed" % (key,))
+        return None
+
+    def store(self, key, fragment, ttl):
+        """Stores a fragment rendered after lookup() returned None, and
+        hands it to the renders waiting for it (used internally).
+
+        If ``fragment`` is None, rendering failed and the waiting renders
+        render it themselves.
+        """
+        if fragment is not None:
+            try:
+                d = self.set(key, fragment, ttl)
+            except Exception:
+                log.err(None, "Fragment cache store of %r failed" % (key,))
+            else:
+                if isinstance(d, Deferred):
+                    d.addErrback(log.err, "Fragment cache store of %r "
+                                 "failed" % (key,))
+        self._release(key, fragment)
+
+    def _release(self, key, fragment):
+        for d in self._pending.pop(key, ()):
+            d.callback(fragment)
+
+
+class RedisFragmentCache(FragmentCache):
+    """Keeps the output of ``{% cache %}`` blocks in redis, where all the
+    processes of the application share it.
+
+    ``redis`` is a connection of `cyclone.redis`. Keys are prefixed with
+    ``prefix``.
+    """
+    asynchronous = True
+
+    def __init__(self, redis, prefix="fragment:"):
+        super(RedisFragmentCache, self).__init__()
+        self.redis = redis
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.redis.get("%s%s" % (self.prefix, key))
+
+    def set(self, key, fragment, ttl):
+        return self.redis.set("%s%s" % (self.prefix, key), fragment,
+                              expire=ttl or None)
+
+    @inlineCallbacks
+    def clear(self):
+        it = self.redis.scan_iter(pattern="%s*" % self.prefix, count=1000)
+        while True:
+            keys = yield it.next()
+            if keys is None:
+                break
+            yield self.redis.delete(keys)
+
+
 class DictLoader(BaseLoader):
     """A template loader that loads from a dictionary."""
     def __init__(self, dict, **kwargs):
@@ -433,19 +977,20 @@ class _File(_Node):
 
     def generate(self, writer):
         _write_line = lambda txt: writer.write_line(txt, self.line)
-        _write_line("from twisted.internet.defer import inlineCallbacks, returnValue, Deferred")
-        _write_line("")
-        _write_line("@inlineCallbacks")
         _write_line("def _execute():")
         with writer.indent():
-            # A workaround for the function to be considered a generator
-            _write_line("if 0:")
-            with writer.indent():
-                _write_line("yield None")
+            if writer.asynchronous:
+                # A workaround for the function to be considered a generator
+                _write_line("if 0:")
+                with writer.indent():
+                    _write_line("yield None")
             _write_line("_buffer = []")
             _write_line("_append = _buffer.append")
             self.body.generate(writer)
-            _write_line("returnValue(_utf8('').join(_buffer))")
+            if writer.asynchronous:
+                _write_line("returnValue(_utf8('').join(_buffer))")
+            else:
+                _write_line("return _utf8('').join(_buffer)")
 
     def each_child(self):
         return (self.body,)
@@ -546,12 +1091,60 @@ class _ApplyBlock(_Node):
         with writer.indent():
             writer.write_line("_buffer = []", self.line)
             writer.write_line("_append = _buffer.append", self.line)
+            writer.buffer_depth += 1
             self.body.generate(writer)
+            writer.buffer_depth -= 1
             writer.write_line("return _utf8('').join(_buffer)", self.line)
         writer.write_line("_append(_utf8(%s(%s())))" % (
             self.method, method_name), self.line)
 
 
+class _CacheBlock(_Node):
+    def __init__(self, key, ttl, line, body=None):
+        self.key = key
+        self.ttl = ttl
+        self.line = line
+        self.body = body
+
+    def each_child(self):
+        return (self.body,)
+
+    def generate(self, writer):
+        n = writer.apply_counter
+        writer.apply_counter += 1
+        fragment = "_fragment%d" % n
+        writer.write_line("_key%d = %s" % (n, self.key), self.line)
+        writer.write_line("_ttl%d = %s" % (n, self.ttl), self.line)
+        if writer.asynchronous:
+            writer.write_line("%s = _fragments.lookup(_key%d)" %
+                              (fragment, n), self.line)
+            self.maybe_deferred(fragment, writer)
+        else:
+            writer.write_line("%s = _fragments.lookup(_key%d, False)" %
+                              (fragment, n), self.line)
+        writer.write_line("if %s is None:" % fragment, self.line)
+        with writer.indent():
+            # The body is rendered inline, where it can wait for Deferreds,
+            # into a buffer of its own.
+            writer.write_line("_outer%d = _buffer" % n, self.line)
+            writer.write_line("_buffer = []", self.line)
+            writer.write_line("_append = _buffer.append", self.line)
+            writer.write_line("try:", self.line)
+            with writer.indent():
+                writer.buffer_depth += 1
+                self.body.generate(writer)
+                writer.buffer_depth -= 1
+                writer.write_line("%s = _utf8('').join(_buffer)" % fragment,
+                                  self.line)
+            writer.write_line("finally:", self.line)
+            with writer.indent():
+                writer.write_line("_buffer = _outer%d" % n, self.line)
+                writer.write_line("_append = _buffer.append", self.line)
+                writer.write_line("_fragments.store(_key%d, %s, _ttl%d)" %
+                                  (n, fragment, n), self.line)
+        writer.write_line("_append(_utf8(%s))" % fragment, self.line)
+
+
 class _ControlBlock(_Node):
     def __init__(self, statement, line, body=None):
         self.statement = statement
@@ -597,10 +1190,15 @@ class _Expression(_Node):
 
     def generate(self, writer):
         writer.write_line("_tmp = %s" % self.expression, self.line)
-        self.maybe_deferred("_tmp", writer)
-        writer.write_line("if isinstance(_tmp, _string_types):"
-                          " _tmp = _utf8(_tmp)", self.line)
-        writer.write_line("else: _tmp = _utf8(str(_tmp))", self.line)
+        if writer.asynchronous:
+            self.maybe_deferred("_tmp", writer)
+            writer.write_line("if isinstance(_tmp, _string_types):"
+                              " _tmp = _utf8(_tmp)", self.line)
+            writer.write_line("else: _tmp = _utf8(str(_tmp))", self.line)
+        else:
+            writer.write_line("if isinstance(_tmp, _string_types):"
+                              " _tmp = _utf8(_tmp)", self.line)
+            writer.write_line("else: _tmp = _utf8(_str(_tmp))", self.line)
         if not self.raw and writer.current_template.autoescape is not None:
             # In python3 functions like xhtml_escape return unicode,
             # so we have to convert to utf8 again.
@@ -609,6 +1207,18 @@ class _Expression(_Node):
         writer.write_line("_append(_tmp)", self.line)
 
 
+class _Flush(_Node):
+    def __init__(self, line):
+        self.line = line
+
+    def generate(self, writer):
+        # Apply and cache blocks have a buffer of their own, which cannot
+        # be sent.
+        if not writer.buffer_depth:
+            writer.streaming = True
+            writer.write_line("_flush(_buffer)", self.line)
+
+
 class _Module(_Expression):
     def __init__(self, expression, line):
         super(_Module, self).__init__("_modules." + expression, line,
@@ -645,13 +1255,18 @@ class TemplateError(Exception):
 
 class _CodeWriter(object):
     def __init__(self, file, named_blocks, loader, current_template,
-                 compress_whitespace):
+                 compress_whitespace, asynchronous=False):
         self.file = file
         self.named_blocks = named_blocks
         self.loader = loader
         self.current_template = current_template
         self.compress_whitespace = compress_whitespace
+        self.asynchronous = asynchronous
+        # All the templates included in the generated code.
+        self.templates = set()
         self.apply_counter = 0
+        self.buffer_depth = 0
+        self.streaming = False
         self.include_stack = []
         self._indent = 0
 
@@ -669,6 +1284,7 @@ class _CodeWriter(object):
 
     @contextlib.contextmanager
     def include(self, template, line):
+        self.templates.add(template)
         self.include_stack.append((self.current_template, line))
         self.current_template = template
         try:
@@ -854,7 +1470,8 @@ def _parse(reader, template, in_block=None, in_loop=None):
             return body
 
         elif operator in ("extends", "include", "set", "import", "from",
-                          "comment", "autoescape", "raw", "module", "super"):
+                          "comment", "autoescape", "raw", "module", "super",
+                          "flush"):
             if operator == "comment":
                 continue
             if operator == "extends":
@@ -888,6 +1505,8 @@ def _parse(reader, template, in_block=None, in_loop=None):
                 block = _Expression(suffix, line, raw=True)
             elif operator == "module":
                 block = _Module(suffix, line)
+            elif operator == "flush":
+                block = _Flush(line)
             elif operator == "super":
                 if in_block != "block":
                     raise ParseError("'super' block cannot be attached to 'block' block")
@@ -895,13 +1514,15 @@ def _parse(reader, template, in_block=None, in_loop=None):
             body.chunks.append(block)
             continue
 
-        elif operator in ("apply", "block", "try", "if", "for", "while"):
+        elif operator in ("apply", "block", "cache", "try", "if", "for",
+                          "while"):
             # parse inner body recursively
             if operator in ("for", "while"):
                 block_body = _parse(reader, template, operator, operator)
-            elif operator == "apply":
+            elif operator in ("apply", "cache"):
                 # apply creates a nested function so syntactically it's not
-                # in the loop.
+                # in the loop. The output of cache must be stored, which
+                # break and continue would skip.
                 block_body = _parse(reader, template, operator, None)
             else:
                 block_body = _parse(reader, template, operator, in_loop)
@@ -915,6 +1536,17 @@ def _parse(reader, template, in_block=None, in_loop=None):
                 if not suffix:
                     raise ParseError("block missing name on line %d" % line)
                 block = _NamedBlock(suffix, block_body, template, line)
+            elif operator == "cache":
+                key, space, ttl = suffix.rpartition(" ")
+                try:
+                    # A key with a space and no ttl does not split into
+                    # two expressions.
+                    compile(key.strip(), "<cache key>", "eval")
+                    compile(ttl, "<cache ttl>", "eval")
+                except SyntaxError:
+                    raise ParseError("cache missing key or ttl on line %d" %
+                                     line)
+                block = _CacheBlock(key.strip(), ttl, line, block_body)
             else:
                 block = _ControlBlock(contents, line, block_body)
             body.chunks.append(block)
@@ -929,3 +1561,63 @@ def _parse(reader, template, in_block=None, in_loop=None):
 
         else:
             raise ParseError("unknown operator: %r" % operator)
+
+
+def usage():
+    print("""usage: cyclone templates --precompile [options] PATH [PATH...]
+Options:
+ -h --help              Show this help.
+ -p --precompile        Compile the templates under each PATH.
+ -c --cache=PATH        Directory of the compiled templates, the
+                        template_cache_path setting of the application.
+ -a --autoescape=NAME   Autoescape function of the application, or None
+                        [default: xhtml_escape]
+ -s --asynchronous      The application uses asynchronous templates.
+
+Examples:
+ $ cyclone templates --precompile --cache=/var/cache/foobar templates/""")
+    sys.exit(0)
+
+
+def main():
+    precompile_templates = False
+    cache_path = None
+    kwargs = {}
+
+    shortopts = "hpc:a:s"
+    longopts = ["help", "precompile", "cache=", "autoescape=",
+                "asynchronous"]
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], shortopts, longopts)
+    except getopt.GetoptError:
+        usage()
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+
+        elif o in ("-p", "--precompile"):
+            precompile_templates = True
+
+        elif o in ("-c", "--cache"):
+            cache_path = a
+
+        elif o in ("-a", "--autoescape"):
+            kwargs["autoescape"] = None if a == "None" else a
+
+        elif o in ("-s", "--asynchronous"):
+            kwargs["asynchronous"] = True
+
+    if not precompile_templates or cache_path is None or not args:
+        usage()
+
+    failed = False
+    for root_directory in args:
+        for name, error in precompile(root_directory, cache_path, **kwargs):
+            print("%s: %s" % (os.path.join(root_directory, name), error))
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1920 @@
+# coding: utf-8
+#
+# Copyright 2010 Alexandre Fiori
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import binascii
+import gc
+import hashlib
+import struct
+
+from twisted.internet import defer
+from twisted.internet import protocol
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.trial import unittest
+from twisted.test.proto_helpers import StringTransport
+from mock import Mock
+
+from cyclone import redis
+
+
+class FakeFactory(object):
+    convertNumbers = True
+    password = None
+    dbid = None
+    addConnection = delConnection = lambda self, conn: None
+
+
+class BaseRedisProtocolTest(unittest.TestCase):
+    protocol = redis.BaseRedisProtocol
+
+    def setUp(self):
+        self.proto = self.protocol()
+        self.proto.factory = FakeFactory()
+        self.proto.makeConnection(StringTransport())
+        self.replies = []
+        self.proto.replyReceived = self.replies.append
+
+    def feed(self, data, chunk_size=None):
+        if chunk_size is None:
+            self.proto.dataReceived(data)
+        else:
+            for x in xrange(0, len(data), chunk_size):
+                self.proto.dataReceived(data[x:x + chunk_size])
+
+    def test_simple_replies(self):
+        self.feed("+OK\r\n:42\r\n$3\r\nfoo\r\n$-1\r\n*-1\r\n*0\r\n")
+        self.assertEqual(self.replies, ["OK", 42, u"foo", None, None, []])
+
+    def test_error(self):
+        self.feed("-ERR unknown command\r\n")
+        self.assertIsInstance(self.replies[0], redis.ResponseError)
+        self.assertEqual(self.replies[0].args[0], "ERR unknown command")
+
+    def test_invalid_integer(self):
+        self.feed(":abc\r\n")
+        self.assertIsInstance(self.replies[0], redis.InvalidResponse)
+
+    def test_conversion(self):
+        self.feed("$2\r\n12\r\n$3\r\n1.5\r\n$2\r\n\xc3\xa9\r\n"
+                  "$2\r\n\xff\xfe\r\n")
+        self.assertEqual(self.replies, [12, 1.5, u"\xe9", "\xff\xfe"])
+
+    def test_nested_multi_bulk(self):
+        data = ("*3\r\n$1\r\na\r\n*2\r\n:1\r\n*0\r\n"
+                "*2\r\n$-1\r\n-ERR x\r\n")
+        self.feed(data)
+        self.assertEqual(len(self.replies), 1)
+        a, (one, empty), (none, error) = self.replies[0]
+        self.assertEqual((a, one, empty, none), (u"a", 1, [], None))
+        self.assertIsInstance(error, redis.ResponseError)
+
+    def test_byte_by_byte(self):
+        data = "*2\r\n$5\r\nhello\r\n$7\r\nwo\r\nrld\r\n+OK\r\n"
+        self.feed(data, chunk_size=1)
+        self.assertEqual(self.replies, [[u"hello", u"wo\r\nrld"], "OK"])
+
+    def test_big_bulk_in_chunks(self):
+        value = "x" * 100000
+        self.feed("$%d\r\n%s\r\n:1\r\n" % (len(value), value),
+                  chunk_size=4096)
+        self.assertEqual(self.replies, [value, 1])
+
+    def test_queued(self):
+        self.feed("+QUEUED\r\n+QUEUED\r\n")
+        self.assertEqual(self.proto.transactions, 2)
+
+
+class RawRepliesTest(unittest.TestCase):
+    protocol = redis.BaseRedisProtocol
+
+    def setUp(self):
+        self.proto = self.protocol()
+        self.proto.factory = FakeFactory()
+        self.proto.makeConnection(StringTransport())
+
+    def test_raw_call(self):
+        a = self.proto.get("a")
+        b = self.proto.raw().mget(["b", "c"])
+        c = self.proto.get("c")
+        self.proto.dataReceived("$2\r\n12\r\n*2\r\n$2\r\n12\r\n$2\r\n\xc3\xa9\r\n"
+                                "$2\r\n\xc3\xa9\r\n")
+        self.assertEqual(self.successResultOf(a), 12)
+        self.assertEqual(self.successResultOf(b), ["12", "\xc3\xa9"])
+        self.assertEqual(self.successResultOf(c), u"\xe9")
+        self.assertFalse(self.proto.rawReplies)
+
+    def test_raw_chunks(self):
+        value = "1" * 10000
+        d = self.proto.raw().get("a")
+        data = "$%d\r\n%s\r\n" % (len(value), value)
+        for x in xrange(0, len(data), 4096):
+            self.proto.dataReceived(data[x:x + 4096])
+        self.assertEqual(self.successResultOf(d), value)
+
+    def test_raw_connection(self):
+        self.proto.charset = None
+        self.proto.factory.convertNumbers = False
+        self.proto.tryConvertData = Mock()
+        d = self.proto.lrange("a", 0, -1)
+        self.proto.dataReceived("*3\r\n$1\r\n1\r\n$1\r\n\xff\r\n$-1\r\n")
+        self.assertEqual(self.successResultOf(d), ["1", "\xff", None])
+        self.assertFalse(self.proto.tryConvertData.called)
+
+    def test_nested(self):
+        d = self.proto.execute_command("SCAN", 0)
+        self.proto.dataReceived("*2\r\n$1\r\n5\r\n*2\r\n$2\r\n\xc3\xa9\r\n"
+                                "-ERR x\r\n")
+        cursor, (key, error) = self.successResultOf(d)
+        self.assertEqual((cursor, key), (5, u"\xe9"))
+        self.assertIsInstance(error, redis.ResponseError)
+
+    def test_queued(self):
+        self.proto.factory.convertNumbers = False
+        self.proto.inTransaction = True
+        self.proto.post_proc = [None]
+        replies = [self.proto.raw().get("a"), self.proto.get("b"),
+                   self.proto.execute_command("EXEC")]
+        self.proto.dataReceived("+QUEUED\r\n+QUEUED\r\n"
+                                "*2\r\n$1\r\n1\r\n$1\r\n2\r\n")
+        self.assertEqual([self.successResultOf(d) for d in replies],
+                         ["QUEUED", "QUEUED", [u"1", u"2"]])
+
+    def test_connection_handler(self):
+        factory = redis.RedisFactory("test", None, 1, isLazy=True)
+        proto = factory.buildProtocol(None)
+        proto.makeConnection(StringTransport())
+        raw = factory.handler.raw().get("a")
+        decoded = factory.handler.get("a")
+        proto.dataReceived("$2\r\n\xc3\xa9\r\n$2\r\n\xc3\xa9\r\n")
+        self.assertEqual(self.successResultOf(raw), "\xc3\xa9")
+        self.assertEqual(self.successResultOf(decoded), u"\xe9")
+
+
+class HiredisRawRepliesTest(RawRepliesTest):
+    protocol = redis.HiredisProtocol
+    if redis.hiredis is None:
+        skip = "hiredis is not installed"
+
+
+class AutoPipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.factory = redis.RedisFactory("test", None, 2, isLazy=True,
+                                          autoPipeline=True)
+        self.connections = [self.connect() for x in range(2)]
+
+    def connect(self):
+        proto = self.factory.buildProtocol(None)
+        proto.callLater = self.clock.callLater
+        transport = StringTransport()
+        transport.writeSequence = Mock(side_effect=transport.writeSequence)
+        proto.makeConnection(transport)
+        proto.transport._clock = self.clock
+        return proto
+
+    def test_commands_share_connections(self):
+        rc = self.factory.handler
+        replies = [rc.get("k%d" % x) for x in range(4)]
+        self.assertEqual(len(self.factory.connectionQueue.pending), 2)
+        self.clock.advance(0)
+        for proto in self.connections:
+            transport = proto.transport.transport
+            self.assertEqual(transport.writeSequence.call_count, 1)
+            self.assertEqual(transport.value().count("GET"), 2)
+            proto.dataReceived("$1\r\na\r\n$1\r\nb\r\n")
+        results = []
+        defer.gatherResults(replies).addCallback(results.extend)
+        self.assertEqual(sorted(results), [u"a", u"a", u"b", u"b"])
+
+    def test_errors(self):
+        d = self.factory.handler.get("k")
+        self.clock.advance(0)
+        for proto in self.connections:
+            if proto.transport.transport.value():
+                proto.dataReceived("-ERR wrong type\r\n")
+        return self.assertFailure(d, redis.ResponseError)
+
+    def test_exclusive_commands(self):
+        rc = self.factory.handler
+        rc.blpop("queue")
+        self.assertEqual(len(self.factory.connectionQueue.pending), 1)
+        rc.get("k")
+        rc.get("k")
+        self.clock.advance(0)
+        blocked = [p for p in self.connections
+                   if "BLPOP" in p.transport.transport.value()][0]
+        self.assertNotIn("GET", blocked.transport.transport.value())
+
+
+    def test_exclusive_waits_for_shared_replies(self):
+        self.factory = redis.RedisFactory("test", None, 1, isLazy=True,
+                                          autoPipeline=True)
+        proto = self.connect()
+        transport = proto.transport.transport
+        rc = self.factory.handler
+        lrange = rc.lrange("list", 0, -1)
+        d = rc.multi()
+        self.clock.advance(0)
+        self.assertIn("LRANGE", transport.value())
+        self.assertNotIn("MULTI", transport.value())
+
+        proto.dataReceived("*2\r\n$1\r\na\r\n$1\r\nb\r\n")
+        self.assertEqual(self.successResultOf(lrange), [u"a", u"b"])
+        self.clock.advance(0)
+        self.assertIn("MULTI", transport.value())
+        proto.dataReceived("+OK\r\n")
+        tx = self.successResultOf(d)
+        self.assertTrue(tx.inTransaction)
+
+        # The connection is not shared while in the transaction.
+        transport.clear()
+        get = rc.get("k")
+        self.clock.advance(0)
+        self.assertEqual(transport.value(), "")
+        tx.set("k", "v")
+        tx.commit()
+        self.clock.advance(0)
+        proto.dataReceived("+QUEUED\r\n*1\r\n+OK\r\n")
+        self.assertFalse(tx.inTransaction)
+        self.clock.advance(0)
+        self.assertIn("GET", transport.value())
+        proto.dataReceived("$1\r\nv\r\n")
+        self.assertEqual(self.successResultOf(get), u"v")
+
+    def test_exclusive_does_not_wait_for_callbacks(self):
+        self.factory = redis.RedisFactory("test", None, 1, isLazy=True,
+                                          autoPipeline=True)
+        proto = self.connect()
+        transport = proto.transport.transport
+        rc = self.factory.handler
+        slow = defer.Deferred()
+        rc.get("k").addCallback(lambda value: slow)
+        d = rc.multi()
+        self.clock.advance(0)
+        self.assertEqual(proto.pendingReplies, 1)
+
+        # MULTI is sent once the reply arrives, while its callback waits.
+        proto.dataReceived("$1\r\nv\r\n")
+        self.clock.advance(0)
+        self.assertIn("MULTI", transport.value())
+        proto.dataReceived("+OK\r\n")
+        self.assertTrue(self.successResultOf(d).inTransaction)
+        self.assertEqual(proto.pendingReplies, 0)
+
+
+class ScriptTest(unittest.TestCase):
+    source = "return redis.call('INCRBY', KEYS[1], ARGV[1])"
+
+    def setUp(self):
+        self.proto = redis.RedisProtocol()
+        self.proto.factory = FakeFactory()
+        self.transport = StringTransport()
+        self.proto.makeConnection(self.transport)
+        self.script = self.proto.register_script(self.source)
+
+    def sent(self):
+        value = self.transport.value()
+        self.transport.clear()
+        return value
+
+    def test_evalsha(self):
+        d = self.script(["counter"], [2])
+        sent = self.sent()
+        self.assertIn("EVALSHA", sent)
+        self.assertIn(self.script.sha, sent)
+        self.assertNotIn(self.source, sent)
+        self.proto.dataReceived(":2\r\n")
+        self.assertEqual(self.successResultOf(d), 2)
+
+    def test_reload(self):
+        d = self.script(["counter"], [2])
+        self.sent()
+        self.proto.dataReceived("-NOSCRIPT No matching script.\r\n")
+        self.assertIn(self.source, self.sent())
+        self.proto.dataReceived(":2\r\n")
+        self.assertEqual(self.successResultOf(d), 2)
+        self.assertIn(self.script.sha, self.proto.script_hashes)
+
+        # After SCRIPT FLUSH or a restart of redis.
+        d = self.script(["counter"], [2])
+        self.assertNotIn(self.source, self.sent())
+        self.proto.dataReceived("-NOSCRIPT No matching script.\r\n")
+        self.assertIn(self.source, self.sent())
+        self.proto.dataReceived(":4\r\n")
+        self.assertEqual(self.successResultOf(d), 4)
+
+    def test_other_errors(self):
+        d = self.script(["counter"], [2])
+        self.proto.dataReceived("-ERR value is not an integer\r\n")
+        self.failureResultOf(d, redis.ResponseError)
+        self.assertNotIn("EVAL ", self.sent().replace("EVALSHA", ""))
+
+    def test_pipeline(self):
+        self.proto.pipeline()
+        self.script(["a"], [1], client=self.proto)
+        self.script(["b"], [1], client=self.proto)
+        d = self.proto.execute_pipeline()
+        sent = self.sent()
+        self.assertEqual(sent.count(self.source), 1)
+        self.assertEqual(sent.count("EVALSHA"), 1)
+        self.proto.dataReceived(":1\r\n:1\r\n")
+        self.assertEqual(self.successResultOf(d), [1, 1])
+
+        self.proto.pipeline()
+        self.script(["a"], [1], client=self.proto)
+        self.proto.execute_pipeline()
+        self.assertNotIn(self.source, self.sent())
+
+    def test_connection_handler(self):
+        factory = redis.RedisFactory("test", None, 1, isLazy=True)
+        script = factory.handler.register_script(self.source)
+        self.assertIsInstance(script, redis.Script)
+        self.assertEqual(script.sha, self.script.sha)
+        proto = factory.buildProtocol(None)
+        proto.makeConnection(StringTransport())
+        d = script(["counter"], [2])
+        proto.dataReceived("-NOSCRIPT No matching script.\r\n:2\r\n")
+        self.assertEqual(self.successResultOf(d), 2)
+
+
+class PoolTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.connectors = []
+
+    def makeFactory(self, poolsize=1, **kwargs):
+        self.factory = redis.RedisFactory("test", None, poolsize, isLazy=True,
+                                          **kwargs)
+        self.factory.clock = self.clock
+        self.factory.connect = self.connectLater
+        for x in range(poolsize):
+            self.connect(self.connectLater())
+        return self.factory.handler
+
+    def connectLater(self):
+        connector = Mock()
+        self.connectors.append(connector)
+        return connector
+
+    def connect(self, connector):
+        self.connectors.remove(connector)
+        proto = self.factory.buildProtocol(None)
+        transport = StringTransport()
+        transport.connector = connector
+        proto.makeConnection(transport)
+        return proto
+
+    def test_grows_on_demand(self):
+        rc = self.makeFactory(maxsize=3)
+        first = self.factory.pool[0]
+        rc.get("a")
+        self.assertEqual(self.connectors, [])
+        b = rc.get("b")
+        c = rc.get("c")
+        rc.get("d")
+        self.assertEqual(len(self.connectors), 2)
+        stats = self.factory.stats()
+        self.assertEqual((stats["waiters"], stats["connecting"]), (3, 2))
+
+        second = self.connect(self.connectors[0])
+        self.assertIn("b", second.transport.value())
+        second.dataReceived("$1\r\nb\r\n")
+        self.assertEqual(self.successResultOf(b), u"b")
+        self.assertIn("c", second.transport.value())
+        self.assertNoResult(c)
+        first.dataReceived("$1\r\na\r\n")
+        self.assertIn("d", first.transport.value())
+        stats = self.factory.stats()
+        self.assertEqual((stats["size"], stats["in_use"], stats["idle"]),
+                         (2, 2, 0))
+
+    def test_acquire_timeout(self):
+        rc = self.makeFactory(acquireTimeout=5)
+        rc.get("a")
+        d = rc.get("b")
+        self.clock.advance(4)
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.failureResultOf(d, redis.PoolTimeoutError)
+        self.assertEqual(self.factory.stats()["waiters"], 0)
+
+    def test_cancel_while_waiting(self):
+        rc = self.makeFactory(acquireTimeout=5)
+        rc.get("a")
+        d = rc.get("b")
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_command_timeout(self):
+        rc = self.makeFactory(commandTimeout=2)
+        proto = self.factory.pool[0]
+        d = rc.get("a")
+        self.clock.advance(2)
+        self.failureResultOf(d, redis.CommandTimeoutError)
+        self.assertEqual(self.factory.stats()["idle"], 0)
+
+        # The late reply is read, and the connection goes back to the pool.
+        d = rc.get("b")
+        proto.dataReceived("$4\r\nlate\r\n")
+        self.assertNoResult(d)
+        proto.dataReceived("$1\r\nb\r\n")
+        self.assertEqual(self.successResultOf(d), u"b")
+
+    def test_command_timeout_blocking(self):
+        rc = self.makeFactory(commandTimeout=2)
+        d = rc.blpop("queue")
+        self.clock.advance(10)
+        self.assertNoResult(d)
+
+    def test_idle_eviction(self):
+        rc = self.makeFactory(maxsize=3, idleTimeout=60)
+        rc.get("a")
+        rc.get("b")
+        for connector in list(self.connectors):
+            self.connect(connector)
+        for proto in self.factory.pool:
+            proto.dataReceived("$1\r\nx\r\n")
+        self.assertEqual(self.factory.stats()["idle"], 2)
+
+        self.clock.advance(60)
+        closed = [p for p in self.factory.pool if p.transport.disconnecting]
+        self.assertEqual(len(closed), 1)
+        self.assertEqual(self.factory.stats()["idle"], 1)
+
+        connector = closed[0].transport.connector
+        closed[0].connectionLost(None)
+        self.factory.clientConnectionLost(connector, None)
+        self.assertFalse(connector.connect.called)
+        self.assertEqual(self.factory.size, 1)
+        self.clock.advance(60)
+        self.assertFalse(self.factory.pool[0].transport.disconnecting)
+
+    def test_ping(self):
+        self.makeFactory(pingInterval=10)
+        proto = self.factory.pool[0]
+        self.clock.advance(10)
+        self.assertIn("PING", proto.transport.value())
+        self.assertEqual(self.factory.stats()["idle"], 0)
+        proto.dataReceived("+PONG\r\n")
+        self.assertEqual(self.factory.stats()["idle"], 1)
+
+        proto.transport.clear()
+        self.clock.advance(10)
+        self.assertIn("PING", proto.transport.value())
+        self.clock.advance(10)
+        self.assertTrue(proto.transport.disconnecting)
+
+    def test_drain(self):
+        rc = self.makeFactory(poolsize=2)
+        first, second = self.factory.pool
+        a = rc.get("a")
+        b = rc.get("b")
+        c = rc.get("c")
+        self.factory.drain()
+        self.failureResultOf(c, defer.CancelledError)
+        self.assertFalse(first.transport.disconnecting)
+        self.assertFalse(second.transport.disconnecting)
+        second.dataReceived("$1\r\nb\r\n")
+        self.assertEqual(self.successResultOf(b), u"b")
+        self.assertTrue(second.transport.disconnecting)
+        first.dataReceived("$1\r\na\r\n")
+        self.assertEqual(self.successResultOf(a), u"a")
+        self.assertTrue(first.transport.disconnecting)
+        self.assertEqual(self.factory.continueTrying, 0)
+
+    def test_wait_histogram(self):
+        rc = self.makeFactory()
+        rc.get("a")
+        d = rc.get("b")
+        self.clock.advance(0.2)
+        self.factory.pool[0].dataReceived("$1\r\na\r\n")
+        self.assertNoResult(d)
+        histogram = dict(self.factory.stats()["wait_histogram"])
+        self.assertEqual(histogram[0.001], 1)
+        self.assertEqual(histogram[0.5], 1)
+        self.assertEqual(sum(histogram.values()), 2)
+
+
+class BlockingPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.connectors = []
+        self.factory = redis.RedisFactory("test", None, 1, isLazy=True)
+        self.factory.clock = self.clock
+        self.factory.blocking = self.factory.makeBlockingPool()
+        self.factory.blocking.connect = self.connectLater
+        self.rc = self.factory.handler
+        self.proto = self.connect(self.factory)
+
+    def connectLater(self):
+        connector = Mock()
+        self.connectors.append(connector)
+        return connector
+
+    def connect(self, factory, connector=None):
+        if connector is not None:
+            self.connectors.remove(connector)
+        proto = factory.buildProtocol(None)
+        transport = StringTransport()
+        transport.connector = connector
+        proto.makeConnection(transport)
+        return proto
+
+    def test_shared_pool_is_not_used(self):
+        d = self.rc.blpop("queue")
+        self.assertEqual(len(self.connectors), 1)
+        blocked = self.connect(self.factory.blocking, self.connectors[0])
+        self.assertIn("BLPOP", blocked.transport.value())
+        self.assertNoResult(d)
+
+        get = self.rc.get("a")
+        self.assertIn("GET", self.proto.transport.value())
+        self.assertNotIn("BLPOP", self.proto.transport.value())
+        self.proto.dataReceived("$1\r\na\r\n")
+        self.assertEqual(self.successResultOf(get), u"a")
+
+        blocked.dataReceived("*2\r\n$5\r\nqueue\r\n$3\r\njob\r\n")
+        self.assertEqual(self.successResultOf(d), [u"queue", u"job"])
+        self.assertEqual(self.factory.stats()["blocking"], 1)
+
+    def test_grows_per_caller(self):
+        self.rc.blpop("a")
+        self.rc.brpop("b")
+        self.rc.brpoplpush("c", "d")
+        self.assertEqual(len(self.connectors), 3)
+
+    def test_connection_reused(self):
+        d = self.rc.blpop("queue")
+        blocked = self.connect(self.factory.blocking, self.connectors[0])
+        blocked.dataReceived("*-1\r\n")
+        self.assertEqual(self.successResultOf(d), None)
+        blocked.transport.clear()
+        self.rc.brpop("queue")
+        self.assertEqual(self.connectors, [])
+        self.assertIn("BRPOP", blocked.transport.value())
+
+    def test_cancel_closes_connection(self):
+        d = self.rc.blpop("queue")
+        connector = self.connectors[0]
+        blocked = self.connect(self.factory.blocking, connector)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertTrue(blocked.transport.disconnecting)
+        self.assertEqual(self.factory.blocking.stats()["idle"], 0)
+
+        blocked.connectionLost(None)
+        self.factory.blocking.clientConnectionLost(connector, None)
+        self.assertFalse(connector.connect.called)
+        self.assertEqual(self.factory.blocking.size, 0)
+
+    def test_cancel_while_connecting(self):
+        d = self.rc.blpop("queue")
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        blocked = self.connect(self.factory.blocking, self.connectors[0])
+        self.assertEqual(blocked.transport.value(), "")
+        self.assertEqual(self.factory.blocking.stats()["idle"], 1)
+
+    def test_idle_connections_closed(self):
+        d = self.rc.blpop("queue")
+        blocked = self.connect(self.factory.blocking, self.connectors[0])
+        blocked.dataReceived("*-1\r\n")
+        self.successResultOf(d)
+        self.clock.advance(self.factory.blockingIdleTimeout)
+        self.assertTrue(blocked.transport.disconnecting)
+
+
+class ScanIteratorTest(unittest.TestCase):
+    def setUp(self):
+        self.requests = []
+
+    def scan(self, cursor, pattern=None, count=None):
+        d = defer.Deferred()
+        self.requests.append((cursor, d))
+        return d
+
+    def reply(self, cursor, items):
+        self.requests[-1][1].callback([cursor, items])
+
+    def test_batches(self):
+        it = redis.ScanIterator(self.scan)
+        batches = []
+        it.next().addCallback(batches.append)
+        self.reply(7, ["a", "b"])
+        self.assertEqual(batches, [["a", "b"]])
+        it.next().addCallback(batches.append)
+        self.assertEqual(self.requests[-1][0], 7)
+        self.reply(9, [])
+        self.reply(0, ["c"])
+        it.next().addCallback(batches.append)
+        self.assertEqual(batches, [["a", "b"], ["c"], None])
+        self.assertEqual(len(self.requests), 3)
+        self.assertTrue(it.finished)
+
+    def test_concurrent_next(self):
+        it = redis.ScanIterator(self.scan)
+        batches = []
+        for x in range(3):
+            it.next().addCallback(batches.append)
+        self.reply(1, ["a"])
+        self.reply(0, ["b"])
+        self.assertEqual(batches, [["a"], ["b"], None])
+
+    def test_bounded_prefetch(self):
+        it = redis.ScanIterator(self.scan, prefetch=2)
+        self.reply(1, ["a"])
+        self.reply(2, ["b"])
+        self.assertEqual(len(self.requests), 2)
+        batches = []
+        it.next().addCallback(batches.append)
+        self.assertEqual(batches, [["a"]])
+        self.assertEqual(len(self.requests), 3)
+
+    def test_cancel(self):
+        it = redis.ScanIterator(self.scan)
+        d = it.next()
+        d.cancel()
+        self.assertFailure(d, defer.CancelledError)
+        self.reply(1, ["a"])
+        self.assertEqual(len(self.requests), 1)
+        batches = []
+        it.next().addCallback(batches.append)
+        self.assertEqual(batches, [None])
+
+    def test_failure(self):
+        it = redis.ScanIterator(self.scan)
+        d = it.next()
+        self.requests[-1][1].errback(redis.ResponseError("ERR x"))
+        return self.assertFailure(d, redis.ResponseError)
+
+    def test_mixin(self):
+        conn = redis.ScanIteratorMixin()
+        conn.hscan = Mock(return_value=defer.succeed([0, ["f", 1, "g", 2]]))
+        conn.zscan = Mock(return_value=defer.succeed([0, ["m", "1.5"]]))
+        batches = []
+        conn.hscan_iter("h", count=100).next().addCallback(batches.append)
+        conn.hscan.assert_called_once_with("h", 0, None, 100)
+        conn.zscan_iter("z").next().addCallback(batches.append)
+        self.assertEqual(batches, [[("f", 1), ("g", 2)], [("m", 1.5)]])
+
+
+class PipelineCheckoutTest(unittest.TestCase):
+    def setUp(self):
+        self.factory = redis.RedisFactory("test", None, 1, isLazy=True)
+        self.proto = self.factory.buildProtocol(None)
+        self.proto.makeConnection(StringTransport())
+
+    def test_connection_held_until_executed(self):
+        pipe = []
+        self.factory.handler.pipeline().addCallback(pipe.append)
+        self.assertEqual(len(self.factory.connectionQueue.pending), 0)
+        pipe[0].set("a", 1)
+        pipe[0].execute_pipeline()
+        self.proto.dataReceived("+OK\r\n")
+        self.assertEqual(len(self.factory.connectionQueue.pending), 1)
+
+
+class FakeNode(object):
+    """A shard that stores keys in a dict, and records its pipelines."""
+    def __init__(self, uuid):
+        self._factory = Mock()
+        self._factory.uuid = uuid
+        self.data = {}
+        self.pipelines = []
+
+    def get(self, key):
+        return defer.succeed(self.data.get(key))
+
+    def set(self, key, value):
+        self.data[key] = value
+        return defer.succeed("OK")
+
+    def mget(self, keys):
+        return defer.succeed([self.data.get(k) for k in keys])
+
+    def mset(self, mapping):
+        self.data.update(mapping)
+        return defer.succeed("OK")
+
+    def delete(self, keys):
+        found = [k for k in keys if self.data.pop(k, None) is not None]
+        return defer.succeed(len(found))
+
+    def scan(self, cursor=0, pattern=None, count=None):
+        # One key per page, the cursor is the position of the next key.
+        keys = sorted(self.data)
+        cursor = int(cursor)
+        following = cursor + 1 if cursor + 1 < len(keys) else 0
+        return defer.succeed([str(following), keys[cursor:cursor + 1]])
+
+    def pipeline(self):
+        node = self
+
+        class Pipeline(object):
+            def __init__(self):
+                self.commands = []
+
+            def __getattr__(self, method):
+                return lambda *args: self.commands.append((method, args))
+
+            def execute_pipeline(self):
+                node.pipelines.append(self.commands)
+                return defer.gatherResults(
+                    [getattr(node, method)(*args)
+                     for method, args in self.commands])
+
+        return defer.succeed(Pipeline())
+
+
+class HashRingTest(unittest.TestCase):
+    keys = ["user:%d" % x for x in xrange(20000)]
+
+    def setUp(self):
+        self.nodes = [FakeNode("127.0.0.1:%d" % (6379 + x)) for x in range(4)]
+
+    def assertEvenDistribution(self, ring, nodes, tolerance):
+        counts = dict((node, 0) for node in nodes)
+        for key in self.keys:
+            counts[ring(key)] += 1
+        expected = len(self.keys) / float(len(nodes))
+        for node, count in counts.items():
+            self.assertTrue(abs(count - expected) < expected * tolerance,
+                            "%s got %d keys, expected ~%d" %
+                            (node._factory.uuid, count, expected))
+
+    def assertMovedTo(self, before, ring, node):
+        moved = [k for k in self.keys if before[k] is not ring(k)]
+        for key in moved:
+            self.assertIs(ring(key), node)
+        return len(moved) / float(len(self.keys))
+
+    def test_invalid_mode(self):
+        self.assertRaises(ValueError, redis.HashRing, self.nodes, mode="md4")
+
+    def test_empty(self):
+        ring = redis.HashRing([])
+        self.assertEqual(ring("foo"), None)
+        self.assertEqual(ring.get_node_pos("foo"), [None, None])
+
+    def test_distribution(self):
+        # ketama hashes 4 points at once, they spread a bit less.
+        for mode, tolerance in (("crc32", 0.1), ("ketama", 0.25),
+                                ("jump", 0.05)):
+            self.assertEvenDistribution(
+                redis.HashRing(self.nodes, mode=mode), self.nodes, tolerance)
+
+    def test_add_and_remove_node(self):
+        for mode in redis.HashRing.modes:
+            ring = redis.HashRing(self.nodes[:3], mode=mode)
+            before = dict((k, ring(k)) for k in self.keys)
+            ring.add_node(self.nodes[3])
+            self.assertEqual(ring.nodes, self.nodes)
+            moved = self.assertMovedTo(before, ring, self.nodes[3])
+            self.assertTrue(0.15 < moved < 0.35,
+                            "%s moved %.2f of the keys" % (mode, moved))
+            ring.remove_node(self.nodes[3])
+            self.assertEqual(ring.nodes, self.nodes[:3])
+            self.assertEqual(self.assertMovedTo(before, ring, None), 0)
+
+    def test_remove_middle_node(self):
+        ring = redis.HashRing(self.nodes)
+        before = dict((k, ring(k)) for k in self.keys)
+        ring.remove_node(self.nodes[1])
+        for key in self.keys:
+            if before[key] is not self.nodes[1]:
+                self.assertIs(ring(key), before[key])
+
+    def test_cache(self):
+        ring = redis.HashRing(self.nodes, mode="ketama", cache_size=10)
+        node = ring("foo")
+        self.assertIs(ring._cache.get("foo"), node)
+        ring.remove_node(node)
+        self.assertIsNot(ring("foo"), node)
+
+    def test_ketama_points(self):
+        ring = redis.HashRing(self.nodes, mode="ketama")
+        self.assertEqual(len(ring._ring[1]), 160 * len(self.nodes))
+        node, pos = ring.get_node_pos("foo")
+        self.assertTrue(ring._ring[1][pos] >=
+                        struct.unpack("<L", hashlib.md5("foo").digest()[:4])[0]
+                        or pos == 0)
+
+    def test_hashtag(self):
+        self.assertEqual(redis._hashtag("user:{42}:name"), "42")
+        self.assertEqual(redis._hashtag("a{b}c{d}e"), "d")
+        self.assertEqual(redis._hashtag("a{b}c{d"), "b")
+        self.assertEqual(redis._hashtag("{user}:name"), "{user}:name")
+        self.assertEqual(redis._hashtag("plain"), "plain")
+
+
+class ShardedConnectionHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.nodes = [FakeNode("node%d" % x) for x in range(3)]
+        self.handler = redis.ShardedConnectionHandler(self.nodes)
+        self.keys = ["key:%d" % x for x in range(30)]
+        self.handler.mset(dict((k, k.upper()) for k in self.keys))
+
+    def test_hash_mode(self):
+        self.assertEqual(self.handler._ring.mode, "crc32")
+        handler = redis.ShardedConnectionHandler(self.nodes, hashMode="jump")
+        self.assertEqual(handler._ring.mode, "jump")
+        connections = defer.DeferredList(
+            [defer.succeed(node) for node in self.nodes])
+        handler = redis.ShardedConnectionHandler(connections, "ketama")
+        self.assertEqual(handler._ring.mode, "ketama")
+        self.assertEqual(handler._ring.nodes, self.nodes)
+
+    def test_keys_are_spread(self):
+        for node in self.nodes:
+            self.assertTrue(node.data)
+            for key in node.data:
+                self.assertIs(self.handler._node(key), node)
+
+    def test_mget_preserves_order(self):
+        keys = list(reversed(self.keys)) + ["missing"]
+        d = self.handler.mget(keys)
+        d.addCallback(self.assertEqual,
+                      [k.upper() for k in reversed(self.keys)] + [None])
+        return d
+
+    def test_mget_failure(self):
+        self.nodes[1].mget = lambda keys: defer.fail(
+            redis.ResponseError("ERR down"))
+        return self.assertFailure(self.handler.mget(self.keys),
+                                  redis.ResponseError)
+
+    def test_delete(self):
+        d = self.handler.delete(self.keys[:10] + ["missing"])
+        d.addCallback(self.assertEqual, 10)
+        return d
+
+    @defer.inlineCallbacks
+    def test_scan_iter(self):
+        it = self.handler.scan_iter()
+        keys = []
+        while True:
+            batch = yield it.next()
+            if batch is None:
+                break
+            keys.extend(batch)
+        self.assertEqual(sorted(keys), sorted(self.keys))
+
+    def test_hashtags_share_a_node(self):
+        self.assertIs(self.handler._node("user:{1}:name"),
+                      self.handler._node("user:{1}:email"))
+
+    @defer.inlineCallbacks
+    def test_pipeline(self):
+        pipe = yield self.handler.pipeline()
+        replies = [pipe.get(k) for k in self.keys]
+        pipe.set("new", "value")
+        results = yield pipe.execute_pipeline()
+        self.assertEqual(results, [k.upper() for k in self.keys] + ["OK"])
+        self.assertEqual(replies[3].result, "KEY:3")
+        for node in self.nodes:
+            self.assertEqual(len(node.pipelines), 1)
+
+    @defer.inlineCallbacks
+    def test_pipeline_failure(self):
+        self.nodes[1].pipeline = lambda: defer.fail(
+            redis.ResponseError("ERR down"))
+        pipe = yield self.handler.pipeline()
+        errors = []
+        pipe.get(self.keys[0]).addErrback(errors.append)
+        for key in self.keys[1:]:
+            pipe.get(key)
+        yield self.assertFailure(pipe.execute_pipeline(), redis.ResponseError)
+        self.assertEqual(len(errors), 1)
+        del pipe
+        gc.collect()
+        # The failures nobody handled are not logged.
+        self.assertEqual(self.flushLoggedErrors(redis.ResponseError), [])
+
+    @defer.inlineCallbacks
+    def test_pipeline_unsharded_method(self):
+        pipe = yield self.handler.pipeline()
+        self.assertRaises(NotImplementedError, getattr, pipe, "keys")
+
+
+def parse_command(data):
+    """Returns the first command in data and the rest, or None and data."""
+    end = data.find("\r\n")
+    if end == -1:
+        return None, data
+    args = []
+    pos = end + 2
+    for x in xrange(int(data[1:end])):
+        end = data.find("\r\n", pos)
+        if end == -1:
+            return None, data
+        start = end + 2
+        pos = start + int(data[pos + 1:end]) + 2
+        if len(data) < pos:
+            return None, data
+        args.append(data[start:pos - 2])
+    return args, data[pos:]
+
+
+class FakeClusterNodeProtocol(protocol.Protocol):
+    def connectionMade(self):
+        self.buffer = ""
+        self.asking = False
+        self.factory.connections.add(self)
+
+    def connectionLost(self, reason):
+        self.factory.connections.discard(self)
+        if not self.factory.connections and not self.factory.closed.called:
+            self.factory.closed.callback(None)
+
+    def dataReceived(self, data):
+        self.buffer += data
+        while True:
+            command, self.buffer = parse_command(self.buffer)
+            if command is None:
+                break
+            self.factory.commands.append(command)
+            reply = self.factory.cluster.reply(self, command)
+            self.asking = command[0] == "ASKING"
+            self.transport.write(reply)
+
+
+class FakeClusterNode(protocol.Factory):
+    protocol = FakeClusterNodeProtocol
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.data = {}
+        self.commands = []
+        self.connections = set()
+        self.closed = defer.Deferred()
+        self.port = reactor.listenTCP(0, self, interface="127.0.0.1")
+        self.address = "127.0.0.1:%d" % self.port.getHost().port
+
+
+def bulk(value):
+    if value is None:
+        return "$-1\r\n"
+    return "$%d\r\n%s\r\n" % (len(value), value)
+
+
+class FakeCluster(object):
+    """
+    Stands in for a redis cluster of two nodes, serving the lower and
+    upper half of the slots. Slots can be moved to the other node, or
+    marked as migrating, and then keys missing on their owner are
+    redirected with ASK.
+    """
+    def __init__(self):
+        self.nodes = [FakeClusterNode(self), FakeClusterNode(self)]
+        half = redis.CLUSTER_SLOTS // 2
+        self.slots = [0] * half + [1] * half
+        self.migrating = {}
+
+    def serving(self, proto, key):
+        """Returns the node that serves key, or an error to reply with."""
+        slot = redis._keyslot(key)
+        node = self.nodes.index(proto.factory)
+        owner = self.slots[slot]
+        if owner == node:
+            target = self.migrating.get(slot)
+            if target is not None and key not in proto.factory.data:
+                return None, "-ASK %d %s\r\n" % (
+                    slot, self.nodes[target].address)
+            return proto.factory, None
+        if proto.asking and self.migrating.get(slot) == node:
+            return proto.factory, None
+        return None, "-MOVED %d %s\r\n" % (slot, self.nodes[owner].address)
+
+    def reply(self, proto, command):
+        name = command[0].upper()
+        if name == "CLUSTER":
+            ranges = []
+            for slot, owner in enumerate(self.slots):
+                if ranges and ranges[-1][2] == owner:
+                    ranges[-1][1] = slot
+                else:
+                    ranges.append([slot, slot, owner])
+            port = lambda n: self.nodes[n].port.getHost().port
+            return "*%d\r\n%s" % (len(ranges), "".join(
+                "*3\r\n:%d\r\n:%d\r\n*2\r\n$9\r\n127.0.0.1\r\n:%d\r\n" %
+                (start, end, port(owner)) for start, end, owner in ranges))
+        if name == "ASKING":
+            return "+OK\r\n"
+        if name == "SCAN":
+            keys = sorted(proto.factory.data)
+            return "*2\r\n$1\r\n0\r\n*%d\r\n%s" % (
+                len(keys), "".join(bulk(k) for k in keys))
+
+        keys = command[1::2] if name == "MSET" else command[1:2] \
+            if name in ("GET", "SET", "INCRBY") else command[1:]
+        if len(set(redis._keyslot(k) for k in keys)) > 1:
+            return "-CROSSSLOT Keys don't hash to the same slot\r\n"
+        node, error = self.serving(proto, keys[0])
+        if error:
+            return error
+        if name == "GET":
+            return bulk(node.data.get(keys[0]))
+        if name == "SET":
+            node.data[keys[0]] = command[2]
+            return "+OK\r\n"
+        if name == "INCRBY":
+            try:
+                value = int(node.data.get(keys[0], 0)) + int(command[2])
+            except ValueError:
+                return "-ERR value is not an integer or out of range\r\n"
+            node.data[keys[0]] = str(value)
+            return ":%d\r\n" % value
+        if name == "MGET":
+            return "*%d\r\n%s" % (len(keys), "".join(
+                bulk(node.data.get(k)) for k in keys))
+        if name == "MSET":
+            node.data.update(zip(command[1::2], command[2::2]))
+            return "+OK\r\n"
+        if name == "DEL":
+            return ":%d\r\n" % len(
+                [k for k in keys if node.data.pop(k, None) is not None])
+        return "-ERR unknown command '%s'\r\n" % name
+
+    def owner(self, key):
+        return self.nodes[self.slots[redis._keyslot(key)]]
+
+    @defer.inlineCallbacks
+    def stop(self):
+        for node in self.nodes:
+            if node.connections:
+                yield node.closed
+            yield node.port.stopListening()
+
+
+class KeySlotTest(unittest.TestCase):
+    def test_keyslot(self):
+        self.assertEqual(binascii.crc_hqx("123456789", 0), 0x31c3)
+        self.assertEqual(redis._keyslot("foo"), 12182)
+        self.assertEqual(redis._keyslot(u"foo"), 12182)
+        self.assertEqual(redis._keyslot("{user1000}.following"),
+                         redis._keyslot("{user1000}.followers"))
+        self.assertEqual(redis._keyslot("foo{}{bar}"),
+                         binascii.crc_hqx("foo{}{bar}", 0) % 16384)
+        self.assertEqual(redis._keyslot("foo{{bar}}zap"),
+                         redis._keyslot("{bar"))
+
+    def test_redirection(self):
+        error = redis.ResponseError("MOVED 3999 10.0.0.1:6381")
+        self.assertEqual(redis._redirection(error),
+                         ("MOVED", 3999, "10.0.0.1:6381"))
+        self.assertEqual(
+            redis._redirection(redis.ResponseError("ASK 1 10.0.0.1:6381")),
+            ("ASK", 1, "10.0.0.1:6381"))
+        self.assertEqual(redis._redirection(redis.ResponseError("ERR x")),
+                         None)
+
+
+class ClusterConnectionTest(unittest.TestCase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.cluster = FakeCluster()
+        self.rc = yield redis.ClusterConnectionPool(
+            [self.cluster.nodes[0].address], poolsize=2)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.rc.disconnect()
+        yield self.cluster.stop()
+
+    def slotsFetched(self):
+        return sum(1 for node in self.cluster.nodes for c in node.commands
+                   if c[0] == "CLUSTER")
+
+    @defer.inlineCallbacks
+    def test_commands_sent_to_slot_owner(self):
+        keys = ["key:%d" % x for x in xrange(20)]
+        for key in keys:
+            yield self.rc.set(key, key.upper())
+        for key in keys:
+            self.assertEqual(self.cluster.owner(key).data[key], key.upper())
+            value = yield self.rc.get(key)
+            self.assertEqual(value, key.upper())
+        self.assertEqual(len(self.rc._nodes), 2)
+
+    @defer.inlineCallbacks
+    def test_unreachable_startup_node(self):
+        # Accepts connections, and never replies.
+        factory = protocol.Factory()
+        factory.protocol = protocol.Protocol
+        silent = reactor.listenTCP(0, factory, interface="127.0.0.1")
+        self.addCleanup(silent.stopListening)
+        self.patch(redis.ClusterConnectionHandler, "slotsTimeout", 0.1)
+        rc = yield redis.ClusterConnectionPool(
+            ["127.0.0.1:%d" % silent.getHost().port,
+             self.cluster.nodes[0].address])
+        try:
+            yield rc.set("foo", "bar")
+            value = yield rc.get("foo")
+            self.assertEqual(value, "bar")
+        finally:
+            yield rc.disconnect()
+
+    @defer.inlineCallbacks
+    def test_moved(self):
+        yield self.rc.set("foo", "bar")
+        slot = redis._keyslot("foo")
+        old, new = self.cluster.owner("foo"), self.cluster.nodes[0]
+        new.data["foo"] = old.data.pop("foo")
+        self.cluster.slots[slot] = 0
+        value = yield self.rc.get("foo")
+        self.assertEqual(value, "bar")
+        self.assertIs(self.rc._slots[slot], self.rc._node(new.address))
+        # The whole map is fetched again in background.
+        yield self.rc.refreshSlots()
+        self.assertEqual(self.slotsFetched(), 3)
+
+    @defer.inlineCallbacks
+    def test_ask(self):
+        slot = redis._keyslot("foo")
+        owner = self.cluster.slots[slot]
+        target = 1 - owner
+        self.cluster.migrating[slot] = target
+        self.cluster.nodes[target].data["foo"] = "migrated"
+        value = yield self.rc.get("foo")
+        self.assertEqual(value, "migrated")
+        # ASK does not change the slot map.
+        self.assertIs(self.rc._slots[slot],
+                      self.rc._node(self.cluster.nodes[owner].address))
+        self.assertEqual(self.slotsFetched(), 1)
+
+    @defer.inlineCallbacks
+    def test_errors(self):
+        yield self.rc.set("foo", "bar")
+        yield self.assertFailure(self.rc.incr("foo"), redis.ResponseError)
+        self.assertRaises(NotImplementedError, getattr, self.rc, "keys")
+
+    @defer.inlineCallbacks
+    def test_scan_iter(self):
+        keys = ["key:%d" % x for x in xrange(20)]
+        for key in keys:
+            yield self.rc.set(key, key)
+        it = self.rc.scan_iter()
+        found = []
+        while True:
+            batch = yield it.next()
+            if batch is None:
+                break
+            found.extend(batch)
+        self.assertEqual(sorted(found), sorted(keys))
+
+    @defer.inlineCallbacks
+    def test_multi_key_commands(self):
+        mapping = dict(("key:%d" % x, "value:%d" % x) for x in xrange(20))
+        yield self.rc.mset(mapping)
+        keys = sorted(mapping, reverse=True)
+        values = yield self.rc.mget(keys + ["missing"])
+        self.assertEqual(values, [mapping[k] for k in keys] + [None])
+        removed = yield self.rc.delete(keys[:5])
+        self.assertEqual(removed, 5)
+
+    @defer.inlineCallbacks
+    def test_pipeline(self):
+        keys = ["key:%d" % x for x in xrange(10)]
+        for key in keys:
+            self.cluster.owner(key).data[key] = key.upper()
+
+        moved = keys[3]
+        old = self.cluster.owner(moved)
+        new = self.cluster.nodes[1 - self.cluster.nodes.index(old)]
+        new.data[moved] = old.data.pop(moved)
+        self.cluster.slots[redis._keyslot(moved)] = \
+            self.cluster.nodes.index(new)
+
+        pipe = yield self.rc.pipeline()
+        for key in keys:
+            pipe.get(key)
+        pipe.incr("counter")
+        values = yield pipe.execute_pipeline()
+        self.assertEqual(values, [k.upper() for k in keys] + [1])
+
+        gets = [c for node in self.cluster.nodes for c in node.commands
+                if c[0] == "GET"]
+        self.assertEqual(len(gets), len(keys) + 1)
+        yield self.rc.refreshSlots()
+
+
+class FakeSentinel(object):
+    def __init__(self, master=None, replicas=()):
+        self.master = master
+        self.replicas = list(replicas)
+        self.error = None
+
+    def execute_command(self, *args):
+        if self.error is not None:
+            return defer.fail(self.error)
+        if args[:2] == ("SENTINEL", "get-master-addr-by-name"):
+            return defer.succeed(self.master and self.master.split(":"))
+        elif args[:2] == ("SENTINEL", "slaves"):
+            return defer.succeed([
+                ["ip", address.split(":")[0], "port", address.split(":")[1],
+                 "flags", flags] for address, flags in self.replicas])
+        raise AssertionError(args)
+
+
+class FakeServer(FakeNode):
+    """A redis server that can hold replies, and refuse writes."""
+    def __init__(self, uuid):
+        FakeNode.__init__(self, uuid)
+        self._factory.drain = self.drain
+        self.drained = False
+        self.readonly = False
+        self.held = []
+
+    def drain(self):
+        self.drained = True
+        for d in self.held:
+            d.cancel()
+
+    def get(self, key):
+        if self.drained:
+            d = defer.Deferred()
+            self.held.append(d)
+            return d
+        return FakeNode.get(self, key)
+
+    def set(self, key, value):
+        if self.readonly:
+            return defer.fail(redis.ResponseError(
+                "READONLY You can't write against a read only replica."))
+        return FakeNode.set(self, key, value)
+
+
+class SentinelConnectionTest(unittest.TestCase):
+    def setUp(self):
+        self.sentinels = {
+            "s1:26379": FakeSentinel("10.0.0.1:6379"),
+            "s2:26379": FakeSentinel("10.0.0.1:6379"),
+        }
+        self.servers = {}
+        self.data = {}
+        self.rc = self.makeHandler()
+
+    def makeHandler(self, readFromReplicas=False):
+        handler = redis.SentinelConnectionHandler(
+            sorted(self.sentinels), "mymaster", None, 1, True, "utf-8", None,
+            None, None, True, False, readFromReplicas)
+        handler._sentinel = self.sentinels.get
+        handler._pool = self.server
+        return handler
+
+    def server(self, address):
+        self.servers[address] = FakeServer(address)
+        self.servers[address].data = self.data.setdefault(address, {})
+        return self.servers[address]
+
+    def test_discover_master(self):
+        self.sentinels["s1:26379"].error = redis.PoolTimeoutError("timeout")
+        self.successResultOf(self.rc.set("a", "1"))
+        self.assertEqual(self.rc.master, "10.0.0.1:6379")
+        self.assertEqual(self.servers["10.0.0.1:6379"].data, {"a": "1"})
+        self.assertEqual(self.successResultOf(self.rc.get("a")), "1")
+
+    def test_unknown_service(self):
+        for sentinel in self.sentinels.values():
+            sentinel.master = None
+        self.failureResultOf(self.rc.get("a"), redis.SentinelError)
+
+    def test_switch_master(self):
+        self.successResultOf(self.rc.discoverMaster())
+        old = self.servers["10.0.0.1:6379"]
+        old.drained = True
+        d = self.rc.get("a")
+        self.assertNoResult(d)
+
+        self.rc.eventReceived("+switch-master",
+                              "othermaster 10.0.0.1 6379 10.0.0.9 6379")
+        self.assertEqual(self.rc.master, "10.0.0.1:6379")
+        self.data["10.0.0.2:6379"] = {"a": "new"}
+        self.rc.eventReceived("+switch-master",
+                              "mymaster 10.0.0.1 6379 10.0.0.2 6379")
+        self.assertEqual(self.rc.master, "10.0.0.2:6379")
+        self.assertEqual(self.successResultOf(d), "new")
+
+    def test_readonly(self):
+        self.successResultOf(self.rc.discoverMaster())
+        self.servers["10.0.0.1:6379"].readonly = True
+        for sentinel in self.sentinels.values():
+            sentinel.master = "10.0.0.2:6379"
+        self.successResultOf(self.rc.set("a", "1"))
+        self.assertTrue(self.servers["10.0.0.1:6379"].drained)
+        self.assertEqual(self.servers["10.0.0.2:6379"].data, {"a": "1"})
+
+        self.servers["10.0.0.2:6379"].readonly = True
+        self.failureResultOf(self.rc.set("a", "1"), redis.ResponseError)
+
+    def test_read_from_replicas(self):
+        self.sentinels["s1:26379"].replicas = [
+            ("10.0.0.2:6379", "slave"),
+            ("10.0.0.3:6379", "slave"),
+            ("10.0.0.4:6379", "s_down,slave"),
+        ]
+        rc = self.makeHandler(readFromReplicas=True)
+        self.successResultOf(rc.discoverMaster())
+        self.assertEqual(sorted(rc._replicas),
+                         ["10.0.0.2:6379", "10.0.0.3:6379"])
+        for address in rc._replicas:
+            self.servers[address].data["a"] = address
+        self.assertEqual(
+            sorted(self.successResultOf(rc.get("a")) for x in range(2)),
+            ["10.0.0.2:6379", "10.0.0.3:6379"])
+        self.successResultOf(rc.set("b", "1"))
+        self.assertEqual(self.servers["10.0.0.1:6379"].data, {"b": "1"})
+
+        # The replica goes down, then a replica is promoted.
+        self.sentinels["s1:26379"].replicas = [("10.0.0.3:6379", "slave")]
+        rc.eventReceived("+sdown", "slave 10.0.0.2:6379 10.0.0.2 6379 "
+                                   "@ mymaster 10.0.0.1 6379")
+        self.assertEqual(list(rc._replicas), ["10.0.0.3:6379"])
+        self.assertTrue(self.servers["10.0.0.2:6379"].drained)
+        promoted = rc._replicas["10.0.0.3:6379"]
+        self.sentinels["s1:26379"].master = "10.0.0.3:6379"
+        self.sentinels["s1:26379"].replicas = []
+        rc.eventReceived("+switch-master",
+                         "mymaster 10.0.0.1 6379 10.0.0.3 6379")
+        self.assertIs(rc._master, promoted)
+        self.assertEqual(rc._replicas, {})
+
+
+class StreamCommandsTest(unittest.TestCase):
+    def setUp(self):
+        self.proto = redis.RedisProtocol()
+        self.proto.factory = FakeFactory()
+        self.transport = StringTransport()
+        self.proto.makeConnection(self.transport)
+
+    def sent(self):
+        value = self.transport.value()
+        self.transport.clear()
+        return parse_command(value)[0]
+
+    def test_xadd(self):
+        d = self.proto.xadd("s", [("a", 1), ("b", "x")], maxlen=100)
+        self.assertEqual(self.sent(),
+                         ["XADD", "s", "MAXLEN", "~", "100", "*",
+                          "a", "1", "b", "x"])
+        self.proto.dataReceived("$3\r\n1-0\r\n")
+        self.assertEqual(self.successResultOf(d), u"1-0")
+
+    def test_xreadgroup(self):
+        d = self.proto.xreadgroup("g", "c", {"s": ">"}, count=10, block=500)
+        self.assertEqual(self.sent(),
+                         ["XREADGROUP", "GROUP", "g", "c", "COUNT", "10",
+                          "BLOCK", "500", "STREAMS", "s", ">"])
+        self.proto.dataReceived(
+            "*1\r\n*2\r\n$1\r\ns\r\n*2\r\n"
+            "*2\r\n$3\r\n1-0\r\n*2\r\n$1\r\na\r\n$1\r\n1\r\n"
+            "*2\r\n$3\r\n2-0\r\n*-1\r\n")
+        self.assertEqual(self.successResultOf(d),
+                         {u"s": [(u"1-0", {u"a": 1}), (u"2-0", {})]})
+
+    def test_xread_timeout(self):
+        d = self.proto.xread({"s": "$"}, block=100)
+        self.proto.dataReceived("*-1\r\n")
+        self.assertEqual(self.successResultOf(d), {})
+
+    def test_xpending(self):
+        d = self.proto.xpending("s", "g")
+        self.assertEqual(self.sent(), ["XPENDING", "s", "g"])
+        self.proto.dataReceived(
+            "*4\r\n:2\r\n$3\r\n1-0\r\n$3\r\n2-0\r\n"
+            "*1\r\n*2\r\n$1\r\nc\r\n$1\r\n2\r\n")
+        self.assertEqual(self.successResultOf(d),
+                         {"pending": 2, "min": u"1-0", "max": u"2-0",
+                          "consumers": {u"c": 2}})
+        d = self.proto.xpending("s", "g", "-", "+", 5)
+        self.assertEqual(self.sent(), ["XPENDING", "s", "g", "-", "+", "5"])
+        self.proto.dataReceived("*1\r\n*4\r\n$3\r\n1-0\r\n$1\r\nc\r\n"
+                                ":7000\r\n:1\r\n")
+        self.assertEqual(self.successResultOf(d), [(u"1-0", u"c", 7000, 1)])
+
+    def test_xautoclaim(self):
+        d = self.proto.xautoclaim("s", "g", "c", 60000, count=5)
+        self.assertEqual(self.sent(),
+                         ["XAUTOCLAIM", "s", "g", "c", "60000", "0-0",
+                          "COUNT", "5"])
+        self.proto.dataReceived("*2\r\n$3\r\n0-0\r\n*1\r\n*2\r\n$3\r\n1-0\r\n"
+                                "*2\r\n$1\r\na\r\n$1\r\nb\r\n")
+        self.assertEqual(self.successResultOf(d),
+                         (u"0-0", [(u"1-0", {u"a": u"b"})]))
+
+
+class FakeStream(object):
+    """A stream with one consumer group, as seen by a StreamConsumer."""
+    def __init__(self, clock):
+        self.clock = clock
+        self.entries = []
+        self.pending = {}
+        self.delivered = 0
+        self.blocked = None
+        self.autoclaim = True
+        self.reads = 0
+
+    def add(self, *values):
+        for value in values:
+            eid = "%d-0" % (len(self.entries) + 1)
+            self.entries.append((eid, {"value": value}))
+        if self.blocked is not None:
+            d, self.blocked = self.blocked, None
+            d.callback(None)
+
+    def xgroup_create(self, key, group, id, mkstream):
+        return defer.fail(redis.ResponseError(
+            "BUSYGROUP Consumer Group name already exists"))
+
+    def xack(self, key, group, ids):
+        acked = [eid for eid in ids if self.pending.pop(eid, None)]
+        return defer.succeed(len(acked))
+
+    @defer.inlineCallbacks
+    def xreadgroup(self, group, consumer, streams, count, block):
+        self.reads += 1
+        start = streams.values()[0]
+        if start != ">":
+            entries = [(eid, fields) for eid, fields in self.entries
+                       if eid in self.pending and
+                       self.pending[eid][0] == consumer and
+                       int(eid.split("-")[0]) > int(start.split("-")[0])]
+            defer.returnValue({"s": entries[:count]})
+
+        if self.delivered == len(self.entries):
+            self.blocked = defer.Deferred()
+            yield self.blocked
+        entries = self.entries[self.delivered:self.delivered + count]
+        self.delivered += len(entries)
+        for eid, fields in entries:
+            self.pending[eid] = (consumer, self.clock.seconds())
+        defer.returnValue({"s": entries})
+
+    def pipeline(self):
+        stream = self
+
+        class Pipeline(object):
+            def __init__(self):
+                self.commands = []
+
+            def __getattr__(self, method):
+                return lambda *args: self.commands.append((method, args))
+
+            @defer.inlineCallbacks
+            def execute_pipeline(self):
+                replies = []
+                for method, args in self.commands:
+                    reply = yield getattr(stream, method)(*args)
+                    replies.append(reply)
+                defer.returnValue(replies)
+
+        return defer.succeed(Pipeline())
+
+    def _claimable(self, idle):
+        now = self.clock.seconds()
+        return [(eid, fields) for eid, fields in self.entries
+                if eid in self.pending and
+                (now - self.pending[eid][1]) * 1000 >= idle]
+
+    def xautoclaim(self, key, group, consumer, idle, start, count):
+        if not self.autoclaim:
+            return defer.fail(redis.ResponseError(
+                "ERR unknown command 'XAUTOCLAIM'"))
+        entries = self._claimable(idle)
+        for eid, fields in entries:
+            self.pending[eid] = (consumer, self.clock.seconds())
+        return defer.succeed(("0-0", entries))
+
+    def xpending(self, key, group, start, end, count):
+        now = self.clock.seconds()
+        return defer.succeed([
+            (eid, c, int((now - since) * 1000), 1)
+            for eid, (c, since) in sorted(self.pending.items())])
+
+    def xclaim(self, key, group, consumer, idle, ids):
+        entries = [(eid, fields) for eid, fields in self._claimable(idle)
+                   if eid in ids]
+        for eid, fields in entries:
+            self.pending[eid] = (consumer, self.clock.seconds())
+        return defer.succeed(entries)
+
+
+class StreamConsumerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.stream = FakeStream(self.clock)
+        self.handled = []
+        self.consumer = self.makeConsumer("c1")
+
+    def makeConsumer(self, name, callback=None):
+        return redis.StreamConsumer(self.stream, "s", "g", name,
+                                    callback or self.handle, count=2,
+                                    claimAfter=60, clock=self.clock)
+
+    def handle(self, eid, fields):
+        self.handled.append(fields["value"])
+
+    def test_batches(self):
+        self.stream.add("a", "b", "c")
+        self.consumer.start()
+        self.assertEqual(self.handled, ["a", "b", "c"])
+        self.assertEqual(self.stream.reads, 4)
+        # The last ack went with the read that blocks.
+        self.assertEqual(self.stream.pending, {})
+        d = self.consumer.stop()
+        self.assertNoResult(d)
+        self.stream.add("d")
+        self.successResultOf(d)
+        self.assertEqual(self.handled, ["a", "b", "c", "d"])
+        # Acknowledged on stop.
+        self.assertEqual(self.stream.pending, {})
+        self.assertEqual(self.consumer.processed, 4)
+
+    def test_failures_stay_pending(self):
+        def handle(eid, fields):
+            if fields["value"] == "bad":
+                raise ValueError(fields["value"])
+            self.handled.append(fields["value"])
+
+        consumer = self.makeConsumer("c1", handle)
+        self.stream.add("a", "bad", "b")
+        consumer.start()
+        self.assertEqual(self.handled, ["a", "b"])
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertEqual(consumer.failed, 1)
+        d = consumer.stop()
+        self.stream.add()
+        self.successResultOf(d)
+        self.assertEqual(sorted(self.stream.pending), ["2-0"])
+
+    def test_history_first(self):
+        self.stream.add("a", "b")
+        self.stream.delivered = 2
+        self.stream.pending = {"1-0": ("c1", 0), "2-0": ("other", 0)}
+        self.consumer.start()
+        self.assertEqual(self.handled, ["a"])
+        self.stream.add("c")
+        self.assertEqual(self.handled, ["a", "c"])
+        self.consumer.stop()
+        self.stream.add()
+
+    def test_claim(self):
+        self.stream.add("a", "b")
+        self.stream.delivered = 2
+        self.stream.pending = {"1-0": ("dead", 0), "2-0": ("dead", 0)}
+        self.consumer.start()
+        self.assertEqual(self.handled, [])
+        self.clock.advance(60)
+        # Claims are made between reads.
+        self.stream.add("c")
+        self.assertEqual(self.handled, ["c", "a", "b"])
+        self.assertEqual(self.consumer.claimed, 2)
+
+    def test_claim_without_xautoclaim(self):
+        self.stream.autoclaim = False
+        self.test_claim()
+        self.assertFalse(self.consumer._autoclaim)
+
+    def test_retry_after_errors(self):
+        self.stream.xreadgroup = Mock(
+            side_effect=[defer.fail(redis.ConnectionError("Not connected")),
+                         defer.succeed({"s": []}),
+                         defer.Deferred()])
+        self.consumer.start()
+        self.assertEqual(len(self.flushLoggedErrors(redis.ConnectionError)),
+                         1)
+        self.assertEqual(self.stream.xreadgroup.call_count, 1)
+        self.clock.advance(self.consumer.retryDelay)
+        self.assertEqual(self.stream.xreadgroup.call_count, 3)
+
+
+class ClientSideCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.handler = Mock()
+        self.handler.get.return_value = defer.succeed(u"v")
+        self.cache = redis.ClientSideCache(self.handler, ttl=10,
+                                           tracking=False, clock=self.clock)
+
+    def get(self, key):
+        results = []
+        self.cache.get(key).addCallback(results.append)
+        return results[0]
+
+    def test_ttl(self):
+        self.assertEqual(self.get("k"), u"v")
+        self.assertEqual(self.get("k"), u"v")
+        self.assertEqual(self.handler.get.call_count, 1)
+        self.clock.advance(11)
+        self.get("k")
+        self.assertEqual(self.handler.get.call_count, 2)
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["size"]),
+                         (1, 2, 1))
+        self.assertAlmostEqual(stats["hit_rate"], 1 / 3.0)
+
+    def test_values_per_command(self):
+        self.handler.hget.return_value = defer.succeed(u"f")
+        self.handler.hmget.return_value = defer.succeed([u"f", u"g"])
+        self.cache.hget("h", "a")
+        self.cache.hget("h", "a")
+        self.cache.hget("h", "b")
+        self.cache.hmget("h", ["a", "b"])
+        self.cache.hmget("h", ["a", "b"])
+        self.assertEqual(self.handler.hget.call_count, 2)
+        self.assertEqual(self.handler.hmget.call_count, 1)
+
+    def test_writes_invalidate(self):
+        self.get("k")
+        self.handler.set.return_value = defer.succeed("OK")
+        self.cache.set("k", "new")
+        self.handler.set.assert_called_once_with("k", "new")
+        self.get("k")
+        self.assertEqual(self.handler.get.call_count, 2)
+        self.assertEqual(self.cache.stats()["invalidations"], 1)
+
+    def cacheKeys(self, *keys):
+        for key in keys:
+            self.get(key)
+        self.handler.get.reset_mock()
+
+    def assertInvalidated(self, invalidated, kept):
+        for key in invalidated + kept:
+            self.get(key)
+        self.assertEqual(self.handler.get.call_count, len(invalidated))
+        self.assertEqual(self.cache.stats()["invalidations"],
+                         len(invalidated))
+
+    def test_delete_list(self):
+        self.cacheKeys("a", "b", "c")
+        self.handler.delete.return_value = defer.succeed(2)
+        self.cache.delete(["a", "b"])
+        self.assertInvalidated(["a", "b"], ["c"])
+
+    def test_mset(self):
+        self.cacheKeys("a", "b", "c")
+        self.handler.mset.return_value = defer.succeed("OK")
+        self.cache.mset({"a": 1, "b": 2})
+        self.handler.mset.assert_called_once_with({"a": 1, "b": 2})
+        self.assertInvalidated(["a", "b"], ["c"])
+
+    def test_rename(self):
+        self.cacheKeys("a", "b", "c")
+        self.handler.rename.return_value = defer.succeed("OK")
+        self.cache.rename("a", "b")
+        self.assertInvalidated(["a", "b"], ["c"])
+
+    def test_reads_do_not_invalidate(self):
+        self.cacheKeys("a")
+        self.handler.exists.return_value = defer.succeed(True)
+        self.cache.exists("a")
+        self.handler.exists.assert_called_once_with("a")
+        self.assertInvalidated([], ["a"])
+
+    def test_concurrent_misses(self):
+        d = defer.Deferred()
+        self.handler.get.return_value = d
+        results = []
+        for x in range(3):
+            self.cache.get("k").addCallback(results.append)
+        d.callback(u"v")
+        self.assertEqual(results, [u"v"] * 3)
+        self.assertEqual(self.handler.get.call_count, 1)
+
+    def test_errors_not_cached(self):
+        self.handler.get.return_value = defer.fail(redis.ResponseError("x"))
+        self.assertFailure(self.cache.get("k"), redis.ResponseError)
+        self.handler.get.return_value = defer.succeed(u"v")
+        self.assertEqual(self.get("k"), u"v")
+        self.assertEqual(self.handler.get.call_count, 2)
+
+    def test_invalidated_while_reading(self):
+        d = defer.Deferred()
+        self.handler.get.return_value = d
+        self.cache.get("k")
+        self.cache.invalidate(["k"])
+        d.callback(u"old")
+        self.assertEqual(self.cache.stats()["size"], 0)
+
+
+class ClientSideCacheTrackingTest(unittest.TestCase):
+    def setUp(self):
+        self.handler = Mock()
+        self.handler._factory = Mock(uuid="127.0.0.1:6379", dbid=None,
+                                     charset="utf-8", password=None,
+                                     replyTimeout=None, convertNumbers=True)
+        self.cache = redis.ClientSideCache(self.handler)
+        self.subscriber = self.connect(self.cache.invalidationFactory)
+        self.assertEqual(self.subscriber.transport.value(),
+                         "*2\r\n$6\r\nCLIENT\r\n$2\r\nID\r\n")
+        self.subscriber.transport.clear()
+        self.subscriber.dataReceived(":42\r\n")
+        self.subscriber.dataReceived("*3\r\n$9\r\nsubscribe\r\n"
+                                     "$20\r\n__redis__:invalidate\r\n:1\r\n")
+        self.reader = self.connect(self.cache.trackingFactory)
+
+    def connect(self, factory):
+        proto = factory.buildProtocol(None)
+        proto.makeConnection(StringTransport())
+        return proto
+
+    def get(self, key):
+        results = []
+        self.cache.get(key).addCallback(results.append)
+        return results
+
+    def test_tracking(self):
+        self.assertEqual(self.cache.clientId, 42)
+        self.assertIn("TRACKING\r\n$2\r\nON\r\n$8\r\nREDIRECT\r\n"
+                      "$2\r\n42", self.reader.transport.value())
+        self.reader.dataReceived("+OK\r\n")
+        self.assertEqual(self.cache.trackingFactory.pool, [self.reader])
+
+        self.reader.transport.clear()
+        results = self.get("k")
+        self.assertIn("GET", self.reader.transport.value())
+        self.reader.dataReceived("$1\r\nv\r\n")
+        self.assertEqual(results + self.get("k"), [u"v", u"v"])
+        self.assertFalse(self.handler.get.called)
+
+        self.subscriber.dataReceived(
+            "*3\r\n$7\r\nmessage\r\n$20\r\n__redis__:invalidate\r\n"
+            "*1\r\n$1\r\nk\r\n")
+        self.assertEqual(self.cache.stats()["invalidations"], 1)
+        self.reader.transport.clear()
+        self.get("k")
+        self.assertIn("GET", self.reader.transport.value())
+
+    def test_flush_invalidates_everything(self):
+        self.reader.dataReceived("+OK\r\n")
+        self.get("k")
+        self.reader.dataReceived("$1\r\nv\r\n")
+        self.subscriber.dataReceived(
+            "*3\r\n$7\r\nmessage\r\n$20\r\n__redis__:invalidate\r\n"
+            "$-1\r\n")
+        self.assertEqual(self.cache.stats()["size"], 0)
+
+    def test_fallback_to_ttl(self):
+        self.reader.dataReceived("-ERR Unknown subcommand 'TRACKING'\r\n")
+        self.assertFalse(self.cache.stats()["tracking"])
+        self.assertTrue(self.subscriber.transport.disconnecting)
+        self.handler.get.return_value = defer.succeed(u"v")
+        self.assertEqual(self.get("k") + self.get("k"), [u"v", u"v"])
+        self.assertEqual(self.handler.get.call_count, 1)
+
+
+class PubSubBridgeTest(unittest.TestCase):
+    def setUp(self):
+        self.bridge = redis.PubSubBridge()
+        self.conn = Mock()
+        self.conn.subscribe.return_value = defer.succeed(None)
+        self.conn.unsubscribe.return_value = defer.succeed(None)
+
+    def test_subscribe_is_reference_counted(self):
+        self.bridge.connectionMade(self.conn)
+        self.bridge.subscribe("chat", Mock())
+        self.bridge.subscribe("chat", Mock())
+        self.conn.subscribe.assert_called_once_with("chat")
+
+    def test_unsubscribe_last_subscriber(self):
+        self.bridge.connectionMade(self.conn)
+        a, b = Mock(), Mock()
+        self.bridge.subscribe("chat", a)
+        self.bridge.subscribe("chat", b)
+        self.bridge.unsubscribe("chat", a)
+        self.assertFalse(self.conn.unsubscribe.called)
+        self.bridge.unsubscribe("chat", b)
+        self.conn.unsubscribe.assert_called_once_with("chat")
+        self.assertEqual(self.bridge.subscribers, {})
+
+    def test_unsubscribe_all(self):
+        self.bridge.connectionMade(self.conn)
+        a = Mock()
+        self.bridge.subscribe("one", a)
+        self.bridge.subscribe("two", a)
+        self.bridge.unsubscribeAll(a)
+        self.assertEqual(self.conn.unsubscribe.call_count, 2)
+        self.assertEqual(self.bridge.subscribers, {})
+
+    def test_subscriptions_sent_on_connect(self):
+        self.bridge.subscribe("one", Mock())
+        self.bridge.subscribe("two", Mock())
+        self.assertFalse(self.conn.subscribe.called)
+        self.bridge.connectionMade(self.conn)
+        self.assertEqual(
+            sorted(c[0][0] for c in self.conn.subscribe.call_args_list),
+            ["one", "two"])
+
+    def test_message_delivery(self):
+        websocket = Mock(spec=["sendMessage"])
+        sse = Mock(spec=["sendEvent"])
+        callback = Mock(spec=[])
+        for subscriber in (websocket, sse, callback):
+            self.bridge.subscribe("chat", subscriber)
+        self.bridge.messageReceived("chat", "hi")
+        websocket.sendMessage.assert_called_once_with("hi")
+        sse.sendEvent.assert_called_once_with("hi")
+        callback.assert_called_once_with("chat", "hi")
+
+    def test_failing_subscriber(self):
+        broken = Mock(spec=[], side_effect=ValueError("boom"))
+        callback = Mock(spec=[])
+        self.bridge.subscribe("chat", broken)
+        self.bridge.subscribe("chat", callback)
+        self.bridge.messageReceived("chat", "hi")
+        callback.assert_called_once_with("chat", "hi")
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    def test_protocol(self):
+        callback = Mock(spec=[])
+        self.bridge.subscribe("chat", callback)
+        proto = self.bridge.factory.buildProtocol(None)
+        transport = StringTransport()
+        proto.makeConnection(transport)
+        self.assertIs(self.bridge.connection, proto)
+        self.assertEqual(transport.value(),
+                         "*2\r\n$9\r\nSUBSCRIBE\r\n$4\r\nchat\r\n")
+        proto.dataReceived("*3\r\n$9\r\nsubscribe\r\n$4\r\nchat\r\n:1\r\n"
+                           "*3\r\n$7\r\nmessage\r\n$4\r\nchat\r\n$2\r\n42\r\n")
+        callback.assert_called_once_with(u"chat", u"42")
+
+    def test_psubscribe_is_reference_counted(self):
+        self.conn.psubscribe.return_value = defer.succeed(None)
+        self.conn.punsubscribe.return_value = defer.succeed(None)
+        self.bridge.connectionMade(self.conn)
+        a, b = Mock(), Mock()
+        self.bridge.psubscribe("news.*", a)
+        self.bridge.psubscribe("news.*", b)
+        self.conn.psubscribe.assert_called_once_with("news.*")
+        self.bridge.unsubscribeAll(a)
+        self.assertFalse(self.conn.punsubscribe.called)
+        self.bridge.punsubscribe("news.*", b)
+        self.conn.punsubscribe.assert_called_once_with("news.*")
+        self.assertEqual(self.bridge.patterns, {})
+
+    def test_pattern_delivery(self):
+        channel = Mock(spec=[])
+        pattern = Mock(spec=[])
+        self.bridge.subscribe("news.sport", channel)
+        self.bridge.psubscribe("news.*", pattern)
+        self.bridge.messageReceived("news.sport", "goal", "news.*")
+        pattern.assert_called_once_with("news.sport", "goal")
+        self.assertFalse(channel.called)
+        self.bridge.messageReceived("news.sport", "goal")
+        channel.assert_called_once_with("news.sport", "goal")
+
+    def test_pattern_protocol(self):
+        callback = Mock(spec=[])
+        self.bridge.psubscribe("news.*", callback)
+        proto = self.bridge.factory.buildProtocol(None)
+        transport = StringTransport()
+        proto.makeConnection(transport)
+        self.assertEqual(transport.value(),
+                         "*2\r\n$10\r\nPSUBSCRIBE\r\n$6\r\nnews.*\r\n")
+        proto.dataReceived("*4\r\n$8\r\npmessage\r\n$6\r\nnews.*\r\n"
+                           "$10\r\nnews.sport\r\n$4\r\ngoal\r\n")
+        callback.assert_called_once_with(u"news.sport", u"goal")
+
+    def test_sharded_connections(self):
+        bridge = redis.PubSubBridge(connections=4)
+        conns = []
+        for shard, factory in enumerate(bridge.factories):
+            conn = Mock()
+            conn.subscribe.return_value = defer.succeed(None)
+            bridge.connectionMade(conn, shard)
+            conns.append(conn)
+        channels = ["channel:%d" % x for x in range(20)]
+        for channel in channels:
+            bridge.subscribe(channel, Mock())
+        for channel in channels:
+            conns[bridge._shard(channel)].subscribe.assert_any_call(channel)
+        self.assertEqual(sum(c.subscribe.call_count for c in conns), 20)
+        self.assertTrue(all(c.subscribe.called for c in conns))
+
+    def test_sharded_resubscribe(self):
+        bridge = redis.PubSubBridge(connections=2)
+        channels = ["channel:%d" % x for x in range(10)]
+        for channel in channels:
+            bridge.subscribe(channel, Mock())
+        conn = Mock()
+        conn.subscribe.return_value = defer.succeed(None)
+        bridge.connectionMade(conn, 1)
+        self.assertEqual(
+            sorted(c[0][0] for c in conn.subscribe.call_args_list),
+            sorted(c for c in channels if bridge._shard(c) == 1))
+        bridge.connectionLost(conn, 1)
+        self.assertEqual(bridge.connections, [None, None])
@@ -0,0 +1,306 @@
+# coding: utf-8
+#
+# Copyright 2010 Alexandre Fiori
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from twisted.internet import defer
+from twisted.internet import task
+from twisted.trial import unittest
+from twisted.test.proto_helpers import StringTransport
+from mock import Mock
+
+from cyclone import sse
+from cyclone.web import Application
+from cyclone.sse import SSEHandler, EventBuffer, RedisEventBuffer
+
+
+class EventBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.buffer = EventBuffer(maxlen=3, max_age=60, clock=self.clock)
+
+    def test_append_assigns_ids(self):
+        self.assertEqual(self.buffer.append("a"), "1")
+        self.assertEqual(self.buffer.append("b", eid=u"x"), "x")
+
+    def test_since(self):
+        for message in "abc":
+            self.buffer.append(message, event="letter")
+        self.assertEqual(self.buffer.since("1"),
+                         [("2", "letter", "b"), ("3", "letter", "c")])
+        self.assertEqual(self.buffer.since(3), [])
+
+    def test_since_unknown_id(self):
+        self.buffer.append("a")
+        self.assertEqual(self.buffer.since("foo"), [("1", None, "a")])
+
+    def test_maxlen(self):
+        for message in "abcd":
+            self.buffer.append(message)
+        self.assertEqual([m for _, _, m in self.buffer.since("0")],
+                         ["b", "c", "d"])
+        self.assertEqual(self.buffer.since("2"),
+                         [("3", None, "c"), ("4", None, "d")])
+
+    def test_reused_id(self):
+        self.buffer.append("a", eid="x")
+        self.buffer.append("b")
+        self.buffer.append("c", eid="x")
+        self.buffer.append("d")
+        # Expiring "a" keeps the id of "c".
+        self.assertEqual(self.buffer.since("x"), [("4", None, "d")])
+
+    def test_max_age(self):
+        self.buffer.append("a")
+        self.clock.advance(45)
+        self.buffer.append("b")
+        self.clock.advance(30)
+        self.assertEqual(self.buffer.since("0"), [("2", None, "b")])
+
+
+class RedisEventBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.redis = Mock()
+        self.buffer = RedisEventBuffer(self.redis, "events", maxlen=10,
+                                       max_age=60, clock=self.clock)
+
+    def test_append(self):
+        self.buffer.append("hello", event="greeting")
+        self.redis.execute_command.assert_called_once_with(
+            "XADD", "events", "MAXLEN", "~", 10, "*", "data", "hello",
+            "event", "greeting")
+
+    def test_since(self):
+        self.clock.advance(120)
+        self.redis.execute_command.return_value = defer.succeed([
+            [u"50000-0", [u"data", u"old"]],
+            [u"90000-0", [u"data", u"seen"]],
+            [u"95000-0", [u"data", 42, u"event", u"n"]],
+        ])
+        d = self.buffer.since("90000-0")
+        self.redis.execute_command.assert_called_once_with(
+            "XRANGE", "events", "90000-0", "+", "COUNT", 11)
+        d.addCallback(self.assertEqual, [("95000-0", u"n", "42")])
+        return d
+
+    def test_since_invalid_id(self):
+        self.redis.execute_command.return_value = defer.succeed([])
+        self.buffer.since("garbage")
+        self.redis.execute_command.assert_called_once_with(
+            "XRANGE", "events", "-", "+", "COUNT", 11)
+
+
+class SSEHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.transport = StringTransport()
+        self.request = Mock()
+        self.request.connection.transport = self.transport
+        self.request.headers = {}
+        self.buffer = EventBuffer()
+
+        class Handler(SSEHandler):
+            bind = Mock()
+
+            def getEventBuffer(handler):
+                return self.buffer
+
+        self.handler = Handler(Application(), self.request)
+        self.handler.flush = Mock()
+
+    def test_send_event(self):
+        self.handler.sendEvent(u"hi", event="greeting", eid=1, retry=10)
+        self.assertEqual(self.transport.value(),
+                         "id: 1\nevent: greeting\nretry: 10\ndata: hi\n\n")
+
+    def test_no_replay_without_last_event_id(self):
+        self.buffer.append("a")
+        self.handler._execute([])
+        self.assertEqual(self.transport.value(), "")
+        self.handler.bind.assert_called_once_with()
+
+    def test_replay(self):
+        for message in "abc":
+            self.buffer.append(message)
+        self.request.headers["Last-Event-ID"] = "1"
+        self.handler._execute([])
+        self.assertEqual(self.transport.value(),
+                         "id: 2\ndata: b\n\nid: 3\ndata: c\n\n")
+        self.handler.bind.assert_called_once_with()
+
+
+class SSEAsyncReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.transport = StringTransport()
+        self.request = Mock()
+        self.request.connection.transport = self.transport
+        self.request.headers = {"Last-Event-ID": "1"}
+        self.replay = defer.Deferred()
+        event_buffer = Mock()
+        event_buffer.since.return_value = self.replay
+
+        class Handler(SSEHandler):
+            bind = Mock()
+            unbind = Mock()
+
+            def getEventBuffer(handler):
+                return event_buffer
+
+        self.handler = Handler(Application(), self.request)
+        self.handler.flush = Mock()
+        self.handler._execute([])
+
+    def tearDown(self):
+        self.handler._closeStream()
+
+    def test_bound_before_replay(self):
+        self.handler.bind.assert_called_once_with()
+        self.handler.sendEvent("live", eid="3")
+        self.handler.sendEvent("live", eid="4")
+        self.assertEqual(self.transport.value(), "")
+        self.replay.callback([("2", None, "b"), ("3", None, "live")])
+        self.assertEqual(self.transport.value(),
+                         "id: 2\ndata: b\n\nid: 3\ndata: live\n\n"
+                         "id: 4\ndata: live\n\n")
+        self.handler.sendEvent("c")
+        self.assertTrue(self.transport.value().endswith("data: c\n\n"))
+
+    def test_disconnected_during_replay(self):
+        self.handler.on_connection_closed()
+        self.replay.callback([("2", None, "b")])
+        self.assertEqual(self.transport.value(), "")
+        self.handler.bind.assert_called_once_with()
+        self.handler.unbind.assert_called_once_with()
+
+    def test_replay_failed(self):
+        self.handler.sendEvent("live")
+        self.replay.errback(ValueError("no redis"))
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertEqual(self.transport.value(), "data: live\n\n")
+
+
+class SSECoalescingTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.transport = StringTransport()
+        self.transport.writeSequence = Mock(
+            wraps=self.transport.writeSequence)
+        request = Mock()
+        request.connection.transport = self.transport
+        request.headers = {}
+
+        class Handler(SSEHandler):
+            write_coalescing = True
+
+        self.handler = Handler(Application(), request)
+        self.handler.flush = Mock()
+        self.handler.transport._clock = self.clock
+        self.handler._execute([])
+
+    def tearDown(self):
+        self.handler._closeStream()
+
+    def test_one_write_per_iteration(self):
+        for message in "abc":
+            self.handler.sendEvent(message)
+        self.assertEqual(self.transport.value(), "")
+        self.clock.advance(0)
+        self.assertEqual(self.transport.writeSequence.call_count, 1)
+        self.assertEqual(self.transport.value(),
+                         "data: a\n\ndata: b\n\ndata: c\n\n")
+        self.handler.sendEvent("d")
+        self.clock.advance(0)
+        self.assertEqual(self.transport.writeSequence.call_count, 2)
+
+    def test_discarded_on_close(self):
+        self.handler.sendEvent("a")
+        self.handler.on_connection_closed()
+        self.clock.advance(0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertFalse(self.transport.writeSequence.called)
+        self.assertEqual(self.transport.value(), "")
+
+
+class SSEHeartbeatTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(sse, "_heartbeats", {5: sse._Heartbeat(5, self.clock)})
+        self.handlers = [self.makeHandler() for x in range(2)]
+
+    def makeHandler(self):
+        request = Mock()
+        request.connection.transport = StringTransport()
+        request.headers = {}
+
+        class Handler(SSEHandler):
+            heartbeat_interval = 5
+            unbind = Mock()
+
+        handler = Handler(Application(), request)
+        handler.flush = Mock()
+        handler._execute([])
+        return handler
+
+    def tearDown(self):
+        for handler in self.handlers:
+            handler._closeStream()
+
+    def test_single_looping_call(self):
+        heartbeat = sse._heartbeats[5]
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.assertEqual(heartbeat.streams, set(self.handlers))
+        self.clock.advance(5)
+        for handler in self.handlers:
+            self.assertEqual(handler.transport.value(), ":\n\n")
+
+    def test_active_streams(self):
+        count = SSEHandler.activeStreams()
+        self.handlers[0].on_connection_closed()
+        self.assertEqual(SSEHandler.activeStreams(), count - 1)
+        self.handlers[0].unbind.assert_called_once_with()
+
+    def test_failed_write_unbinds(self):
+        handler = self.handlers[0]
+        handler.transport.write = Mock(side_effect=IOError("broken pipe"))
+        self.clock.advance(5)
+        handler.unbind.assert_called_once_with()
+        self.assertTrue(handler.transport.disconnecting)
+        self.assertNotIn(handler, sse._heartbeats[5].streams)
+        handler.on_connection_closed()
+        handler.unbind.assert_called_once_with()
+
+    def test_closed_before_bind(self):
+        request = Mock()
+        request.connection.transport = StringTransport()
+        request.headers = {}
+        request.notifyFinish.return_value = defer.succeed(None)
+
+        class Handler(SSEHandler):
+            heartbeat_interval = 5
+            bind = Mock()
+            unbind = Mock()
+
+        handler = Handler(Application(), request)
+        handler.flush = Mock()
+        handler._execute([])
+        self.assertFalse(handler.bind.called)
+        self.assertFalse(handler.unbind.called)
+        self.assertNotIn(handler, sse._heartbeats[5].streams)
+        self.assertNotIn(handler, SSEHandler._active_streams)
+
+    def test_stops_without_streams(self):
+        for handler in self.handlers:
+            handler.on_connection_closed()
+        self.assertFalse(sse._heartbeats[5].call.running)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -13,9 +13,14 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import linecache
+import os
+import shutil
+
 from twisted.internet import defer
 from twisted.trial import unittest
 from twisted.internet import reactor
+from twisted.python.filepath import FilePath
 
 from mock import Mock
 
@@ -71,6 +76,47 @@ class TestTemplates(unittest.TestCase):
 		self.assertEqual(t.generate(a=42.5), "Unknown")
 		self.assertEqual(t.generate(a="meow"), "String")
 
+	def test_compiled_once(self):
+		t = template.Template(r"{% set x = 1 %}{{ x + y }}", name="once.html")
+		code = t._execute_code
+		self.assertEqual(t.generate(y=1), "2")
+		self.assertEqual(t.generate(y=2), "3")
+		self.assertIs(t._execute_code, code)
+		self.assertNotIn("y", t._namespace)
+
+	def test_linecache(self):
+		linecache.cache["sentinel.py"] = (0, None, [], "sentinel.py")
+		t = template.Template("a\n{{ b }}", name="lines.html")
+		t.generate(b=1)
+		self.assertIn("sentinel.py", linecache.cache)
+		self.assertIn("def _execute():",
+			linecache.getline(t._filename(), 1))
+		self.assertTrue(t._filename().startswith("lines_html_"))
+		del linecache.cache["sentinel.py"]
+
+	def test_linecache_same_name(self):
+		a = template.Template("{{ a }}")
+		b = template.Template("{{ b }}")
+		self.assertNotEqual(a._filename(), b._filename())
+		self.assertIn("_tmp = a",
+			"".join(linecache.getlines(a._filename())))
+		self.assertIn("_tmp = b",
+			"".join(linecache.getlines(b._filename())))
+		# Once linecache is cleared, the source comes from __loader__.
+		del linecache.cache[a._filename()]
+		self.assertIn("_tmp = a", "".join(
+			linecache.getlines(a._filename(), a._namespace)))
+
+	def test_stream(self):
+		t = template.Template(
+			"a{% flush %}{% apply str %}b{% flush %}{% end %}{{ x }}")
+		self.assertTrue(t.streaming)
+		chunks = []
+		self.assertEqual(t.stream(chunks.append, x="c"), "bc")
+		self.assertEqual(chunks, ["a"])
+		self.assertEqual(t.generate(x="c"), "abc")
+		self.assertFalse(template.Template("a").streaming)
+
 	def test_comment(self):
 		self.assertEqual(
 			template.Template(r"{% comment blah! %}42").generate(),
@@ -128,7 +174,7 @@ class TestTemplates(unittest.TestCase):
 			return d
 
 		# Test that template immidiatly resolves deferreds if possible
-		t = template.Template(r"-) {{x}} <-> {{y(63)}} :!")
+		t = template.Template(r"-) {{x}} <-> {{y(63)}} :!", asynchronous=True)
 		self.assertEqual(
 			t.generate(x=_mkDeferred(42), y=_mkDeferred),
 			"-) 42 <-> 63 :!"
@@ -144,4 +190,302 @@ class TestTemplates(unittest.TestCase):
 		self.assertEqual(
 			txt,
 			"-) hello <-> 3 :!"
-		)
\ No newline at end of file
+		)
+
+	def test_synchronous(self):
+		t = template.Template(r"{{x}}")
+		self.assertNotIn("yield", t.code)
+		self.assertEqual(t.generate(x=defer.succeed(42)), "42")
+		self.assertRaises(template.TemplateError, t.generate,
+			x=defer.Deferred())
+		self.assertRaises(template.TemplateError, t.generate,
+			x=defer.fail(ValueError()))
+
+	def test_synchronous_result_kept(self):
+		t = template.Template(r"{{x}}")
+		d = defer.succeed(42)
+		self.assertEqual(t.generate(x=d), "42")
+		self.assertEqual(self.successResultOf(d), 42)
+
+	def test_loader_asynchronous(self):
+		loader = template.DictLoader({"a.html": "{{x}}"}, asynchronous=True)
+		t = loader.load("a.html")
+		self.assertTrue(t.asynchronous)
+		d = defer.Deferred()
+		rv = t.generate(x=d)
+		self.assertTrue(isinstance(rv, defer.Deferred), rv)
+		d.callback("later")
+		self.assertEqual(self.successResultOf(rv), "later")
+
+
+class TestTemplateCache(unittest.TestCase):
+
+	def setUp(self):
+		self.root = self.mktemp()
+		self.cache = self.mktemp()
+		os.makedirs(os.path.join(self.root, "pages"))
+		self.write("base.html", "<b>{% block body %}{% end %}</b>")
+		self.write("pages/page.html",
+			'{% extends "../base.html" %}{% block body %}'
+			'{% include "../item.html" %}{% end %}')
+		self.write("item.html", "{{ x }}")
+
+	def write(self, name, source, mtime=None):
+		path = os.path.join(self.root, name)
+		with open(path, "wb") as f:
+			f.write(source)
+		if mtime is not None:
+			os.utime(path, (mtime, mtime))
+
+	def load(self, name, **kwargs):
+		loader = template.Loader(self.root, cache_path=self.cache, **kwargs)
+		return loader.load(name)
+
+	def test_cached(self):
+		self.assertEqual(self.load("pages/page.html").generate(x=1),
+			"<b>1</b>")
+		self.patch(template, "_parse", Mock(side_effect=AssertionError))
+		t = self.load("pages/page.html")
+		self.assertEqual(t.generate(x=2), "<b>2</b>")
+		self.assertIs(t.dependencies, None)
+
+	def test_settings(self):
+		self.load("item.html").generate(x="<")
+		t = self.load("item.html", autoescape=None)
+		self.assertEqual(t.generate(x="<"), "<")
+
+	def test_dependency_changed(self):
+		self.load("pages/page.html")
+		self.write("item.html", "[{{ x }}]", mtime=1)
+		self.assertEqual(self.load("pages/page.html").generate(x=1),
+			"<b>[1]</b>")
+
+	def test_touched(self):
+		self.load("pages/page.html")
+		self.write("base.html", "<b>{% block body %}{% end %}</b>", mtime=1)
+		self.patch(template, "_parse", Mock(side_effect=AssertionError))
+		self.assertEqual(self.load("pages/page.html").generate(x=1),
+			"<b>1</b>")
+
+	def test_cached_parent(self):
+		self.load("base.html")
+		t = self.load("pages/page.html")
+		self.assertEqual(t.generate(x=1), "<b>1</b>")
+		self.assertEqual([d.name for d in t.dependencies],
+			["base.html", "item.html"])
+
+	def test_corrupt(self):
+		self.load("item.html")
+		for name in os.listdir(self.cache):
+			self.write(os.path.join(os.path.abspath(self.cache), name), "x")
+		self.assertEqual(self.load("item.html").generate(x=1), "1")
+
+	def test_precompile(self):
+		self.write("broken.html", "{% if %}")
+		errors = template.precompile(self.root, self.cache)
+		self.assertEqual([name for name, e in errors], ["broken.html"])
+		self.assertEqual(len(os.listdir(self.cache)), 3)
+		self.patch(template, "_parse", Mock(side_effect=AssertionError))
+		self.assertEqual(self.load("pages/page.html").generate(x=1),
+			"<b>1</b>")
+
+
+	def test_relocated(self):
+		template.precompile(self.root, self.cache)
+		relocated = self.mktemp()
+		shutil.copytree(self.root, relocated)
+		self.root = relocated
+		self.write("item.html", "{{ x }}", mtime=1)
+		self.patch(template, "_parse", Mock(side_effect=AssertionError))
+		self.assertEqual(self.load("pages/page.html").generate(x=1),
+			"<b>1</b>")
+
+
+class TestLoaderCheck(unittest.TestCase):
+
+	def setUp(self):
+		self.root = self.mktemp()
+		self.cache = self.mktemp()
+		os.makedirs(os.path.join(self.root, "pages"))
+		self.write("base.html", "<b>{% block body %}{% end %}</b>", mtime=1)
+		self.write("pages/page.html",
+			'{% extends "../base.html" %}{% block body %}'
+			'{% include "../item.html" %}{% end %}', mtime=1)
+		self.write("item.html", "{{ x }}", mtime=1)
+		self.loader = template.Loader(self.root)
+
+	def write(self, name, source, mtime=None):
+		path = os.path.join(self.root, name)
+		with open(path, "wb") as f:
+			f.write(source)
+		if mtime is not None:
+			os.utime(path, (mtime, mtime))
+
+	def test_unchanged(self):
+		t = self.loader.load("pages/page.html")
+		self.loader.check()
+		self.assertIs(self.loader.load("pages/page.html"), t)
+
+	def test_modified(self):
+		t = self.loader.load("item.html")
+		other = self.loader.load("base.html")
+		self.write("item.html", "[{{ x }}]", mtime=2)
+		self.loader.check()
+		self.assertIsNot(self.loader.load("item.html"), t)
+		self.assertEqual(self.loader.load("item.html").generate(x=1), "[1]")
+		self.assertIs(self.loader.load("base.html"), other)
+
+	def test_dependency_modified(self):
+		self.loader.load("pages/page.html")
+		self.write("base.html", "<i>{% block body %}{% end %}</i>", mtime=2)
+		self.loader.check()
+		self.assertEqual(self.loader.load("pages/page.html").generate(x=1),
+			"<i>1</i>")
+
+	def test_fragments_cleared(self):
+		self.write("item.html", '{% cache "k" 0 %}{{ x }}{% end %}', mtime=1)
+		self.assertEqual(self.loader.load("item.html").generate(x=1), "1")
+		self.write("item.html", '{% cache "k" 0 %}[{{ x }}]{% end %}',
+			mtime=2)
+		self.loader.check()
+		self.assertEqual(self.loader.load("item.html").generate(x=1), "[1]")
+
+	def test_deleted(self):
+		self.loader.load("item.html")
+		os.remove(os.path.join(self.root, "item.html"))
+		self.loader.check()
+		self.assertEqual(self.loader.templates, {})
+
+	def test_cached_dependency(self):
+		template.Loader(self.root, cache_path=self.cache).load(
+			"pages/page.html")
+		loader = template.Loader(self.root, cache_path=self.cache)
+		loader.load("pages/page.html")
+		self.assertEqual(sorted(loader.templates), ["pages/page.html"])
+		self.write("item.html", "[{{ x }}]", mtime=2)
+		loader.check()
+		self.assertEqual(loader.templates, {})
+
+	def test_watch(self):
+		self.loader._notifier = Mock()
+		t = self.loader.load("pages/page.html")
+		self.write("item.html", "[{{ x }}]", mtime=2)
+		self.loader.check()
+		self.assertIs(self.loader.load("pages/page.html"), t)
+		self.loader._notify(None,
+			FilePath(os.path.join(self.loader.root, "item.html")), 0)
+		self.loader.check()
+		self.assertEqual(self.loader.load("pages/page.html").generate(x=1),
+			"<b>[1]</b>")
+
+	def test_dict_loader(self):
+		loader = template.DictLoader({"a.html": "a"})
+		loader.load("a.html")
+		loader.check()
+		self.assertEqual(loader.templates, {})
+
+
+class TestFragmentCache(unittest.TestCase):
+
+	def setUp(self):
+		self.calls = []
+
+	def render(self, x):
+		self.calls.append(x)
+		return x
+
+	def test_cached(self):
+		t = template.Template('{% cache "k%d" % k 0 %}{{ f(k) }}{% end %}.')
+		self.assertEqual(t.generate(f=self.render, k=1), "1.")
+		self.assertEqual(t.generate(f=self.render, k=1), "1.")
+		self.assertEqual(t.generate(f=self.render, k=2), "2.")
+		self.assertEqual(self.calls, [1, 2])
+
+	def test_expired(self):
+		clock = Mock(return_value=100)
+		self.patch(template.time, "time", clock)
+		t = template.Template('{% cache "k" 10 %}{{ f(1) }}{% end %}')
+		t.generate(f=self.render)
+		clock.return_value = 109
+		t.generate(f=self.render)
+		clock.return_value = 111
+		t.generate(f=self.render)
+		self.assertEqual(self.calls, [1, 1])
+
+	def test_evicted(self):
+		loader = template.DictLoader(
+			{"a": '{% cache k 0 %}{{ f(k) }}{% end %}'},
+			fragment_cache=template.FragmentCache(size=1))
+		t = loader.load("a")
+		for k in ("a", "b", "a"):
+			t.generate(f=self.render, k=k)
+		self.assertEqual(self.calls, ["a", "b", "a"])
+
+	def test_missing_ttl(self):
+		self.assertRaises(template.TemplateError, template.Template,
+			'{% cache "k" %}x{% end %}')
+		self.assertRaises(template.TemplateError, template.Template,
+			'{% cache "a b" %}x{% end %}')
+
+	def test_cleared_on_reset(self):
+		loader = template.DictLoader(
+			{"a": '{% cache "k" 0 %}{{ x }}{% end %}'})
+		self.assertEqual(loader.load("a").generate(x=1), "1")
+		loader.dict["a"] = '{% cache "k" 0 %}[{{ x }}]{% end %}'
+		loader.check()
+		self.assertEqual(loader.load("a").generate(x=1), "[1]")
+
+	def test_redis_clear(self):
+		redis = Mock()
+		it = Mock()
+		it.next.side_effect = [defer.succeed(["fragment:k"]),
+			defer.succeed(None)]
+		redis.scan_iter.return_value = it
+		redis.delete.return_value = defer.succeed(1)
+		self.successResultOf(template.RedisFragmentCache(redis).clear())
+		redis.scan_iter.assert_called_once_with(pattern="fragment:*",
+			count=1000)
+		redis.delete.assert_called_once_with(["fragment:k"])
+
+	def test_collapsed(self):
+		loader = template.DictLoader(
+			{"a": '{% cache "k" 0 %}{{ f(d) }}{% end %}'}, asynchronous=True)
+		t = loader.load("a")
+		d = defer.Deferred()
+		first = t.generate(f=self.render, d=d)
+		second = t.generate(f=self.render, d=d)
+		d.callback("x")
+		self.assertEqual(self.successResultOf(first), "x")
+		self.assertEqual(self.successResultOf(second), "x")
+		self.assertEqual(self.calls, [d])
+
+	def test_failed(self):
+		loader = template.DictLoader(
+			{"a": '{% cache "k" 0 %}{{ d }}{% end %}'}, asynchronous=True)
+		t = loader.load("a")
+		d = defer.Deferred()
+		first = t.generate(d=d)
+		second = t.generate(d="y")
+		d.errback(ValueError())
+		self.failureResultOf(first)
+		self.assertEqual(self.successResultOf(second), "y")
+		self.assertEqual(t.generate(d="z"), "y")
+
+	def test_redis(self):
+		redis = Mock()
+		redis.get.return_value = defer.succeed(None)
+		redis.set.return_value = defer.succeed(True)
+		loader = template.DictLoader(
+			{"a": '{% cache "k" 60 %}{{ x }}{% end %}'}, asynchronous=True,
+			fragment_cache=template.RedisFragmentCache(redis))
+		self.assertEqual(loader.load("a").generate(x=1), "1")
+		redis.get.assert_called_once_with("fragment:k")
+		redis.set.assert_called_once_with("fragment:k", "1", expire=60)
+
+		redis.get.return_value = defer.succeed(u"2")
+		self.assertEqual(loader.load("a").generate(x=1), "2")
+
+	def test_redis_synchronous(self):
+		t = template.Template('{% cache "k" 0 %}x{% end %}')
+		t._namespace["_fragments"] = template.RedisFragmentCache(Mock())
+		self.assertRaises(template.TemplateError, t.generate)
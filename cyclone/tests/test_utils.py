@@ -21,7 +21,10 @@ from cyclone.escape import squeeze, url_escape, url_unescape
 from cyclone.escape import utf8, to_unicode, to_basestring
 from cyclone.escape import recursive_unicode, linkify, _convert_entity
 from cyclone.util import _emit, ObjectDict, import_object
+from cyclone.util import LRUCache, WriteCoalescer
 from mock import Mock
+from twisted.internet import task
+from twisted.test.proto_helpers import StringTransport
 import datetime
 
 
@@ -156,3 +159,68 @@ class UtilsTest(unittest.TestCase):
 
     def test_import_object_fail_no_method(self):
         self.assertRaises(ImportError, import_object, "os.something")
+
+
+class WriteCoalescerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.transport = StringTransport()
+        self.transport.writeSequence = Mock(
+            side_effect=self.transport.writeSequence)
+        self.coalescer = WriteCoalescer(self.transport, max_bytes=10,
+                                        clock=self.clock)
+
+    def test_write_is_deferred_to_next_iteration(self):
+        self.coalescer.write("ab")
+        self.coalescer.write("cd")
+        self.assertEqual(self.transport.value(), "")
+        self.clock.advance(0)
+        self.assertEqual(self.transport.value(), "abcd")
+        self.transport.writeSequence.assert_called_once_with(["ab", "cd"])
+
+    def test_max_bytes_forces_flush(self):
+        self.coalescer.write("12345")
+        self.coalescer.write("67890")
+        self.assertEqual(self.transport.value(), "1234567890")
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_discard(self):
+        self.coalescer.write("ab")
+        self.coalescer.discard()
+        self.clock.advance(0)
+        self.assertEqual(self.transport.value(), "")
+
+    def test_lose_connection_flushes(self):
+        self.coalescer.write("ab")
+        self.coalescer.loseConnection()
+        self.assertEqual(self.transport.value(), "ab")
+        self.assertTrue(self.transport.disconnecting)
+
+
+class LRUCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache["a"] = 1
+        cache["b"] = 2
+        self.assertEqual(cache["a"], 1)
+        cache["c"] = 3
+        self.assertEqual(len(cache), 2)
+        self.assertNotIn("b", cache)
+        self.assertEqual(cache.get("b", "missing"), "missing")
+        self.assertEqual((cache["a"], cache["c"]), (1, 3))
+
+    def test_update_and_pop(self):
+        cache = LRUCache(2)
+        cache["a"] = 1
+        cache["b"] = 2
+        cache["a"] = 10
+        cache["c"] = 3
+        self.assertEqual(cache.get("a"), 10)
+        self.assertEqual(cache.pop("a"), 10)
+        self.assertEqual(cache.pop("a", None), None)
+        self.assertRaises(KeyError, cache.__getitem__, "a")
+        del cache["c"]
+        self.assertEqual(len(cache), 0)
+        cache["d"] = 4
+        cache.clear()
+        self.assertNotIn("d", cache)
@@ -17,6 +17,7 @@
 from twisted.trial import unittest
 from cyclone.web import RequestHandler, HTTPError
 from cyclone.web import Application, URLSpec, URLReverseError
+from cyclone.web import UIModule
 from cyclone.escape import unicode_type
 from mock import Mock
 from datetime import datetime
@@ -418,7 +419,7 @@ class TestRequestHandler(unittest.TestCase):
         app.settings = {
             "template_loader": DictLoader({
                 "simple.html": "simple: {{msg}}",
-            }),
+            }, asynchronous=True),
         }
 
         self.request = request = Mock()
@@ -465,3 +466,83 @@ class TestRequestHandler(unittest.TestCase):
             self.assertEqual(len(args), 1)
             out += args[0]
         defer.returnValue(out)
+
+
+class Widget(UIModule):
+    def render(self):
+        return "<widget/>"
+
+    def css_files(self):
+        return "/widget.css"
+
+    def javascript_files(self):
+        return ["/widget.js", "/widget.js"]
+
+
+class TestTemplateStreaming(unittest.TestCase):
+    def setUp(self):
+        self.patch(RequestHandler, "_template_loaders", {})
+        app = Mock()
+        app.ui_methods = {}
+        app.ui_modules = {"Widget": Widget}
+        app.settings = {
+            "template_loader": DictLoader({
+                "page.html": "<html><head></head>{% flush %}"
+                             "<body>{% module Widget() %}</body></html>",
+                "static.html": "<html><head></head>"
+                               "<body>{% module Widget() %}</body></html>",
+                "late.html": "<html><head></head><body>"
+                             "{% module Widget() %}</body></html>"
+                             "{% flush %}",
+            }),
+        }
+        self.request = Mock()
+        self.request.headers = {}
+        self.request.method = "GET"
+        self.request.version = "HTTP/1.1"
+        self.handler = RequestHandler(app, self.request)
+        self.handler._transforms = []
+
+    def writes(self):
+        return [args[0] for args, kwargs in self.request.write.call_args_list]
+
+    def test_module_elements(self):
+        self.handler.render("static.html")
+        self.assertEqual(len(self.writes()), 1)
+        self.assertTrue(self.writes()[0].endswith(
+            '<html><head><link href="/widget.css" type="text/css" '
+            'rel="stylesheet"/>\n</head><body><widget/>'
+            '<script src="/widget.js" type="text/javascript"></script>\n'
+            '</body></html>'))
+
+    def test_streaming(self):
+        self.handler.render("page.html")
+        writes = self.writes()
+        self.assertEqual(len(writes), 2)
+        self.assertTrue(writes[0].endswith("\r\n\r\n<html><head></head>"))
+        self.assertNotIn("Content-Length", writes[0])
+        # The module was rendered after </head> was sent.
+        self.assertEqual(writes[1],
+            '<body><widget/><link href="/widget.css" type="text/css" '
+            'rel="stylesheet"/>\n'
+            '<script src="/widget.js" type="text/javascript"></script>\n'
+            '</body></html>')
+        self.assertTrue(self.handler._finished)
+
+    def test_body_already_streamed(self):
+        self.handler.render("late.html")
+        writes = self.writes()
+        self.assertEqual(len(writes), 2)
+        self.assertTrue(writes[0].endswith(
+            '<html><head><link href="/widget.css" type="text/css" '
+            'rel="stylesheet"/>\n</head><body><widget/></body></html>'))
+        # </body> was sent already, the script goes at the end.
+        self.assertEqual(writes[1],
+            '<script src="/widget.js" type="text/javascript"></script>\n')
+        self.assertTrue(self.handler._finished)
+
+    def test_render_string_not_streamed(self):
+        html = self.handler.render_string("page.html")
+        self.assertEqual(html, "<html><head></head><body><widget/></body>"
+                               "</html>")
+        self.assertFalse(self.request.write.called)
@@ -0,0 +1,131 @@
+# coding: utf-8
+#
+# Copyright 2010 Alexandre Fiori
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import struct
+
+from twisted.internet import task
+from twisted.trial import unittest
+from twisted.test.proto_helpers import StringTransport
+from mock import Mock
+
+from cyclone.web import Application
+from cyclone.websocket import WebSocketHandler
+from cyclone.websocket import WebSocketProtocol17, WebSocketProtocol76
+
+
+class WebSocketTestMixin(object):
+    handler_class = WebSocketHandler
+
+    def setUp(self):
+        self.transport = StringTransport()
+        self.request = Mock()
+        self.request.connection.transport = self.transport
+        self.handler = self.handler_class(Application(), self.request)
+
+
+class WebSocketProtocol17Test(WebSocketTestMixin, unittest.TestCase):
+    def setUp(self):
+        WebSocketTestMixin.setUp(self)
+        self.handler.ws_protocol = WebSocketProtocol17(self.handler)
+
+    def test_send_text(self):
+        self.handler.sendMessage(u"hello")
+        self.assertEqual(self.transport.value(), "\x81\x05hello")
+
+    def test_send_dict(self):
+        self.handler.sendMessage({"a": 1})
+        self.assertEqual(self.transport.value(), '\x81\x08{"a": 1}')
+
+    def test_send_binary(self):
+        self.handler.sendMessage("\x00\x01", binary=True)
+        self.assertEqual(self.transport.value(), "\x82\x02\x00\x01")
+
+    def test_send_binary_views(self):
+        for payload in (bytearray("abc"), memoryview("abc"), buffer("abc")):
+            self.transport.clear()
+            self.handler.sendMessage(payload, binary=True)
+            self.assertEqual(self.transport.value(), "\x82\x03abc")
+
+    def test_send_medium_frame(self):
+        payload = "x" * 300
+        self.handler.sendMessage(payload, binary=True)
+        self.assertEqual(self.transport.value(),
+                         "\x82\x7e" + struct.pack("!H", 300) + payload)
+
+    def test_send_large_frame(self):
+        payload = "x" * 70000
+        self.handler.sendMessage(payload)
+        self.assertEqual(self.transport.value(),
+                         "\x81\x7f" + struct.pack("!Q", 70000) + payload)
+
+    def test_header_and_payload_written_separately(self):
+        payload = "x" * 1000
+        self.transport.writeSequence = Mock()
+        self.handler.sendMessage(payload, binary=True)
+        (seq,), _ = self.transport.writeSequence.call_args
+        self.assertEqual(len(seq), 2)
+        self.assertIs(seq[1], payload)
+
+
+class WebSocketProtocol76Test(WebSocketTestMixin, unittest.TestCase):
+    def setUp(self):
+        WebSocketTestMixin.setUp(self)
+        self.handler.ws_protocol = WebSocketProtocol76(self.handler)
+
+    def test_send_text(self):
+        self.handler.sendMessage("hello")
+        self.assertEqual(self.transport.value(), "\x00hello\xff")
+
+    def test_send_binary_unsupported(self):
+        self.assertRaises(ValueError, self.handler.sendMessage, "hello",
+                          binary=True)
+
+
+class WebSocketCoalescingTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.transport = StringTransport()
+        self.transport.writeSequence = Mock(
+            wraps=self.transport.writeSequence)
+        request = Mock()
+        request.connection.transport = self.transport
+
+        class Handler(WebSocketHandler):
+            write_coalescing = True
+
+        self.handler = Handler(Application(), request)
+        self.handler.ws_protocol = WebSocketProtocol17(self.handler)
+        self.handler.ws_protocol.transport._clock = self.clock
+
+    def test_one_write_per_iteration(self):
+        for message in ("a", "b", "c"):
+            self.handler.sendMessage(message)
+        self.assertEqual(self.transport.value(), "")
+        self.clock.advance(0)
+        self.assertEqual(self.transport.writeSequence.call_count, 1)
+        self.assertEqual(self.transport.value(),
+                         "\x81\x01a\x81\x01b\x81\x01c")
+        self.handler.sendMessage("d")
+        self.clock.advance(0)
+        self.assertEqual(self.transport.writeSequence.call_count, 2)
+
+    def test_discarded_on_close(self):
+        self.handler.sendMessage("a")
+        self.handler._connectionLost(None)
+        self.clock.advance(0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertFalse(self.transport.writeSequence.called)
+        self.assertEqual(self.transport.value(), "")
@@ -70,6 +70,149 @@ def import_object(name):
         raise ImportError("No method named %s" % parts[-1])
 
 
+class WriteCoalescer(object):
+    """Wraps a transport and gathers everything written to it during one
+    reactor iteration, flushing it with a single ``writeSequence`` call.
+
+    The queue is flushed early when it holds ``max_bytes`` or more, so
+    bursts of small writes never grow it without bound. It implements
+    enough of the transport interface (``write``, ``writeSequence``,
+    ``loseConnection``) to be used in its place.
+    """
+    def __init__(self, transport, max_bytes=65536, clock=None):
+        self.transport = transport
+        self.max_bytes = max_bytes
+        self._clock = clock
+        self._queue = []
+        self._size = 0
+        self._delayed = None
+
+    def write(self, data):
+        self._queue.append(data)
+        self._size += len(data)
+        if self._size >= self.max_bytes:
+            self.flush()
+        elif self._delayed is None:
+            if self._clock is None:
+                from twisted.internet import reactor
+                self._clock = reactor
+            self._delayed = self._clock.callLater(0, self.flush)
+
+    def writeSequence(self, seq):
+        for data in seq:
+            self.write(data)
+
+    def flush(self):
+        """Writes all pending data to the transport right away."""
+        if self._delayed is not None:
+            if self._delayed.active():
+                self._delayed.cancel()
+            self._delayed = None
+        if self._queue:
+            queue = self._queue
+            self._queue = []
+            self._size = 0
+            self.transport.writeSequence(queue)
+
+    def discard(self):
+        """Drops pending data, for when the connection is already gone."""
+        if self._delayed is not None:
+            if self._delayed.active():
+                self._delayed.cancel()
+            self._delayed = None
+        self._queue = []
+        self._size = 0
+
+    def loseConnection(self):
+        self.flush()
+        self.transport.loseConnection()
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+
+class LRUCache(object):
+    """A mapping that keeps at most ``maxsize`` items, discarding the
+    least recently used one when full.
+
+    >>> cache = LRUCache(2)
+    >>> cache["a"] = 1
+    >>> cache["b"] = 2
+    >>> cache.get("a")
+    1
+    >>> cache["c"] = 3
+    >>> "b" in cache
+    False
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.clear()
+
+    def clear(self):
+        self._links = {}
+        # Circular doubly linked list of [prev, next, key, value], with
+        # the most recently used item right after the root.
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def __len__(self):
+        return len(self._links)
+
+    def __contains__(self, key):
+        return key in self._links
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _push(self, link):
+        root = self._root
+        first = root[1]
+        link[0], link[1] = root, first
+        first[0] = root[1] = link
+
+    def get(self, key, default=None):
+        link = self._links.get(key)
+        if link is None:
+            return default
+        if self._root[1] is not link:
+            self._unlink(link)
+            self._push(link)
+        return link[3]
+
+    def __getitem__(self, key):
+        link = self._links.get(key)
+        if link is None:
+            raise KeyError(key)
+        return self.get(key)
+
+    def __setitem__(self, key, value):
+        link = self._links.get(key)
+        if link is not None:
+            self._unlink(link)
+            link[3] = value
+        else:
+            if len(self._links) >= self.maxsize:
+                oldest = self._root[0]
+                self._unlink(oldest)
+                del self._links[oldest[2]]
+            link = self._links[key] = [None, None, key, value]
+        self._push(link)
+
+    def pop(self, key, *default):
+        link = self._links.pop(key, None)
+        if link is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        self._unlink(link)
+        return link[3]
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+
 # Fake byte literal support:  In python 2.6+, you can say b"foo" to get
 # a byte literal (str in 2.x, bytes in 3.x).  There's no way to do this
 # in a way that supports 2.5, though, so we need a function wrapper
@@ -119,6 +119,9 @@ class RequestHandler(object):
     xsrf_cookie_name = "_xsrf"
     _template_loaders = {}  # {path: template.BaseLoader}
     _template_loader_lock = threading.Lock()
+    _template_stream = None
+    # The UI modules whose <head> elements were streamed with </head>.
+    _head_modules = None
 
     def __init__(self, application, request, **kwargs):
         super(RequestHandler, self).__init__()
@@ -526,21 +529,42 @@ class RequestHandler(object):
         self._write_buffer.append(chunk)
 
     def render(self, template_name, **kwargs):
-        """Renders the template with the given arguments as the response."""
-        d = defer.maybeDeferred(self.render_string, template_name, **kwargs)
+        """Renders the template with the given arguments as the response.
+
+        Templates with ``{% flush %}`` are sent to the client in chunks, as
+        they are rendered. The CSS and ``<head>`` elements of the UI modules
+        rendered after ``</head>`` was sent go before ``</body>`` instead.
+        """
+        self._template_stream = self._stream_template_chunk
+        try:
+            d = defer.maybeDeferred(self.render_string, template_name,
+                                    **kwargs)
+        finally:
+            self._template_stream = None
         d.addCallback(self._insertAdditionalPageElements)
         d.addCallbacks(self.finish, self._execute_failure)
         return d
 
-    def _insertAdditionalPageElements(self, html): # pragma: no cover
-        """Insert the additional JS and CSS added by the modules on the page"""
+    def _stream_template_chunk(self, chunk):
+        if self._head_modules is None and "</head>" in chunk:
+            modules = getattr(self, "_active_modules", {})
+            self._head_modules = set(modules)
+            head = self._page_elements(modules.values())[0]
+            if head:
+                chunk = _splice(chunk, [(chunk.index("</head>"), head)])
+        self.write(chunk)
+        self.flush()
+
+    def _page_elements(self, modules):
+        """Returns the HTML to insert before ``</head>`` and ``</body>``,
+        for the JS and CSS added by ``modules``."""
         js_embed = []
         js_files = []
         css_embed = []
         css_files = []
         html_heads = []
         html_bodies = []
-        for module in getattr(self, "_active_modules", {}).values():
+        for module in modules:
             embed_part = module.embedded_javascript()
             if embed_part:
                 js_embed.append(utf8(embed_part))
@@ -568,52 +592,72 @@ class RequestHandler(object):
 
         def is_absolute(path):
             return any(path.startswith(x) for x in ["/", "http:", "https:"])
-        if js_files:
-            # Maintain order of JavaScript files given by modules
+
+        def unique_urls(files):
+            # Maintain the order of the files given by modules
             paths = []
             unique_paths = set()
-            for path in js_files:
+            for path in files:
                 if not is_absolute(path):
                     path = self.static_url(path)
                 if path not in unique_paths:
                     paths.append(path)
                     unique_paths.add(path)
-            js = ''.join('<script src="' + escape.xhtml_escape(p) +
-                         '" type="text/javascript"></script>'
-                         for p in paths)
-            sloc = html.rindex('</body>')
-            html = html[:sloc] + utf8(js) + '\n' + html[sloc:]
+            return paths
+
+        head = []
+        body = []
+        if js_files:
+            body.append(utf8(''.join(
+                '<script src="' + escape.xhtml_escape(p) +
+                '" type="text/javascript"></script>'
+                for p in unique_urls(js_files))))
         if js_embed:
-            js = '<script type="text/javascript">\n//<![CDATA[\n' + \
-                '\n'.join(js_embed) + '\n//]]>\n</script>'
-            sloc = html.rindex('</body>')
-            html = html[:sloc] + js + '\n' + html[sloc:]
+            body.append('<script type="text/javascript">\n//<![CDATA[\n' +
+                        '\n'.join(js_embed) + '\n//]]>\n</script>')
+        if html_bodies:
+            body.append(''.join(html_bodies))
         if css_files:
-            paths = []
-            unique_paths = set()
-            for path in css_files:
-                if not is_absolute(path):
-                    path = self.static_url(path)
-                if path not in unique_paths:
-                    paths.append(path)
-                    unique_paths.add(path)
-            css = ''.join('<link href="' + escape.xhtml_escape(p) + '" '
-                          'type="text/css" rel="stylesheet"/>'
-                          for p in paths)
-            hloc = html.index('</head>')
-            html = html[:hloc] + utf8(css) + '\n' + html[hloc:]
+            head.append(utf8(''.join(
+                '<link href="' + escape.xhtml_escape(p) + '" '
+                'type="text/css" rel="stylesheet"/>'
+                for p in unique_urls(css_files))))
         if css_embed:
-            css = '<style type="text/css">\n' + '\n'.join(css_embed) + \
-                '\n</style>'
-            hloc = html.index('</head>')
-            html = html[:hloc] + css + '\n' + html[hloc:]
+            head.append('<style type="text/css">\n' + '\n'.join(css_embed) +
+                        '\n</style>')
         if html_heads:
-            hloc = html.index('</head>')
-            html = html[:hloc] + ''.join(html_heads) + '\n' + html[hloc:]
-        if html_bodies:
-            hloc = html.index('</body>')
-            html = html[:hloc] + ''.join(html_bodies) + '\n' + html[hloc:]
-        return html
+            head.append(''.join(html_heads))
+        return (''.join(part + '\n' for part in head),
+                ''.join(part + '\n' for part in body))
+
+    def _insertAdditionalPageElements(self, html):
+        """Insert the additional JS and CSS added by the modules on the page
+
+        ``html`` is only what is left of a streamed page, which may not
+        have ``</head>`` or ``</body>`` anymore. The elements then go at
+        its end. Placeholders would not work here: UI modules are rendered
+        in the body, after the place of their CSS may have been sent.
+        """
+        modules = getattr(self, "_active_modules", {})
+        if not modules:
+            return html
+        if self._head_modules is None:
+            head, body = self._page_elements(modules.values())
+        else:
+            # </head> was streamed already.
+            late, _ = self._page_elements(
+                module for name, module in modules.items()
+                if name not in self._head_modules)
+            head, body = "", late + self._page_elements(modules.values())[1]
+
+        insertions = []
+        if head:
+            index = html.find('</head>')
+            insertions.append((len(html) if index < 0 else index, head))
+        if body:
+            index = html.rfind('</body>')
+            insertions.append((len(html) if index < 0 else index, body))
+        return _splice(html, insertions)
 
     def render_string(self, template_name, **kwargs):
         """Generate the given template with the given arguments.
@@ -621,6 +665,9 @@ class RequestHandler(object):
         We return the generated string. To generate and write a template
         as a response, use render() above.
         """
+        # Only the template of render() is streamed, not the ones of the
+        # UI modules it renders.
+        write, self._template_stream = self._template_stream, None
         # If no template_path is specified, use the path of the calling file
         template_path = self.get_template_path()
         if not template_path:
@@ -638,6 +685,8 @@ class RequestHandler(object):
         t = loader.load(template_name)
         namespace = self.get_template_namespace()
         namespace.update(kwargs)
+        if write is not None and t.streaming:
+            return t.stream(write, **namespace)
         return t.generate(**namespace)
 
     def get_template_namespace(self):
@@ -667,7 +716,9 @@ class RequestHandler(object):
 
         May be overridden by subclasses.  By default returns a
         directory-based loader on the given path, using the
-        ``autoescape`` application setting.  If a ``template_loader``
+        ``autoescape``, ``template_asynchronous``, ``template_cache_path``,
+        ``template_watch`` and ``template_fragment_cache`` application
+        settings.  If a ``template_loader``
         application setting is supplied, uses that instead.
         """
         settings = self.application.settings
@@ -678,6 +729,14 @@ class RequestHandler(object):
             # autoescape=None means "no escaping", so we have to be sure
             # to only pass this kwarg if the user asked for it.
             kwargs["autoescape"] = settings["autoescape"]
+        if "template_asynchronous" in settings:
+            kwargs["asynchronous"] = settings["template_asynchronous"]
+        if "template_cache_path" in settings:
+            kwargs["cache_path"] = settings["template_cache_path"]
+        if "template_watch" in settings:
+            kwargs["watch"] = settings["template_watch"]
+        if "template_fragment_cache" in settings:
+            kwargs["fragment_cache"] = settings["template_fragment_cache"]
         return template.Loader(template_path, **kwargs)
 
     def flush(self, include_footers=False):
@@ -1530,12 +1589,12 @@ class Application(protocol.ServerFactory):
             if not handler:
                 handler = self.error_handler(self, request, status_code=404)
 
-        # In debug mode, re-compile templates and reload static files on every
-        # request so you don't need to restart to see changes
+        # In debug mode, re-compile modified templates and reload static
+        # files on every request so you don't need to restart to see changes
         if self.settings.get("debug"):
             with RequestHandler._template_loader_lock:
                 for loader in RequestHandler._template_loaders.values():
-                    loader.reset()
+                    loader.check()
             StaticFileHandler.reset()
 
         handler._execute(transforms, *args, **kwargs)
@@ -2167,6 +2226,19 @@ class URLSpec(object):
 url = URLSpec
 
 
+def _splice(text, insertions):
+    """Inserts each text of ``insertions``, a list of (index, text), at its
+    index, copying ``text`` once."""
+    parts = []
+    pos = 0
+    for index, insertion in sorted(insertions, key=lambda i: i[0]):
+        parts.append(text[pos:index])
+        parts.append(insertion)
+        pos = index
+    parts.append(text[pos:])
+    return "".join(parts)
+
+
 def _time_independent_equals(a, b):
     if len(a) != len(b):
         return False
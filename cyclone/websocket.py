@@ -32,6 +32,7 @@ import cyclone
 import cyclone.web
 import cyclone.escape
 
+from cyclone.util import WriteCoalescer
 from twisted.python import log
 
 
@@ -78,7 +79,16 @@ class WebSocketHandler(cyclone.web.RequestHandler):
       };
 
     This script pops up an alert box that says "You said: Hello, world".
+
+    Handlers that send many small messages in a burst may set
+    ``write_coalescing = True``: messages produced during one reactor
+    iteration are then queued and written together with a single
+    ``writeSequence`` call, or earlier once ``write_coalescing_max_bytes``
+    are pending.
     """
+    write_coalescing = False
+    write_coalescing_max_bytes = 65536
+
     def __init__(self, application, request, **kwargs):
         cyclone.web.RequestHandler.__init__(self, application, request,
                                             **kwargs)
@@ -86,7 +96,12 @@ class WebSocketHandler(cyclone.web.RequestHandler):
         self.request = request
         self.transport = request.connection.transport
         self.ws_protocol = None
-        self.notifyFinish().addCallback(self.connectionLost)
+        self.notifyFinish().addCallback(self._connectionLost)
+
+    def _connectionLost(self, reason):
+        if self.ws_protocol is not None:
+            self.ws_protocol.connectionLost(reason)
+        self.connectionLost(reason)
 
     def headersReceived(self):
         pass
@@ -101,18 +116,23 @@ class WebSocketHandler(cyclone.web.RequestHandler):
         """Gets called when a message is received from the peer."""
         pass
 
-    def sendMessage(self, message):
+    def sendMessage(self, message, binary=False):
         """Sends the given message to the client of this Web Socket.
 
         The message may be either a string or a dict (which will be
-        encoded as json).
+        encoded as json). If ``binary`` is True the message is sent in a
+        binary frame, and may also be a ``bytearray``, ``memoryview`` or
+        ``buffer``.
         """
         if isinstance(message, dict):
             message = cyclone.escape.json_encode(message)
         if isinstance(message, unicode):
             message = message.encode("utf-8")
-        assert isinstance(message, str)
-        self.ws_protocol.sendMessage(message)
+        assert isinstance(message, (str, bytearray, memoryview, buffer))
+        if binary:
+            self.ws_protocol.sendMessage(message, code=0x82)
+        else:
+            self.ws_protocol.sendMessage(message)
 
     def _rawDataReceived(self, data):
         self.ws_protocol.handleRawData(data)
@@ -155,14 +175,21 @@ class WebSocketProtocol(object):
         self.handler = handler
         self.request = handler.request
         self.transport = handler.transport
+        if handler.write_coalescing:
+            self.transport = WriteCoalescer(
+                handler.transport, handler.write_coalescing_max_bytes)
 
     def acceptConnection(self):
         pass
 
+    def connectionLost(self, reason):
+        if isinstance(self.transport, WriteCoalescer):
+            self.transport.discard()
+
     def rawDataReceived(self, data):
         pass
 
-    def sendMessage(self, message):
+    def sendMessage(self, message, code=0x81):
         pass
 
 
@@ -307,21 +334,24 @@ class WebSocketProtocol17(WebSocketProtocol):
     def sendMessage(self, message, code=0x81):
         if isinstance(message, unicode):
             message = message.encode('utf8')
+        elif isinstance(message, memoryview):
+            message = message.tobytes()
+        elif isinstance(message, (bytearray, buffer)):
+            message = str(message)
+
         length = len(message)
-        newFrame = []
-        newFrame.append(code)
-        newFrame = bytearray(newFrame)
         if length <= 125:
-            newFrame.append(length)
-        elif length > 125 and length < 65536:
-            newFrame.append(126)
-            newFrame += struct.pack('!H', length)
-        elif length >= 65536:
-            newFrame.append(127)
-            newFrame += struct.pack('!Q', length)
+            header = struct.pack('!BB', code, length)
+        elif length < 65536:
+            header = struct.pack('!BBH', code, 126, length)
+        else:
+            header = struct.pack('!BBQ', code, 127, length)
 
-        newFrame += message
-        self.transport.write(str(newFrame))
+        # The payload is handed to the transport next to its header, rather
+        # than being copied into a single frame string. Only str payloads
+        # avoid a copy: transports join what they buffer with str.join,
+        # which takes no memoryview, bytearray or buffer.
+        self.transport.writeSequence([header, message])
 
 
 class WebSocketProtocol76(WebSocketProtocol):
@@ -418,7 +448,12 @@ class WebSocketProtocol76(WebSocketProtocol):
         self.transport.write('\xff\x00')
         self.transport.loseConnection()
 
-    def sendMessage(self, message):
+    def sendMessage(self, message, code=0x81):
+        if code != 0x81:
+            raise ValueError("Only text messages are supported by "
+                             "WebSocket draft 76")
+        if isinstance(message, memoryview):
+            message = message.tobytes()
         self.transport.write("\x00%s\xff" % message)
 
     def _calculate_token(self, k1, k2, k3):
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Copyright 2010 Alexandre Fiori
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# Measures how many keys per second the sharded connections can map to
+# their redis server, for each mode of the hash ring, with and without the
+# LRU cache. "hot" looks up the same 500 keys over and over, "cold" looks
+# up 100k different keys.
+#
+#   python redis_hashring.py [nodes] [repeat]
+
+import bisect
+import re
+import sys
+import time
+import zlib
+
+from cyclone import redis
+
+
+class Node(object):
+    def __init__(self, uuid):
+        self._factory = self
+        self.uuid = uuid
+
+
+class LegacyHashRing(object):
+    # The ring as it was before, a dict of points and a sorted list.
+    def __init__(self, nodes, replicas=160):
+        self.nodes = nodes
+        self.replicas = replicas
+        self.ring = {}
+        self.sorted_keys = []
+        for node in nodes:
+            for x in xrange(replicas):
+                crckey = zlib.crc32("%s:%d" % (node._factory.uuid, x))
+                self.ring[crckey] = node
+                self.sorted_keys.append(crckey)
+        self.sorted_keys.sort()
+
+    def get_node(self, key):
+        n, i = self.get_node_pos(key)
+        return n
+
+    def get_node_pos(self, key):
+        crc = zlib.crc32(key)
+        idx = bisect.bisect(self.sorted_keys, crc)
+        idx = min(idx, (self.replicas * len(self.nodes)) - 1)
+        return [self.ring[self.sorted_keys[idx]], idx]
+
+    def __call__(self, key):
+        return self.get_node(key)
+
+
+def legacy_lookup(nodes):
+    findhash = re.compile(r'.+\{(.*)\}.*')
+    ring = LegacyHashRing(nodes)
+
+    def lookup(key):
+        m = findhash.match(key)
+        if m is not None and len(m.groups()) >= 1:
+            return ring(m.groups()[0])
+        return ring(key)
+    return lookup
+
+
+def ring_lookup(nodes, **kwargs):
+    ring = redis.HashRing(nodes, **kwargs)
+    handler = redis.ShardedConnectionHandler([])
+    handler._ring = ring
+    return handler._node
+
+
+def measure(lookup, keys, repeat):
+    best = None
+    for x in xrange(repeat):
+        started = time.time()
+        for key in keys:
+            lookup(key)
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return len(keys) / best
+
+
+def main(nodes=8, repeat=5):
+    nodes = [Node("127.0.0.1:%d" % (6379 + x)) for x in xrange(nodes)]
+    lookups = [("legacy", legacy_lookup(nodes))]
+    for mode in redis.HashRing.modes:
+        lookups.append((mode, ring_lookup(nodes, mode=mode, cache_size=0)))
+        lookups.append(("%s + lru" % mode,
+                        ring_lookup(nodes, mode=mode, cache_size=1024)))
+
+    keysets = [
+        ("hot", ["user:%d:profile" % x for x in xrange(500)] * 200),
+        ("cold", ["user:%d:profile" % x for x in xrange(100000)]),
+    ]
+    for name, keys in keysets:
+        print "%s keys, %d nodes" % (name, len(nodes))
+        for label, lookup in lookups:
+            print "    %-20s %10.0f lookups/s" % (
+                label, measure(lookup, keys, repeat))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Copyright 2010 Alexandre Fiori
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# Measures how fast the redis protocols parse big replies, without a redis
+# server: replies are fed to the protocol in 64KB chunks, as they would
+# arrive from the network. "raw" replies are neither decoded nor converted
+# to numbers, like with charset=None and convertNumbers=False, or raw().
+# LegacyRedisProtocol is the parser BaseRedisProtocol had before, which
+# switched a LineReceiver between line and raw mode for each bulk reply.
+#
+#   python redis_parser.py [rounds]
+
+import sys
+import time
+
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.protocols import basic
+from twisted.test.proto_helpers import StringTransport
+
+from cyclone import redis
+
+
+class Factory(object):
+    convertNumbers = True
+    password = None
+    dbid = None
+
+    def addConnection(self, conn):
+        pass
+
+    def delConnection(self, conn):
+        pass
+
+
+class MultiBulkStorage(object):
+    def __init__(self, parent=None):
+        self.items = None
+        self.pending = None
+        self.parent = parent
+
+    def set_pending(self, pending):
+        if self.pending is None:
+            if pending < 0:
+                self.items = None
+                self.pending = 0
+            else:
+                self.items = []
+                self.pending = pending
+            return self
+        else:
+            m = MultiBulkStorage(self)
+            m.set_pending(pending)
+            return m
+
+    def append(self, item):
+        self.pending -= 1
+        self.items.append(item)
+
+
+class LegacyRedisProtocol(basic._PauseableMixin, redis.BaseRedisProtocol):
+    callLater = reactor.callLater
+    line_mode = 1
+    line_buffer = ""
+    delimiter = "\r\n"
+    MAX_LENGTH = 16384
+
+    def __init__(self, *args, **kwargs):
+        redis.BaseRedisProtocol.__init__(self, *args, **kwargs)
+        self.bulk_length = 0
+        self.bulk_buffer = []
+        self.multi_bulk = MultiBulkStorage()
+
+    def dataReceived(self, data, unpause=False):
+        if unpause is True:
+            if self.line_buffer:
+                self.line_buffer = data + self.line_buffer
+            else:
+                self.line_buffer += data
+
+            self.resumeProducing()
+        else:
+            self.line_buffer = self.line_buffer + data
+
+        while self.line_mode and not self.paused:
+            try:
+                line, self.line_buffer = self.line_buffer.split(
+                    self.delimiter, 1)
+            except ValueError:
+                if len(self.line_buffer) > self.MAX_LENGTH:
+                    line, self.line_buffer = self.line_buffer, ""
+                    return self.transport.loseConnection()
+                break
+            else:
+                if len(line) > self.MAX_LENGTH:
+                    self.line_buffer = ""
+                    return self.transport.loseConnection()
+                why = self.lineReceived(line)
+                if why or self.transport and self.transport.disconnecting:
+                    return why
+        else:
+            if not self.paused:
+                data = self.line_buffer
+                self.line_buffer = ""
+                if data:
+                    return self.rawDataReceived(data)
+
+    def setLineMode(self, extra=""):
+        self.line_mode = 1
+        if extra:
+            self.pauseProducing()
+            self.callLater(0, self.dataReceived, extra, True)
+
+    def setRawMode(self):
+        self.line_mode = 0
+
+    def lineReceived(self, line):
+        if line:
+            self.resetTimeout()
+            token, data = line[0], line[1:]
+        else:
+            return
+
+        if token == "$":  # bulk data
+            try:
+                self.bulk_length = long(data)
+            except ValueError:
+                self.replyReceived(redis.InvalidResponse(
+                    "Cannot convert data '%s' to integer" % data))
+            else:
+                if self.bulk_length == -1:
+                    self.bulk_length = 0
+                    self.bulkDataReceived(None)
+                else:
+                    self.bulk_length += 2  # 2 == \r\n
+                    self.setRawMode()
+
+        elif token == "*":  # multi-bulk data
+            try:
+                n = long(data)
+            except (TypeError, ValueError):
+                self.multi_bulk = MultiBulkStorage()
+                self.replyReceived(redis.InvalidResponse(
+                    "Cannot convert multi-response header '%s' to integer" %
+                    data))
+            else:
+                self.multi_bulk = self.multi_bulk.set_pending(n)
+                if n in (0, -1):
+                    self.multiBulkDataReceived()
+
+        elif token == "+":  # single line status
+            if data == "QUEUED":
+                self.transactions += 1
+                self.replyReceived(data)
+            else:
+                if self.multi_bulk.pending:
+                    self.handleMultiBulkElement(data)
+                else:
+                    self.replyReceived(data)
+
+        elif token == "-":  # error
+            reply = redis.ResponseError(data[4:] if data[:4] == "ERR"
+                                        else data)
+            if self.multi_bulk.pending:
+                self.handleMultiBulkElement(reply)
+            else:
+                self.replyReceived(reply)
+
+        elif token == ":":  # integer
+            try:
+                reply = int(data)
+            except ValueError:
+                reply = redis.InvalidResponse(
+                    "Cannot convert data '%s' to integer" % data)
+
+            if self.multi_bulk.pending:
+                self.handleMultiBulkElement(reply)
+            else:
+                self.replyReceived(reply)
+
+    def rawDataReceived(self, data):
+        if self.bulk_length:
+            data, rest = data[:self.bulk_length], data[self.bulk_length:]
+            self.bulk_length -= len(data)
+        else:
+            rest = ""
+
+        self.bulk_buffer.append(data)
+        if self.bulk_length == 0:
+            bulk_buffer = "".join(self.bulk_buffer)[:-2]
+            self.bulk_buffer = []
+            self.bulkDataReceived(bulk_buffer)
+            self.setLineMode(extra=rest)
+
+    def bulkDataReceived(self, data):
+        el = None
+        if data is not None:
+            el = self.tryConvertData(data)
+
+        if self.multi_bulk.pending or self.multi_bulk.items:
+            self.handleMultiBulkElement(el)
+        else:
+            self.replyReceived(el)
+
+    def handleMultiBulkElement(self, element):
+        self.multi_bulk.append(element)
+
+        if not self.multi_bulk.pending:
+            self.multiBulkDataReceived()
+
+    def multiBulkDataReceived(self):
+        while self.multi_bulk.parent and not self.multi_bulk.pending:
+            p = self.multi_bulk.parent
+            p.append(self.multi_bulk.items)
+            self.multi_bulk = p
+
+        if not self.multi_bulk.pending:
+            reply = self.multi_bulk.items
+            self.multi_bulk = MultiBulkStorage()
+
+            reply = self.handleTransactionData(reply)
+
+            self.replyReceived(reply)
+
+
+def bulk(value):
+    return "$%d\r\n%s\r\n" % (len(value), value)
+
+
+def multi_bulk(values):
+    return "*%d\r\n%s" % (len(values), "".join(bulk(v) for v in values))
+
+
+REPLIES = [
+    ("MGET 1k keys",
+     multi_bulk(["value:%d:%s" % (x, "x" * 32) for x in xrange(1000)])),
+    ("MGET 1k binary blobs",
+     multi_bulk(["%d\xff\x80%s" % (x, "\x00" * 32) for x in xrange(1000)])),
+    ("HGETALL 10k fields",
+     multi_bulk(sum([["field:%d" % x, "value:%d:%s" % (x, "y" * 16)]
+                     for x in xrange(10000)], []))),
+]
+
+
+def parse(protocol_class, data, rounds, chunk_size=65536, raw=False):
+    clock = task.Clock()
+    proto = protocol_class(charset=None if raw else "utf-8")
+    proto.factory = Factory()
+    proto.factory.convertNumbers = not raw
+    # Older parsers resume after each bulk reply in a new reactor
+    # iteration, the clock stands for the reactor.
+    proto.callLater = clock.callLater
+    proto.makeConnection(StringTransport())
+    proto.connected = 1
+    chunks = [data[x:x + chunk_size] for x in xrange(0, len(data), chunk_size)]
+
+    started = time.time()
+    for x in xrange(rounds):
+        d = proto.replyQueue.get()
+        for chunk in chunks:
+            proto.dataReceived(chunk)
+        while not d.called:
+            clock.advance(0)
+    return (time.time() - started) / rounds
+
+
+def main(rounds=20):
+    protocols = [LegacyRedisProtocol, redis.BaseRedisProtocol]
+    if redis.hiredis is not None:
+        protocols.append(redis.HiredisProtocol)
+
+    for name, data in REPLIES:
+        print "%s (%d bytes)" % (name, len(data))
+        for protocol_class in protocols:
+            for raw in (False, True):
+                label = protocol_class.__name__ + (" raw" if raw else "")
+                elapsed = parse(protocol_class, data, rounds, raw=raw)
+                print "    %-30s %8.2f ms/reply" % (label, elapsed * 1000)
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Copyright 2010 Alexandre Fiori
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# Measures how many times per second a typical page, a template extending
+# a base layout with a loop, conditionals and escaped values, can be
+# rendered. "legacy" renders it the way Template.generate used to: exec
+# of the compiled module and linecache.clearcache() on every call, with
+# the Deferred-aware code of asynchronous templates. "asynchronous" is
+# that code, compiled once, and "synchronous" the default plain function.
+#
+#   python template_render.py [renders]
+
+import datetime
+import linecache
+import sys
+import time
+
+from twisted.internet.defer import inlineCallbacks
+
+from cyclone import escape
+from cyclone import template
+from cyclone.util import ObjectDict
+
+
+TEMPLATES = {
+    "base.html": """<!DOCTYPE html>
+<html>
+  <head>
+    <title>{% block title %}Site{% end %}</title>
+  </head>
+  <body>
+    <div id="header">{{ user["name"] }}</div>
+    {% block body %}{% end %}
+    <div id="footer">{% block footer %}&copy; cyclone{% end %}</div>
+  </body>
+</html>
+""",
+    "page.html": """{% extends "base.html" %}
+{% block title %}{{ title }} - {% super %}{% end %}
+{% block body %}
+  <ul>
+  {% for item in items %}
+    <li class="{% if item["done"] %}done{% else %}todo{% end %}">
+      <a href="/items/{{ url_escape(item["id"]) }}">{{ item["text"] }}</a>
+    </li>
+  {% end %}
+  </ul>
+{% end %}
+""",
+}
+
+
+def legacy_generate(t, **kwargs):
+    namespace = {
+        "escape": escape.xhtml_escape,
+        "xhtml_escape": escape.xhtml_escape,
+        "url_escape": escape.url_escape,
+        "json_encode": escape.json_encode,
+        "squeeze": escape.squeeze,
+        "linkify": escape.linkify,
+        "datetime": datetime,
+        "_utf8": escape.utf8,
+        "_string_types": (unicode, str),
+        "__name__": t.name.replace('.', '_'),
+        "__loader__": ObjectDict(get_source=lambda name: t.code),
+    }
+    namespace.update(t.namespace)
+    namespace.update(kwargs)
+    exec "from twisted.internet.defer import returnValue, Deferred" \
+        in namespace
+    exec t.compiled in namespace
+    execute = inlineCallbacks(namespace["_execute"])
+    linecache.clearcache()
+    return execute().result
+
+
+def measure(render, renders):
+    started = time.time()
+    for x in xrange(renders):
+        render()
+    return renders / (time.time() - started)
+
+
+def main(renders=100000):
+    page = template.DictLoader(TEMPLATES).load("page.html")
+    loader = template.DictLoader(TEMPLATES, asynchronous=True)
+    async_page = loader.load("page.html")
+    kwargs = dict(
+        title="Things <to do>",
+        user={"name": "Alice & Bob"},
+        items=[{"id": str(x), "text": "item <%d>" % x, "done": x % 3 == 0}
+               for x in xrange(10)])
+    assert legacy_generate(async_page, **kwargs) == page.generate(**kwargs)
+
+    print "page.html, %d renders" % renders
+    for label, render in [
+            ("legacy", lambda: legacy_generate(async_page, **kwargs)),
+            ("asynchronous", lambda: async_page.generate(**kwargs)),
+            ("synchronous", lambda: page.generate(**kwargs))]:
+        print "    %-20s %10.0f renders/s" % (label, measure(render, renders))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))